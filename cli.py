@@ -4,6 +4,7 @@
 # Date: 2020-12-10
 
 
+import os
 import string
 import subprocess
 import sys
@@ -14,8 +15,10 @@ from pathlib import Path
 from typing import List, Optional
 
 from ugit import base
+from ugit import daemon
 from ugit import data
 from ugit import diff
+from ugit import protocol
 from ugit import remote
 
 
@@ -28,6 +31,20 @@ def is_oid (oid):
     else: 
         return base.get_oid (oid)
 
+
+
+def is_filter (spec):
+    if spec not in (None, 'blob:none'):
+        raise typer.BadParameter (f'Unsupported filter {spec}, only blob:none')
+    return spec
+
+
+def is_remote (remote_path):
+    if protocol.is_url (remote_path):
+        return remote_path
+    if not Path (remote_path).is_dir ():
+        raise typer.BadParameter (f'Directory {remote_path} does not exist')
+    return str (remote_path)
     
 
 app = typer.Typer()
@@ -47,7 +64,7 @@ def hash_object (file: Path = typer.Argument(..., exists=True)):
     """
     Add a single file to the repository and print it's OID
     """
-    print (data.hash_object (file.read_bytes ()))
+    print (data.hash_file (file))
 
 
 @app.command('cat-file')
@@ -56,7 +73,9 @@ def cat_file (object:  str = typer.Argument(...,  callback=is_oid)):
     Display file content for a given OID 
     """
     if data.object_exists (object):
-        print (data.get_object (object, expected=None).decode())
+        sys.stdout.flush ()
+        for chunk in data.open_object (object, expected=None):
+            sys.stdout.buffer.write (chunk)
 
 
 @app.command('write-tree')
@@ -106,20 +125,23 @@ def log (value: str = typer.Argument('@', callback=is_oid)):
 
 
 @app.command()
-def show (value: str = typer.Argument('@', callback=is_oid)):
+def show (value: str = typer.Argument('@', callback=is_oid),
+          paths: Optional[List[str]] = typer.Argument (None)):
     """
     Show differences between given and previous Commit point
+    (optionally limited to the given paths)
     """
     commit = base.get_commit (value)
     parent_tree = None
-    if commit.parents:
-        parent_tree = base.get_commit (commit.parents[0]).tree
+    parents = base.get_commit_parents (value)
+    if parents:
+        parent_tree = base.get_commit_tree (parents[0])
 
     _print_commit (value, commit)
-    result = diff.diff_trees (
-        base.get_tree (parent_tree), base.get_tree (commit.tree))
+    result = diff.diff_trees (parent_tree, commit.tree, paths)
     sys.stdout.flush ()
-    sys.stdout.buffer.write (result)
+    for chunk in result:
+        sys.stdout.buffer.write (chunk)
 
 
 @app.command('diff')
@@ -141,14 +163,15 @@ def _diff (commit: str,
             oid = base.get_oid ('@')
             tree_from = base.get_tree (oid and base.get_commit (oid).tree)
     else:
-        tree_to = base.get_working_tree ()
+        tree_to = base.get_working_tree (try_lock=True)
         if not commit:
             # If no commit was provided, diff from index
             tree_from = base.get_index_tree ()
 
     result = diff.diff_trees (tree_from, tree_to)
     sys.stdout.flush ()
-    sys.stdout.buffer.write (result)
+    for chunk in result:
+        sys.stdout.buffer.write (chunk)
 
 
 @app.command()
@@ -199,9 +222,8 @@ def k ():
             oids.add (ref.value)
 
     for oid in base.iter_commits_and_parents (oids):
-        commit = base.get_commit (oid)
         dot += f'"{oid}" [shape=box style=filled label="{oid[:10]}"]\n'
-        for parent in commit.parents:
+        for parent in base.get_commit_parents (oid):
             dot += f'"{oid}" -> "{parent}"\n'
 
     dot += '}'
@@ -214,7 +236,7 @@ def k ():
 
 
 @app.command()
-def status ():
+def status (jobs: int = typer.Option (0, "--jobs", "-j")):
     """
     List status on changed, staged or comitted files
     """
@@ -230,16 +252,22 @@ def status ():
         print (f'Merging with {MERGE_HEAD[:10]}')
 
     print ('\nChanges to be committed:\n')
-    HEAD_tree = HEAD and base.get_commit (HEAD).tree
-    for path, action in diff.iter_changed_files (base.get_tree (HEAD_tree),
+    HEAD_tree = HEAD and base.get_commit_tree (HEAD)
+    for path, action in diff.iter_changed_files (HEAD_tree,
                                                  base.get_index_tree ()):
         print (f'{action:>12}: {path}')
 
     print ('\nChanges not staged for commit:\n')
+    working_tree = base.get_working_tree (jobs or None, untracked=False,
+                                          try_lock=True)
     for path, action in diff.iter_changed_files (base.get_index_tree (),
-                                                 base.get_working_tree ()):
+                                                 working_tree):
         print (f'{action:>12}: {path}')
 
+    print ('\nUntracked files:\n')
+    for path in base.get_untracked_files ():
+        print (f'{"":>12}  {path}')
+
 
 @app.command()
 def reset (commit: str = typer.Argument('@', callback=is_oid)):
@@ -259,39 +287,144 @@ def merge (commit: str = typer.Argument(...,  callback=base.get_oid)):
 
 @app.command('merge-base')
 def merge_base (commit1: str = typer.Argument(...,  callback=base.get_oid), 
-                commit2: str = typer.Argument(...,  callback=base.get_oid)):
+                commit2: str = typer.Argument(...,  callback=base.get_oid),
+                all: bool = typer.Option (False, "--all")):
     """
     Merge branches based on two given commit points
     """
-    print (base.get_merge_base (commit1, commit2))
+    if all:
+        for oid in base.get_merge_bases (commit1, commit2):
+            print (oid)
+    else:
+        print (base.get_merge_base (commit1, commit2))
 
 
 @app.command()
-def fetch (remote_path: Path  = typer.Argument(..., exists=True, dir_okay=True, readable=True)):
+def fetch (remote_path: str = typer.Argument(..., callback=is_remote),
+           link: bool = typer.Option (False, "--link", 
+                                      help="Hardlink the objects of a local remote"),
+           depth: Optional[int] = typer.Option (None, "--depth", min=1,
+                                                help="Fetch only this many commits of history"),
+           unshallow: bool = typer.Option (False, "--unshallow",
+                                           help="Fetch all history of a shallow repository"),
+           filter_spec: Optional[str] = typer.Option (None, "--filter", callback=is_filter,
+                                                 help="blob:none to fetch blobs on demand")):
     """
-    Fetch branch from a remote repository
+    Fetch branch from a remote repository, a path or ugit://host:port/path
     """
-    remote.fetch (remote_path)
+    if depth and unshallow:
+        raise typer.BadParameter ('--depth and --unshallow exclude each other')
+    remote.fetch (remote_path, link, depth, unshallow, blobs=not filter_spec)
+
+
+@app.command()
+def clone (remote_path: str = typer.Argument(..., callback=is_remote),
+           directory: Path = typer.Argument (...),
+           link: bool = typer.Option (False, "--link",
+                                      help="Hardlink the objects of a local remote"),
+           shared: bool = typer.Option (False, "--shared",
+                                        help="Read the objects of a local remote in place"),
+           depth: Optional[int] = typer.Option (None, "--depth", min=1,
+                                                help="Fetch only this many commits of history"),
+           filter_spec: Optional[str] = typer.Option (None, "--filter", callback=is_filter,
+                                                 help="blob:none to fetch blobs on demand")):
+    """
+    Clone a repository into a new directory
+    """
+    if not protocol.is_url (remote_path):
+        remote_path = str (Path (remote_path).resolve ())
+    if directory.exists () and any (directory.iterdir ()):
+        raise typer.BadParameter (f'Directory {directory} is not empty')
+    directory.mkdir (parents=True, exist_ok=True)
+    os.chdir (directory)
+    remote.clone (remote_path, link, shared, depth, blobs=not filter_spec)
 
     
 @app.command()
-def push (remote_path: Path = typer.Argument (..., exists=True, dir_okay=True, readable=True),
+def push (remote_path: str = typer.Argument (..., callback=is_remote),
           branch: str = typer.Argument (...)):
     """
-    Push Branch to a remote repository
+    Push Branch to a remote repository, a path or ugit://host:port/path
     """
     if branch and base.is_branch (branch):
-        remote.push (str(remote_path), f'refs/heads/{branch}')
+        remote.push (remote_path, f'refs/heads/{branch}')
     else:
         print ('ERROR: Given branch is incorrect')
 
 
 @app.command()
-def add (files: List[Path]):
+def serve (root: Path = typer.Argument ('.', exists=True, file_okay=False),
+           host: str = typer.Option ('localhost', "--host"),
+           port: int = typer.Option (protocol.DEFAULT_PORT, "--port", "-p"),
+           jobs: int = typer.Option (0, "--jobs", "-j")):
+    """
+    Serve the repositories below root to ugit://host:port/path remotes
+    """
+    print (f'Serving {root} on {host}:{port}')
+    daemon.serve (root, host, port, jobs or None)
+
+
+@app.command('sparse-checkout')
+def sparse_checkout (directories: Optional[List[str]] = typer.Argument (None),
+                     disable: bool = typer.Option (False, "--disable",
+                                                   help="Check out all files again")):
+    """
+    Check out only the given directories, or list those checked out
+    """
+    if disable:
+        base.set_sparse_checkout (None)
+    elif directories:
+        base.set_sparse_checkout (directories)
+    else:
+        for directory in data.get_sparse_checkout () or []:
+            print (directory)
+
+
+@app.command('commit-graph')
+def commit_graph ():
+    """
+    Write all Commits reachable from References into the commit-graph file
+    """
+    oids = {ref.value for _, ref in data.iter_refs ()}
+    count = base.update_commit_graph (oids)
+    print (f'Added {count} commits to the commit-graph')
+
+
+@app.command()
+def repack ():
+    """
+    Move all objects into a single pack file with reachability bitmaps
+    """
+    p = base.repack ()
+    print (f'Packed {len (p) if p else 0} objects')
+
+
+@app.command()
+def gc ():
+    """
+    Pack all reachable objects and delete unreachable ones
+    """
+    p = base.gc ()
+    print (f'Packed {len (p) if p else 0} reachable objects')
+
+
+@app.command()
+def pack_refs ():
+    """
+    Move all refs into the packed-refs file
+    """
+    count = data.pack_refs ()
+    print (f'Packed {count} refs')
+
+
+@app.command()
+def add (files: List[Path],
+         jobs: int = typer.Option (0, "--jobs", "-j")):
     """
     Add a list of files/dirs to the repository and its Index file
+    (hashed by --jobs worker processes, default one per CPU)
     """
-    base.add (files)
+    base.add (files, jobs or None)
 
 
 @app.command()
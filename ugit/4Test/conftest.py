@@ -0,0 +1,64 @@
+# File: conftest.py
+
+# Fixtures shared by the pytest routines of this directory:
+# every test runs in a fresh repository within its own temp directory
+
+import sys
+
+from pathlib import Path
+
+import pytest
+
+sys.path.insert (0, str (Path (__file__).resolve ().parents[2]))
+
+from ugit import base
+from ugit import data
+from ugit import pack
+
+
+def reset_caches ():
+    """ Forget everything cached by the previous repository """
+    data.clear_ref_cache ()
+    data._packed_refs.clear ()
+    data._packs.clear ()
+    data._alternates.clear ()
+    data._object_dirs.clear ()
+    data._commit_graphs.clear ()
+    data.object_cache.clear ()
+    data.parsed_cache.clear ()
+    pack.base_cache.clear ()
+    base._generations.clear ()
+
+
+@pytest.fixture
+def repo (tmp_path, monkeypatch):
+    """ An initialized, empty repository as current directory """
+    path = tmp_path / 'repo'
+    path.mkdir ()
+    monkeypatch.chdir (path)
+    reset_caches ()
+    base.init ()
+    yield path
+    reset_caches ()
+
+
+def write (path, content):
+    """ Write a work tree file, creating its directories """
+    fp = Path (path)
+    fp.parent.mkdir (parents=True, exist_ok=True)
+    fp.write_text (content) if isinstance (content, str) else fp.write_bytes (content)
+
+
+def commit (files, message='commit'):
+    """ Write files {path: content}, add them and commit, returns the OID """
+    for path, content in files.items ():
+        write (path, content)
+    base.add ([Path (path) for path in files])
+    return base.commit (message)
+
+
+def enter (monkeypatch, path):
+    """ Switch to another repository directory, creating it if needed """
+    path.mkdir (exist_ok=True)
+    monkeypatch.chdir (path)
+    reset_caches ()
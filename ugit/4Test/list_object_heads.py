@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 
-# list heads of all object files in .ugit/objects
+# list heads of all loose object files in .ugit/objects
+# - objects are zlib compressed within fan-out directories: objects/ab/cdef...
+# - objects of the former flat layout are stored uncompressed: objects/abcdef...
+
+import zlib
 
 from pathlib import Path
 
 p = Path ('.ugit/objects')
 
-for f in (fp for fp in p.rglob('*') if fp.is_file() if fp.is_file()):
-     print(f.name, '\t', f.read_bytes()[0:20])
-
+for d in sorted (fp for fp in p.iterdir() if fp.is_dir() if len (fp.name) == 2):
+     for f in sorted (fp for fp in d.iterdir() if fp.is_file()):
+          head = zlib.decompressobj().decompress(f.read_bytes(), 20)
+          print(d.name + f.name, '\t', head)
 
+for f in (fp for fp in p.iterdir() if fp.is_file() if len (fp.name) == 40):
+     print(f.name, '\t', f.read_bytes()[0:20])
@@ -0,0 +1,75 @@
+# File: test_alternates.py
+
+# Object directories read as alternates, and clones sharing them
+
+import os
+
+from pathlib import Path
+
+from ugit import base
+from ugit import data
+from ugit import remote
+
+from conftest import commit, enter
+
+
+def other_repo (tmp_path, monkeypatch, name, files):
+    """ Create a repository with one commit of files, returns
+    (its path, the commit), the current directory is left unchanged
+    """
+    cwd = Path.cwd ()
+    path = tmp_path / name
+    path.mkdir ()
+    monkeypatch.chdir (path)
+    base.init ()
+    oid = commit (files)
+    monkeypatch.chdir (cwd)
+    return path, oid
+
+
+def test_alternate_added_later_is_found (repo, tmp_path, monkeypatch):
+    other, oid = other_repo (tmp_path, monkeypatch, 'other', {'f': 'other\n'})
+    assert not data.object_exists (oid)
+
+    data.add_alternate (other / '.ugit' / 'objects')
+    assert data.object_exists (oid)
+    assert base.get_commit (oid).message == 'commit'
+    assert data.get_alternates () == [other / '.ugit' / 'objects']
+
+
+def test_alternates_of_alternates (repo, tmp_path, monkeypatch):
+    first, first_oid = other_repo (tmp_path, monkeypatch, 'first', {'f': '1\n'})
+    second, second_oid = other_repo (tmp_path, monkeypatch, 'second', {'f': '2\n'})
+
+    monkeypatch.chdir (second)
+    data.add_alternate (first / '.ugit' / 'objects')
+    # A cycle back does not make the lookup loop
+    data.add_alternate (repo / '.ugit' / 'objects')
+    monkeypatch.chdir (repo)
+
+    data.add_alternate (second / '.ugit' / 'objects')
+    assert data.object_exists (first_oid)
+    assert data.object_exists (second_oid)
+    assert not data.object_exists ('0' * 40)
+
+
+def test_shared_clone (repo, tmp_path, monkeypatch):
+    oid = commit ({'f': 'shared\n'})
+
+    enter (monkeypatch, tmp_path / 'clone')
+    remote.clone (str (repo), shared=True)
+    assert Path ('f').read_text () == 'shared\n'
+    assert data.get_ref ('refs/heads/master').value == oid
+    assert not any ((data.GIT_DIR / 'objects').glob ('??/*'))
+
+
+def test_linked_clone (repo, tmp_path, monkeypatch):
+    commit ({'f': 'packed\n'})
+    p = data.repack ()
+    oid = commit ({'f': 'loose\n'})
+
+    enter (monkeypatch, tmp_path / 'clone')
+    remote.clone (str (repo), link=True)
+    assert Path ('f').read_text () == 'loose\n'
+    assert os.path.samefile (data._loose_path (oid), repo / '.ugit' / 'objects' / oid[:2] / oid[2:])
+    assert os.path.samefile (data.GIT_DIR / 'objects' / 'pack' / p.path.name, p.path)
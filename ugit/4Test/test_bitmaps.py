@@ -0,0 +1,54 @@
+# File: test_bitmaps.py
+
+# Reachability bitmaps and garbage collection
+
+import os
+
+from pathlib import Path
+
+from ugit import base
+from ugit import data
+
+from conftest import commit
+
+
+def make_history (count):
+    return [commit ({'f': f'{i}\n', f'd/{i % 3}': f'{i}\n'}) for i in range (count)]
+
+
+def test_gc_writes_bitmaps (repo):
+    make_history (10)
+    p = base.gc ()
+    assert p.bitmaps
+    assert p.path.with_suffix ('.bitmap').is_file ()
+    assert not dict (data._iter_loose_paths ())
+
+
+def test_bitmaps_give_the_same_objects (repo):
+    history = make_history (20)
+    expected_all = set (base.iter_objects_in_commits ([history[-1]]))
+    expected_new = set (base.iter_new_objects ([history[-1]], [history[5]]))
+
+    base.gc ()
+    # A commit after the bitmaps were written
+    history.append (commit ({'f': 'after gc\n'}))
+    assert base._get_bitmap_pack ()
+    assert set (base.iter_reachable_objects ([history[-2]])) == expected_all
+    assert set (base.iter_new_objects ([history[-2]], [history[5]])) == expected_new
+    assert set (base.iter_new_objects ([history[-1]], [history[-2]])) == {
+        history[-1], base.get_commit (history[-1]).tree, data.hash_object (b'after gc\n')}
+
+
+def test_gc_deletes_unreachable_objects (repo):
+    commit ({'f': '1\n'})
+    old = data.hash_object (b'unreachable and old\n')
+    recent = data.hash_object (b'unreachable but recent\n')
+    expired = 1_000_000
+    os.utime (data._loose_path (old), (expired, expired))
+
+    p = base.gc ()
+    assert old not in p and recent not in p
+    assert not data.object_exists (old)
+    assert data.object_exists (recent)
+    assert data.get_object (data.hash_object (b'1\n')) == b'1\n'
+    assert Path ('f').read_text () == '1\n'
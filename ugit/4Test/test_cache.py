@@ -0,0 +1,67 @@
+# File: test_cache.py
+
+# Size-bounded LRU caches of objects
+
+import pytest
+
+from ugit import base
+from ugit import data
+from ugit.cache import LRUCache
+
+from conftest import commit
+
+
+def test_least_recently_used_is_evicted ():
+    cache = LRUCache (10)
+    cache.put ('a', 1, 4)
+    cache.put ('b', 2, 4)
+    assert cache.get ('a') == 1
+    cache.put ('c', 3, 4)
+    assert 'b' not in cache
+    assert cache.get ('a') == 1 and cache.get ('c') == 3
+    assert cache.size == 8
+    assert (cache.hits, cache.misses) == (3, 0)
+    assert cache.get ('b', 'missing') == 'missing'
+    assert cache.misses == 1
+
+
+def test_replacing_and_oversized_values ():
+    cache = LRUCache (10)
+    cache.put ('a', 1, 4)
+    cache.put ('a', 2, 6)
+    assert cache.get ('a') == 2 and cache.size == 6
+    cache.put ('big', 3, 11)
+    assert 'big' not in cache and cache.size == 6
+
+
+def test_resize_and_disable ():
+    cache = LRUCache (10)
+    for key in 'abc':
+        cache.put (key, key, 3)
+    cache.resize (5)
+    assert len (cache) == 1 and 'c' in cache
+    cache.resize (0)
+    assert not len (cache)
+    cache.put ('d', 'd', 1)
+    assert 'd' not in cache
+
+
+def test_parsed_commits_are_cached (repo, monkeypatch):
+    oid = commit ({'f': '1\n'}, 'cached')
+    data.parsed_cache.clear ()
+    assert base.get_commit (oid).message == 'cached'
+
+    def no_read (*args):
+        raise AssertionError ('Object read again')
+
+    monkeypatch.setattr (data, 'get_object', no_read)
+    assert base.get_commit (oid).message == 'cached'
+
+
+def test_cached_tree_is_no_commit (repo):
+    oid = commit ({'f': '1\n'})
+    tree = base.get_commit (oid).tree
+    list (base._iter_tree_entries (tree))
+    with pytest.raises (AssertionError, match='Expected commit, got tree'):
+        base.get_commit (tree)
+    assert base.get_commit (oid).parents == ()
@@ -0,0 +1,61 @@
+# File: test_cache_tree.py
+
+# Tree OIDs of unchanged directories cached in the Index
+
+from pathlib import Path
+
+from ugit import base
+from ugit import data
+
+from conftest import commit, write
+
+
+def cached_trees ():
+    with data.get_index (read_only=True) as index:
+        return dict (index.trees)
+
+
+def test_changed_file_invalidates_its_directories (repo):
+    commit ({'a/b/c': '1\n', 'a/d': '2\n', 'e/f': '3\n'})
+    before = cached_trees ()
+    assert set (before) == {'', 'a', 'a/b', 'e'}
+
+    write ('a/b/c', 'changed\n')
+    base.add ([Path ('a/b/c')])
+    assert cached_trees () == {'e': before['e']}
+
+
+def test_cached_trees_give_the_same_tree (repo, monkeypatch):
+    commit ({'a/b': '1\n', 'c/d': '2\n'})
+    write ('a/b', 'changed\n')
+    base.add ([Path ('a/b')])
+    tree = base.write_tree ()
+
+    with data.get_index () as index:
+        index.trees.clear ()
+        index.dirty = True
+    hashed = []
+    hash_object = data.hash_object
+
+    def record (content, type_='blob'):
+        hashed.append (type_)
+        return hash_object (content, type_)
+
+    monkeypatch.setattr (data, 'hash_object', record)
+    assert base.write_tree () == tree
+    assert hashed.count ('tree') == 3
+
+    hashed.clear ()
+    assert base.write_tree () == tree
+    assert hashed == []
+
+
+def test_read_tree_fills_the_cache (repo):
+    oid = commit ({'a/b': '1\n', 'c': '2\n'})
+    with data.get_index () as index:
+        index.trees.clear ()
+        index.dirty = True
+    base.read_tree (base.get_commit (oid).tree)
+    trees = cached_trees ()
+    assert trees[''] == base.get_commit (oid).tree
+    assert 'a' in trees
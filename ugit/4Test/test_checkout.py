@@ -0,0 +1,111 @@
+# File: test_checkout.py
+
+# Incremental checkout and merge of the working directory
+
+import os
+
+from pathlib import Path
+
+import pytest
+
+from ugit import base
+from ugit import data
+
+from conftest import commit, write
+
+
+def test_checkout_touches_only_changed_files (repo):
+    first = commit ({'same': 'same\n', 'changed': 'one\n', 'gone': 'gone\n'})
+    os.utime ('same', ns=(0, 0))
+    Path ('gone').unlink ()
+    base.add ([Path ('.')])
+    with data.get_index () as index:
+        del index['gone']
+    commit ({'changed': 'two\n', 'new': 'new\n'})
+
+    base.checkout (first)
+    assert Path ('changed').read_text () == 'one\n'
+    assert Path ('gone').read_text () == 'gone\n'
+    assert not Path ('new').exists ()
+    assert os.stat ('same').st_mtime_ns == 0
+
+
+def test_checkout_refuses_to_overwrite_local_changes (repo):
+    first = commit ({'f': 'one\n'})
+    commit ({'f': 'two\n'})
+    write ('f', 'local\n')
+    with pytest.raises (AssertionError, match='local changes'):
+        base.checkout (first)
+    assert Path ('f').read_text () == 'local\n'
+
+
+def test_checkout_file_becoming_directory (repo):
+    file_commit = commit ({'a': 'file\n'})
+    Path ('a').unlink ()
+    with data.get_index () as index:
+        del index['a']
+    dir_commit = commit ({'a/b': 'nested\n', 'a/c/d': 'deeper\n'})
+
+    base.checkout (file_commit)
+    assert Path ('a').read_text () == 'file\n'
+    base.checkout (dir_commit)
+    assert Path ('a/b').read_text () == 'nested\n'
+    assert Path ('a/c/d').read_text () == 'deeper\n'
+    assert set (base.get_index_tree ()) == {'a/b', 'a/c/d'}
+
+
+def test_checkout_directory_with_untracked_file_is_not_replaced (repo):
+    file_commit = commit ({'a': 'file\n'})
+    Path ('a').unlink ()
+    with data.get_index () as index:
+        del index['a']
+    commit ({'a/b': 'nested\n'})
+    write ('a/untracked', 'keep me\n')
+
+    with pytest.raises (AssertionError, match='local changes'):
+        base.checkout (file_commit)
+    assert Path ('a/untracked').read_text () == 'keep me\n'
+
+
+def test_checkout_with_deleted_directory (repo):
+    first = commit ({'top': '1\n'})
+    commit ({'d/e/f': 'x\n', 'd/g': 'y\n'})
+    for path in ('d/e/f', 'd/g'):
+        Path (path).unlink ()
+    Path ('d/e').rmdir ()
+    Path ('d').rmdir ()
+
+    base.checkout (first)
+    assert not Path ('d').exists ()
+    assert set (base.get_index_tree ()) == {'top'}
+
+
+def test_refused_merge_leaves_no_merge_head (repo):
+    start = commit ({'f': 'base\n'})
+    commit ({'f': 'ours\n'})
+    base.checkout (start)
+    other = commit ({'f': 'theirs\n'})
+    base.checkout ('master')
+
+    write ('f', 'local\n')
+    with pytest.raises (AssertionError, match='local changes'):
+        base.merge (other)
+    assert not data.get_ref ('MERGE_HEAD').value
+
+    write ('f', 'ours\n')
+    oid = commit ({'g': 'next\n'})
+    assert len (base.get_commit (oid).parents) == 1
+
+
+def test_merge_records_merge_head (repo):
+    start = commit ({'f': 'base\n', 'g': 'base\n'})
+    commit ({'f': 'ours\n'})
+    base.checkout (start)
+    other = commit ({'g': 'theirs\n'})
+    base.checkout ('master')
+
+    base.merge (other)
+    assert data.get_ref ('MERGE_HEAD').value == other
+    assert Path ('g').read_text () == 'theirs\n'
+    oid = base.commit ('merge')
+    assert base.get_commit (oid).parents[1] == other
@@ -0,0 +1,101 @@
+# File: test_commitgraph.py
+
+# Commit-graph file with generation numbers
+
+from ugit import base
+from ugit import commitgraph
+from ugit import data
+
+from conftest import commit
+
+
+def graph_path ():
+    return data.GIT_DIR / 'objects' / 'info' / 'commit-graph'
+
+
+def commit_outside_graph (files):
+    """ Commit while another process holds the lock of the graph """
+    lock = graph_path ().with_name ('commit-graph.lock')
+    lock.parent.mkdir (parents=True, exist_ok=True)
+    lock.touch ()
+    try:
+        return commit (files)
+    finally:
+        lock.unlink ()
+
+
+def assert_graph_matches_objects (graph):
+    for oid in graph.oids:
+        stored = base.get_commit (oid)
+        assert graph.get_parents (oid) == stored.parents
+        assert graph.get_tree (oid) == stored.tree
+
+
+def test_generations (repo):
+    root = commit ({'f': '1\n'})
+    second = commit ({'f': '2\n'})
+
+    graph = commitgraph.CommitGraph (graph_path ())
+    assert graph.get_generation (root) == 1
+    assert graph.get_generation (second) == 2
+    assert_graph_matches_objects (graph)
+
+
+def test_append_to_graph_changed_by_another_process (repo):
+    root = commit ({'f': '1\n'})
+    stale = data.get_commit_graph ()
+    assert root in stale
+
+    # Another process appends a commit meanwhile
+    second = commit_outside_graph ({'f': '2\n'})
+    commitgraph.CommitGraph (graph_path ()).append ([
+        (second, base.get_commit (second).tree, [root])])
+    assert second not in stale
+
+    # Committing appends through the stale cached graph
+    third = commit ({'f': '3\n'})
+
+    graph = commitgraph.CommitGraph (graph_path ())
+    assert graph.oids == [root, second, third]
+    assert graph.get_generation (third) == 3
+    assert_graph_matches_objects (graph)
+    assert not graph_path ().with_name ('commit-graph.lock').exists ()
+
+
+def test_truncated_record_is_left_out (repo):
+    root = commit ({'f': '1\n'})
+    second = commit ({'f': '2\n'})
+    with open (graph_path (), 'ab') as f:
+        f.write (b'\x00' * (commitgraph.RECORD.size // 2))
+
+    data._commit_graphs.clear ()
+    graph = data.get_commit_graph ()
+    assert graph.oids == [root, second]
+    assert base.get_merge_base (root, second) == root
+
+    third = commit ({'f': '3\n'})
+    graph = commitgraph.CommitGraph (graph_path ())
+    assert graph.oids == [root, second, third]
+    assert_graph_matches_objects (graph)
+
+
+def test_unreadable_graph_falls_back_to_objects (repo):
+    root = commit_outside_graph ({'f': '1\n'})
+    second = commit_outside_graph ({'f': '2\n'})
+    graph_path ().parent.mkdir (parents=True, exist_ok=True)
+    graph_path ().write_bytes (b'garbage')
+
+    data._commit_graphs.clear ()
+    assert not len (data.get_commit_graph ())
+    assert base.get_merge_base (root, second) == root
+
+    assert base.update_commit_graph ([second]) == 2
+    graph = commitgraph.CommitGraph (graph_path ())
+    assert graph.oids == [root, second]
+
+
+def test_locked_graph_is_not_appended_to (repo):
+    root = commit_outside_graph ({'f': '1\n'})
+    assert root not in commitgraph.CommitGraph (graph_path ())
+    assert base.update_commit_graph ([root]) == 1
+    assert root in commitgraph.CommitGraph (graph_path ())
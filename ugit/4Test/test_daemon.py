@@ -0,0 +1,126 @@
+# File: test_daemon.py
+
+# Fetching and pushing over ugit:// URLs from a server process
+
+import socket
+import subprocess
+import sys
+import time
+
+from pathlib import Path
+
+import pytest
+
+from ugit import base
+from ugit import data
+from ugit import protocol
+from ugit import remote
+
+from conftest import commit, enter
+
+
+@pytest.fixture
+def url (repo):
+    """ The ugit:// URL of repo, served by a daemon process """
+    with socket.socket () as sock:
+        sock.bind (('localhost', 0))
+        port = sock.getsockname ()[1]
+    root = Path (__file__).resolve ().parents[2]
+    process = subprocess.Popen (
+        [sys.executable, '-c', 'import sys; from ugit import daemon; '
+         'daemon.serve (sys.argv[1], port=int (sys.argv[2]), jobs=1)',
+         str (repo.parent), str (port)], cwd=root)
+    try:
+        for _ in range (100):
+            try:
+                socket.create_connection (('localhost', port)).close ()
+                break
+            except ConnectionRefusedError:
+                time.sleep (0.05)
+        yield f'ugit://localhost:{port}/{repo.name}'
+    finally:
+        process.terminate ()
+        process.wait ()
+
+
+def test_clone_and_fetch (repo, url, monkeypatch):
+    first = commit ({'f': '1\n', 'd/g': '2\n'})
+
+    enter (monkeypatch, repo.parent / 'clone')
+    remote.clone (url)
+    assert data.get_ref ('refs/heads/master').value == first
+    assert Path ('d/g').read_text () == '2\n'
+
+    enter (monkeypatch, repo)
+    second = commit ({'f': '3\n'})
+    enter (monkeypatch, repo.parent / 'clone')
+    remote.fetch (url)
+    assert data.get_ref ('refs/remote/master').value == second
+    assert base.get_commit (second).parents == (first,)
+
+
+def test_push (repo, url, monkeypatch):
+    commit ({'f': '1\n'})
+
+    enter (monkeypatch, repo.parent / 'clone')
+    remote.clone (url)
+    pushed = commit ({'f': '2\n'})
+    remote.push (url, 'refs/heads/master')
+
+    enter (monkeypatch, repo)
+    assert data.get_ref ('refs/heads/master').value == pushed
+
+
+def test_push_which_is_no_fast_forward_is_refused (repo, url, monkeypatch):
+    commit ({'f': '1\n'})
+
+    enter (monkeypatch, repo.parent / 'clone')
+    remote.clone (url)
+    commit ({'f': 'clone\n'})
+
+    enter (monkeypatch, repo)
+    server = commit ({'f': 'server\n'})
+
+    enter (monkeypatch, repo.parent / 'clone')
+    with pytest.raises (AssertionError):
+        remote.push (url, 'refs/heads/master')
+    enter (monkeypatch, repo)
+    assert data.get_ref ('refs/heads/master').value == server
+
+
+def test_unknown_repository (repo, url):
+    with protocol.Connection (url.rsplit ('/', 1)[0] + '/missing') as conn:
+        conn.send ({'command': 'fetch', 'path': conn.path})
+        with pytest.raises (AssertionError, match='No repository'):
+            conn.receive ()
+
+
+def push_update (url, update):
+    """ Push an update [ref, old, new] without objects, as another client
+    could, return the reply of the server
+    """
+    with protocol.Connection (url) as conn:
+        conn.send ({'command': 'push', 'path': conn.path})
+        conn.receive ()
+        conn.send ({'update': update, 'objects': 0})
+        return conn.receive ()
+
+
+@pytest.mark.parametrize ('refname', [
+    'refs/heads/../../../../x', '/refs/heads/x', 'refs/heads//x',
+    'refs/heads/./x', 'refs/heads/x.lock', 'refs\\heads\\x', 'refs/tags/x', ''])
+def test_push_to_invalid_ref_is_refused (repo, url, refname):
+    oid = commit ({'f': '1\n'})
+    with pytest.raises (AssertionError, match='Invalid ref name|Can not push'):
+        push_update (url, [refname, None, oid])
+    assert not (repo.parent / 'x').exists ()
+    assert sorted (p.name for p in (repo / '.ugit' / 'refs' / 'heads').iterdir ()) \
+        == ['master']
+
+
+def test_push_which_is_no_fast_forward_is_refused_by_server (repo, url):
+    first = commit ({'f': '1\n'})
+    second = commit ({'f': '2\n'})
+    with pytest.raises (AssertionError, match='not be fast-forwarded'):
+        push_update (url, ['refs/heads/master', second, first])
+    assert data.get_ref ('refs/heads/master').value == second
@@ -0,0 +1,42 @@
+# File: test_delta.py
+
+# Copy/insert deltas between object versions
+
+import os
+
+import pytest
+
+from ugit import delta
+
+
+@pytest.mark.parametrize ('value', [0, 1, 0x7f, 0x80, 0x3fff, 2 ** 40])
+def test_varint_round_trip (value):
+    buf = b'x' + delta.encode_varint (value) + b'y'
+    assert delta.decode_varint (buf, 1) == (value, len (buf) - 1)
+
+
+@pytest.mark.parametrize ('target', [
+    b'',
+    b'prefix ',
+    b'inserted in the middle',
+    os.urandom (300),
+])
+def test_delta_round_trip (target):
+    base = os.urandom (4096)
+    for new in (target + base, base[:1000] + target + base[1000:],
+                base + target, target):
+        d = delta.create_delta (base, new)
+        assert delta.apply_delta (base, d) == new
+
+
+def test_similar_versions_give_small_deltas ():
+    base = b''.join (f'line {i}\n'.encode () for i in range (1000))
+    target = base.replace (b'line 500\n', b'changed\n')
+    d = delta.create_delta (base, target)
+    assert len (d) < 100
+    assert delta.apply_delta (base, d) == target
+
+
+def test_delta_exceeding_max_size ():
+    base, target = os.urandom (1000), os.urandom (1000)
+    assert delta.create_delta (base, target, max_size=500) is None
@@ -0,0 +1,70 @@
+# File: test_diff.py
+
+# In-process Myers diff of lines and blobs
+
+import random
+
+import pytest
+
+from ugit import data
+from ugit import diff
+
+
+def lcs_length (a, b):
+    """ Length of the longest common subsequence, by dynamic programming """
+    row = [0] * (len (b) + 1)
+    for x in a:
+        previous = 0
+        for j, y in enumerate (b):
+            previous, row[j + 1] = row[j + 1], (previous + 1 if x == y
+                                                else max (row[j + 1], row[j]))
+    return row[-1]
+
+
+@pytest.mark.parametrize ('seed', range (50))
+def test_diff_lines_is_shortest (seed):
+    rng = random.Random (seed)
+    a = [rng.choice ('abcd') for _ in range (rng.randrange (30))]
+    b = [rng.choice ('abcd') for _ in range (rng.randrange (30))]
+    blocks = diff.diff_lines (a, b)
+
+    i = j = 0
+    for ai, bj, size in blocks:
+        assert ai >= i and bj >= j and size > 0
+        assert a[ai:ai + size] == b[bj:bj + size]
+        i, j = ai + size, bj + size
+    assert sum (size for _, _, size in blocks) == lcs_length (a, b)
+
+
+def test_unified_diff ():
+    a = [f'{i}\n'.encode () for i in range (1, 11)]
+    b = a[:4] + [b'five\n'] + a[5:]
+    assert b''.join (diff.unified_diff (a, b)) == (
+        b'@@ -2,7 +2,7 @@\n'
+        b' 2\n 3\n 4\n-5\n+five\n 6\n 7\n 8\n')
+
+
+def test_unified_diff_splits_distant_hunks ():
+    a = [f'line {i}\n'.encode () for i in range (30)]
+    b = list (a)
+    b[2], b[25] = b'first\n', b'second\n'
+    hunks = list (diff.unified_diff (a, b))
+    assert [hunk.split (b'\n')[0] for hunk in hunks] == [
+        b'@@ -1,6 +1,6 @@', b'@@ -23,7 +23,7 @@ line 21']
+
+
+def test_diff_blobs_without_newline_at_end (repo):
+    o_from = data.hash_object (b'same\nold')
+    o_to = data.hash_object (b'same\nnew')
+    assert b''.join (diff.diff_blobs (o_from, o_to, 'f')) == (
+        b'--- a/f\n+++ b/f\n'
+        b'@@ -1,2 +1,2 @@\n'
+        b' same\n-old\n\\ No newline at end of file\n'
+        b'+new\n\\ No newline at end of file\n')
+
+
+def test_binary_blobs (repo):
+    o_from = data.hash_object (b'\x00\x01')
+    o_to = data.hash_object (b'\x00\x02')
+    assert b''.join (diff.diff_blobs (o_from, o_to, 'f')) == \
+        b'Binary files a/f and b/f differ\n'
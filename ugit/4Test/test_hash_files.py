@@ -0,0 +1,57 @@
+# File: test_hash_files.py
+
+# Hashing work tree files, serially or by a pool of worker processes
+
+from pathlib import Path
+
+import pytest
+
+from ugit import base
+from ugit import data
+
+from conftest import write
+
+
+def make_files (count):
+    files = []
+    for i in range (count):
+        write (f'd/{i}', f'content {i}\n')
+        files.append ((Path (f'd/{i}'), data.stat_data (f'd/{i}')))
+    return files
+
+
+def test_serial_hashing_keeps_git_dir (repo):
+    git_dir = data.GIT_DIR
+    oids = base.hash_files (make_files (3), jobs=1)
+    assert data.GIT_DIR is git_dir
+    assert oids == [data.hash_object (f'content {i}\n'.encode ()) for i in range (3)]
+
+
+def test_worker_restores_git_dir (repo):
+    git_dir = data.GIT_DIR
+    with pytest.raises (FileNotFoundError):
+        base._hash_path ('missing', repo / '.ugit')
+    assert data.GIT_DIR is git_dir
+
+    write ('f', 'f\n')
+    assert base._hash_path ('f', repo / '.ugit') == data.hash_object (b'f\n')
+    assert data.GIT_DIR is git_dir
+
+
+def test_parallel_hashing (repo, monkeypatch):
+    monkeypatch.setattr (base, 'PARALLEL_MIN_FILES', 0)
+    monkeypatch.setattr (base, 'PARALLEL_MIN_BYTES', 0)
+    files = make_files (20)
+    oids = base.hash_files (files, jobs=2)
+    assert oids == [data.hash_object (f'content {i}\n'.encode ()) for i in range (20)]
+    assert all (map (data.object_exists, oids))
+
+
+def test_add_with_worker_processes (repo, monkeypatch):
+    monkeypatch.setattr (base, 'PARALLEL_MIN_FILES', 0)
+    make_files (10)
+    base.add ([Path ('d')], jobs=2)
+    with data.get_index (read_only=True) as index:
+        assert {path: index[path] for path in index} == {
+            f'd/{i}': data.hash_object (f'content {i}\n'.encode ()) for i in range (10)}
+        assert all (index.stats[path] == data.stat_data (path) for path in index)
@@ -0,0 +1,95 @@
+# File: test_ignore.py
+
+# Gitignore-style patterns, and walking the files which are not ignored
+
+import os
+import re
+
+import pytest
+
+from ugit import ignore
+
+from conftest import write
+
+
+@pytest.mark.parametrize ('pattern, path, ignored', [
+    ('*.log', 'a.log', True),
+    ('*.log', 'd/e/a.log', True),
+    ('*.log', 'a.log/x', False),
+    ('a?c', 'abc', True),
+    ('a?c', 'a/c', False),
+    ('/top', 'top', True),
+    ('/top', 'd/top', False),
+    ('d/*.py', 'd/a.py', True),
+    ('d/*.py', 'd/e/a.py', False),
+    ('d/*.py', 'e/d/a.py', False),
+    ('**/build', 'build', True),
+    ('**/build', 'a/b/build', True),
+    ('d/**', 'd/a/b', True),
+    ('d/**', 'd', False),
+    ('a/**/b', 'a/b', True),
+    ('a/**/b', 'a/x/y/b', True),
+    ('[ab].txt', 'b.txt', True),
+    ('[!ab].txt', 'b.txt', False),
+    ('[!ab].txt', 'c.txt', True),
+    ('\\*', '*', True),
+    ('\\*', 'x', False),
+])
+def test_translate (pattern, path, ignored):
+    assert (re.fullmatch (ignore._translate (pattern), path) is not None) == ignored
+
+
+def test_negation_and_directories (repo):
+    rules = ignore.IgnoreRules (['*.log', '!keep.log', 'build/', '# comment', ''])
+    assert len (rules.rules) == 3
+    assert rules.match ('a.log')
+    assert not rules.match ('keep.log')
+    assert not rules.match ('build')
+    assert rules.match ('build', is_dir=True)
+    assert rules.is_ignored ('build/out')
+    # A file in an ignored directory is not re-included
+    assert rules.is_ignored ('build/keep.log')
+
+
+def test_combined_rules_match_like_single_ones (repo):
+    lines = ['*.log', 'build/', '/top', 'd/**/x']
+    combined = ignore.IgnoreRules (lines)
+    assert combined._combined
+    single = ignore.IgnoreRules (lines + ['!never'])
+    assert not single._combined
+    for path in ['a.log', 'build', 'top', 'd/top', 'd/x', 'd/e/x', 'f']:
+        for is_dir in (False, True):
+            assert combined.match (path, is_dir) == single.match (path, is_dir)
+
+
+def test_rules_are_read_again_when_changed (repo):
+    write (ignore.IGNORE_FILE, '*.log\n')
+    rules = ignore.get_rules ()
+    assert ignore.get_rules () is rules
+    assert rules.match ('a.log')
+
+    write (ignore.IGNORE_FILE, '*.tmp\n')
+    stat = os.stat (ignore.IGNORE_FILE)
+    os.utime (ignore.IGNORE_FILE, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    rules = ignore.get_rules ()
+    assert not rules.match ('a.log')
+    assert rules.match ('a.tmp')
+    # Forced patterns can not be re-included
+    assert rules.match ('.ugit', True)
+
+
+def test_walk_skips_ignored_directories (repo, monkeypatch):
+    write (ignore.IGNORE_FILE, 'build/\n*.log\n')
+    for path in ['f', 'a.log', 'd/g', 'd/h.log', 'build/x', 'd/build/y']:
+        write (path, 'content\n')
+    entered = []
+    scandir = os.scandir
+
+    def record_scandir (path):
+        entered.append (path)
+        return scandir (path)
+
+    monkeypatch.setattr (ignore.os, 'scandir', record_scandir)
+    paths = sorted (path for path, _ in ignore.walk ())
+    assert paths == [ignore.IGNORE_FILE, 'd/g', 'f']
+    assert sorted (entered) == ['.', 'd']
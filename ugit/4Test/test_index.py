@@ -0,0 +1,144 @@
+# File: test_index.py
+
+# Binary Index with stat data, and its lock
+
+import json
+import os
+
+from pathlib import Path
+
+import pytest
+
+from ugit import base
+from ugit import data
+
+from conftest import commit, write
+
+
+def lock_path ():
+    return data.GIT_DIR / 'index.lock'
+
+
+def test_index_round_trip (repo):
+    commit ({'a': 'a\n', 'd/b': 'b\n'})
+    with data.get_index () as index:
+        index.set_skip_worktree ('a', True)
+
+    with data.get_index (read_only=True) as index:
+        assert set (index) == {'a', 'd/b'}
+        assert index['d/b'] == data.hash_object (b'b\n')
+        assert index.skip == {'a'}
+        assert '' in index.trees
+
+
+def test_unchanged_files_are_not_hashed (repo, monkeypatch):
+    commit ({'a': 'a\n'})
+    # Let the entry's mtime precede the Index, so it is not racily clean
+    os.utime ('a', ns=(0, 0))
+    base.get_working_tree ()
+
+    hashed = []
+    hash_files = base.hash_files
+
+    def record (dirty, jobs=None):
+        hashed.extend (path for path, _ in dirty)
+        return hash_files (dirty, jobs)
+
+    monkeypatch.setattr (base, 'hash_files', record)
+    write ('b', 'b\n')
+    tree = base.get_working_tree ()
+    assert set (tree) == {'a', 'b'}
+    assert hashed == ['b']
+
+
+def test_lock_is_removed_if_writing_fails (repo, monkeypatch):
+    def fail (f, index):
+        raise OSError ('disk full')
+
+    monkeypatch.setattr (data, '_write_index', fail)
+    with pytest.raises (OSError, match='disk full'):
+        with data.get_index () as index:
+            index['f'] = data.hash_object (b'f\n')
+    assert not lock_path ().exists ()
+
+
+def test_lock_is_removed_on_errors (repo):
+    with pytest.raises (KeyError):
+        with data.get_index () as index:
+            index['missing']
+    assert not lock_path ().exists ()
+
+    with data.get_index () as index:
+        index['f'] = data.hash_object (b'f\n')
+    assert not lock_path ().exists ()
+    with data.get_index (read_only=True) as index:
+        assert 'f' in index
+
+
+def test_read_only_access_while_locked (repo):
+    commit ({'a': 'a\n'})
+    write ('a', 'changed\n')
+    with data.get_index ():
+        with pytest.raises (FileExistsError, match='another ugit process'):
+            with data.get_index ():
+                pass
+        # Another process running status meanwhile
+        tree = base.get_working_tree (untracked=False, try_lock=True)
+        assert tree['a'] == data.hash_object (b'changed\n')
+        assert base.get_untracked_files () == []
+    assert not lock_path ().exists ()
+    assert Path ('a').read_text () == 'changed\n'
+
+
+def test_status_records_stat_data (repo, monkeypatch):
+    commit ({'a': 'a\n'})
+    # Touched, so the file is hashed again but its entry is unchanged
+    os.utime ('a', ns=(0, 0))
+    base.get_working_tree (untracked=False, try_lock=True)
+    assert not lock_path ().exists ()
+
+    def no_hashing (dirty, jobs=None):
+        assert not dirty, 'Files hashed again'
+        return []
+
+    monkeypatch.setattr (base, 'hash_files', no_hashing)
+    assert base.get_working_tree (untracked=False, try_lock=True) == {
+        'a': data.hash_object (b'a\n')}
+
+
+def test_racily_clean_file_is_hashed_again (repo):
+    commit ({'a': 'one\n'})
+    index_mtime = os.stat (data.GIT_DIR / 'index').st_mtime_ns
+    # Changed within the timestamp tick of the Index, keeping its size
+    write ('a', 'two\n')
+    os.utime ('a', ns=(index_mtime, index_mtime))
+    with data.get_index (read_only=True) as index:
+        assert not index.is_clean ('a', data.stat_data ('a'))
+    assert base.get_working_tree ()['a'] == data.hash_object (b'two\n')
+
+
+def test_add_records_stat_data (repo):
+    write ('a', 'a\n')
+    os.utime ('a', ns=(0, 0))
+    base.add ([Path ('a')])
+    with data.get_index (read_only=True) as index:
+        assert index.stats['a'] == data.stat_data ('a')
+        assert index.is_clean ('a', data.stat_data ('a'))
+
+    write ('a', 'changed\n')
+    with data.get_index (read_only=True) as index:
+        assert not index.is_clean ('a', data.stat_data ('a'))
+
+
+def test_json_index_is_read_and_converted (repo):
+    oid = data.hash_object (b'a\n')
+    (data.GIT_DIR / 'index').write_text (json.dumps ({'a': oid, 'b': oid}))
+    with data.get_index (read_only=True) as index:
+        assert dict (index.items ()) == {'a': oid, 'b': oid}
+        assert not index.stats and not index.trees
+
+    with data.get_index () as index:
+        index['c'] = oid
+    assert (data.GIT_DIR / 'index').read_bytes ()[:4] == data.INDEX_SIGNATURE
+    with data.get_index (read_only=True) as index:
+        assert set (index) == {'a', 'b', 'c'}
@@ -0,0 +1,62 @@
+# File: test_merge.py
+
+# Three-way merge of trees and blobs
+
+from ugit import data
+from ugit import diff
+
+
+def blob (content):
+    return data.hash_object (content.encode ())
+
+
+def test_trivial_paths_are_resolved_by_oid (repo, monkeypatch):
+    def no_merge (*args):
+        raise AssertionError ('Blobs merged')
+
+    monkeypatch.setattr (diff, 'merge_blobs', no_merge)
+    t_base = {'same': blob ('1'), 'ours': blob ('1'), 'theirs': blob ('1'),
+              'both': blob ('1'), 'deleted': blob ('1')}
+    t_HEAD = {'same': blob ('1'), 'ours': blob ('2'), 'theirs': blob ('1'),
+              'both': blob ('3'), 'added': blob ('4')}
+    t_other = {'same': blob ('1'), 'ours': blob ('1'), 'theirs': blob ('2'),
+               'both': blob ('3'), 'deleted': blob ('1')}
+
+    tree, conflicts = diff.merge_trees (t_base, t_HEAD, t_other)
+    assert tree == {'same': blob ('1'), 'ours': blob ('2'), 'theirs': blob ('2'),
+                    'both': blob ('3'), 'added': blob ('4')}
+    assert conflicts == []
+
+
+def test_changes_to_different_lines_merge_cleanly (repo):
+    base = 'a\nb\nc\nd\ne\n'
+    merged, clean = diff.merge_blobs (blob (base),
+                                      blob (base.replace ('b', 'B')),
+                                      blob (base.replace ('d', 'D')))
+    assert clean
+    assert merged == b'a\nB\nc\nD\ne\n'
+
+
+def test_conflicting_changes_are_marked (repo):
+    tree, conflicts = diff.merge_trees ({'f': blob ('a\nb\nc\n')},
+                                        {'f': blob ('a\nours\nc\n')},
+                                        {'f': blob ('a\ntheirs\nc\n')})
+    assert conflicts == [diff.Conflict ('f', 'content')]
+    assert data.get_object (tree['f']) == (
+        b'a\n'
+        b'<<<<<<< HEAD\nours\n'
+        b'||||||| BASE\nb\n'
+        b'=======\ntheirs\n'
+        b'>>>>>>> MERGE_HEAD\n'
+        b'c\n')
+
+
+def test_modify_delete_and_add_add (repo):
+    tree, conflicts = diff.merge_trees (
+        {'modified': blob ('1\n')},
+        {'modified': blob ('2\n'), 'added': blob ('ours\n')},
+        {'added': blob ('theirs\n')})
+    assert sorted (conflicts) == [diff.Conflict ('added', 'add/add'),
+                                  diff.Conflict ('modified', 'modify/delete')]
+    assert tree['modified'] == blob ('2\n')
+    assert b'<<<<<<< HEAD\nours\n' in data.get_object (tree['added'])
@@ -0,0 +1,72 @@
+# File: test_merge_base.py
+
+# Merge bases and ancestry, with and without the commit-graph
+
+import pytest
+
+from ugit import base
+from ugit import data
+
+
+@pytest.fixture (params=[False, True], ids=['objects', 'commit-graph'])
+def graph (request, repo):
+    """ Commits built by make_commit, which go into the commit-graph
+    if the parameter is set
+    """
+    return request.param
+
+
+def make_commit (graph, *parents, message='commit'):
+    tree = data.hash_object (b'', 'tree')
+    commit = f'tree {tree}\n'
+    commit += ''.join (f'parent {parent}\n' for parent in parents)
+    oid = data.hash_object (f'{commit}\n{message}\n'.encode (), 'commit')
+    if graph:
+        base.update_commit_graph ([oid])
+    return oid
+
+
+def test_linear_history (graph):
+    a = make_commit (graph, message='a')
+    b = make_commit (graph, a, message='b')
+    c = make_commit (graph, b, message='c')
+    assert base.get_merge_base (b, c) == b
+    assert base.get_merge_base (c, a) == a
+    assert base.get_merge_base (c, c) == c
+    assert base.is_ancestor_of (c, a)
+    assert not base.is_ancestor_of (a, c)
+
+
+def test_forked_history (graph):
+    root = make_commit (graph, message='root')
+    fork = make_commit (graph, root, message='fork')
+    left = make_commit (graph, make_commit (graph, fork, message='l1'), message='l2')
+    right = make_commit (graph, fork, message='r1')
+    assert base.get_merge_bases (left, right) == [fork]
+    assert not base.is_ancestor_of (left, right)
+
+
+def test_criss_cross_merge (graph):
+    root = make_commit (graph, message='root')
+    left = make_commit (graph, root, message='left')
+    right = make_commit (graph, root, message='right')
+    merge1 = make_commit (graph, left, right, message='merge1')
+    merge2 = make_commit (graph, right, left, message='merge2')
+    assert set (base.get_merge_bases (merge1, merge2)) == {left, right}
+    assert base.get_merge_base (merge1, merge2) in (left, right)
+
+
+def test_unrelated_histories (graph):
+    a = make_commit (graph, message='a')
+    b = make_commit (graph, message='b')
+    assert base.get_merge_bases (a, b) == []
+    assert base.get_merge_base (a, b) is None
+    assert not base.is_ancestor_of (a, b)
+
+
+def test_generations (graph):
+    root = make_commit (graph, message='root')
+    short = make_commit (graph, root, message='short')
+    long = make_commit (graph, make_commit (graph, root, message='x'), message='y')
+    merge = make_commit (graph, short, long, message='merge')
+    assert [base.get_generation (oid) for oid in (root, short, long, merge)] == [1, 2, 3, 4]
@@ -0,0 +1,52 @@
+# File: test_negotiation.py
+
+# Finding common commits, and the objects the other side is missing
+
+from ugit import base
+from ugit import data
+
+from conftest import commit
+
+
+def make_history (count):
+    return [commit ({'f': f'{i}\n', f'new/{i}': f'{i}\n'}) for i in range (count)]
+
+
+def test_walk_stops_at_common_commits (repo):
+    history = make_history (100)
+    server = set (history[:60])
+    asked = []
+
+    def has_commits (batch):
+        asked.extend (batch)
+        return server.intersection (batch)
+
+    common = base.find_common_commits ([history[-1]], has_commits)
+    assert history[59] in common
+    assert common <= server
+    # Ancestors of a common commit are not asked for
+    assert len (asked) < len (history) - 50
+    assert history[0] not in asked
+
+
+def test_unrelated_history_gives_up (repo, monkeypatch):
+    monkeypatch.setattr (base, 'MAX_IN_VAIN', 10)
+    history = make_history (30)
+    asked = []
+
+    def has_commits (batch):
+        asked.extend (batch)
+        return set ()
+
+    assert base.find_common_commits ([history[-1]], has_commits) == set ()
+    assert len (asked) == 10
+
+
+def test_new_objects (repo):
+    old, new = make_history (2)
+    tree = base.get_commit (new).tree
+    subtree = next (oid for _, oid, name in base._iter_tree_entries (tree)
+                    if name == 'new')
+    # The blob of new/0 is known from the old commit
+    assert set (base.iter_new_objects ([new], [old])) == {
+        new, tree, subtree, data.hash_object (b'1\n')}
@@ -0,0 +1,46 @@
+# File: test_objects.py
+
+# Loose objects, written at once or streamed
+
+import hashlib
+import io
+import os
+import stat
+import zlib
+
+from ugit import data
+from ugit import pack
+
+
+def mode (oid):
+    return stat.S_IMODE (os.stat (data._loose_path (oid)).st_mode)
+
+
+def test_streamed_object_matches_written_one (repo):
+    content = os.urandom (3 * pack.CHUNK_SIZE + 1)
+    oid = data.hash_object_stream (io.BytesIO (content))
+    assert oid == data.hash_object (content)
+    assert data.get_object (oid) == content
+    assert b''.join (data.open_object (oid)) == content
+    assert not list ((data.GIT_DIR / 'objects').glob ('tmp-*'))
+
+
+def test_streamed_object_mode (repo):
+    written = data.hash_object (b'written\n')
+    streamed = data.hash_object_stream (io.BytesIO (b'streamed\n'))
+    assert mode (streamed) == mode (written) == data.FILE_MODE
+
+
+def test_loose_objects_are_compressed_in_fan_out_directories (repo):
+    oid = data.hash_object (b'content\n')
+    fp = data.GIT_DIR / 'objects' / oid[:2] / oid[2:]
+    assert zlib.decompress (fp.read_bytes ()) == b'blob\x00content\n'
+    assert dict (data._iter_loose_paths ()) == {oid: fp}
+
+
+def test_legacy_objects_are_read (repo):
+    content = b'legacy\n'
+    oid = hashlib.sha1 (b'blob\x00' + content).hexdigest ()
+    (data.GIT_DIR / 'objects' / oid).write_bytes (b'blob\x00' + content)
+    assert data.object_exists (oid)
+    assert data.get_object (oid) == content
@@ -0,0 +1,201 @@
+# File: test_pack.py
+
+# Pack files with their index and deltas
+
+import hashlib
+import os
+import zlib
+
+import pytest
+
+from ugit import base
+from ugit import data
+from ugit import delta
+from ugit import pack
+
+from conftest import commit
+
+
+def make_objects (*contents):
+    """ Return {oid: ('blob', content)} """
+    return {hashlib.sha1 (b'blob\x00' + content).hexdigest (): ('blob', content)
+            for content in contents}
+
+
+def write (tmp_path, objects, **kwargs):
+    reads = []
+
+    def read_object (oid):
+        reads.append (oid)
+        return objects[oid]
+
+    def read_header (oid):
+        type_, content = objects[oid]
+        return type_, len (content)
+
+    p = pack.Pack (pack.write_pack (tmp_path, objects, read_object,
+                                    read_header=read_header, **kwargs))
+    return p, reads
+
+
+def test_pack_round_trip (tmp_path):
+    base = os.urandom (4096)
+    objects = make_objects (base, base + b'more', b'x' * 10, base[:2000])
+    p, reads = write (tmp_path, objects)
+
+    assert sorted (reads) == sorted (objects)
+    assert sorted (p) == sorted (objects)
+    for oid, obj in objects.items ():
+        assert p.read (oid) == obj
+    assert os.path.getsize (p.path) < 2 * len (base)
+
+
+def test_similar_objects_are_deltas (tmp_path):
+    base = os.urandom (4096)
+    objects = make_objects (base, base + b'more')
+    p, _ = write (tmp_path, objects)
+    codes = [p._map[p.idx.offset (oid)] for oid in objects]
+    assert codes.count (pack.OFS_DELTA) == 1
+    for oid, (type_, content) in objects.items ():
+        assert p.read_header (oid) == (type_, len (content))
+
+
+def test_big_objects_are_stored_whole (tmp_path):
+    big = os.urandom (pack.BIG_FILE_THRESHOLD + 1)
+    objects = make_objects (big, big + b'more', big[:-1])
+    p, _ = write (tmp_path, objects)
+    for oid, obj in objects.items ():
+        assert p._map[p.idx.offset (oid)] == pack.TYPE_CODES['blob']
+        assert p.read (oid) == obj
+
+
+def test_big_objects_are_streamed (tmp_path):
+    big = os.urandom (pack.BIG_FILE_THRESHOLD + 1)
+    objects = make_objects (big, b'small' * 100)
+    opened = []
+
+    def open_object (oid):
+        opened.append (oid)
+        type_, content = objects[oid]
+        return type_, (content[i:i + pack.CHUNK_SIZE]
+                       for i in range (0, len (content), pack.CHUNK_SIZE))
+
+    p, reads = write (tmp_path, objects, open_object=open_object)
+    big_oid, = (oid for oid in objects if objects[oid][1] == big)
+    assert opened == [big_oid]
+    assert big_oid not in reads
+    assert p.read (big_oid) == objects[big_oid]
+    assert p.read_header (big_oid) == ('blob', len (big))
+
+    # Indexed again without being rebuilt as a whole
+    tmp = tmp_path / 'incoming.pack'
+    tmp.write_bytes (p.path.read_bytes ())
+    indexed = pack.Pack (pack.index_pack (tmp))
+    assert sorted (indexed) == sorted (objects)
+    assert indexed.read (big_oid) == objects[big_oid]
+
+
+def test_index_pack (tmp_path):
+    base = os.urandom (4096)
+    objects = make_objects (base, base + b'more')
+    tmp = tmp_path / 'incoming.pack'
+    with open (tmp, 'wb') as f:
+        pack.write_pack_stream (f, list (objects), objects.__getitem__)
+
+    p = pack.Pack (pack.index_pack (tmp))
+    assert sorted (p) == sorted (objects)
+    for oid, obj in objects.items ():
+        assert p.read (oid) == obj
+
+
+def test_stored_deltas_are_reused (tmp_path, monkeypatch):
+    base = os.urandom (4096)
+    objects = make_objects (base, base + b'more', base + b'even more')
+    p, _ = write (tmp_path / 'first', objects)
+    assert sum (1 for oid in objects if p.read_delta (oid)) == 2
+
+    def no_search (*args):
+        raise AssertionError ('Delta searched again')
+
+    # The whole object has no candidate before it, the others are reused
+    monkeypatch.setattr (pack.delta, 'create_delta', no_search)
+    tmp = tmp_path / 'sent.pack'
+    with open (tmp, 'wb') as f:
+        pack.write_pack_stream (f, list (objects), objects.__getitem__,
+                                read_delta=p.read_delta)
+
+    sent = pack.Pack (pack.index_pack (tmp))
+    for oid, obj in objects.items ():
+        assert sent.read (oid) == obj
+        assert sent.read_delta (oid) == p.read_delta (oid)
+
+
+def test_reused_delta_without_its_base_is_searched (tmp_path):
+    base = os.urandom (4096)
+    objects = make_objects (base, base + b'more')
+    p, _ = write (tmp_path / 'first', objects)
+    oid = next (oid for oid in objects if p.read_delta (oid))
+
+    tmp = tmp_path / 'sent.pack'
+    with open (tmp, 'wb') as f:
+        pack.write_pack_stream (f, [oid], objects.__getitem__,
+                                read_delta=p.read_delta)
+    sent = pack.Pack (pack.index_pack (tmp))
+    assert sent.read (oid) == objects[oid]
+    assert not sent.read_delta (oid)
+
+
+def test_repack_moves_loose_objects (repo):
+    head = commit ({'f': 'content\n'}, 'first')
+    loose = dict (data._iter_loose_paths ())
+    assert head in loose
+
+    p = data.repack ()
+    assert sorted (p) == sorted (loose)
+    assert not dict (data._iter_loose_paths ())
+    data.object_cache.clear ()
+    data.parsed_cache.clear ()
+    assert base.get_commit (head).message == 'first'
+    assert data.get_object (data.hash_object (b'content\n')) == b'content\n'
+    assert not data.object_exists ('0' * 40)
+    assert p.idx.offset ('0' * 40) is None
+
+
+def write_raw_pack (path, entries):
+    """ Write a pack of the given raw entries, with a valid checksum """
+    body = pack.Pack.HEADER.pack (pack.PACK_SIGNATURE, pack.VERSION, len (entries))
+    body += b''.join (entries)
+    path.write_bytes (body + hashlib.sha1 (body).digest ())
+    return path
+
+
+@pytest.mark.parametrize ('distance', [0, 1, 10_000])
+def test_bad_delta_distance_is_refused (tmp_path, distance):
+    content = b'x' * 100
+    whole = (bytes ([pack.TYPE_CODES['blob']]) + pack.encode_varint (len (content))
+             + zlib.compress (content))
+    patch = delta.create_delta (content, content + b'y')
+    entry = (bytes ([pack.OFS_DELTA]) + pack.encode_varint (len (content) + 1)
+             + pack.encode_varint (distance) + zlib.compress (patch))
+    path = write_raw_pack (tmp_path / 'incoming.pack', [whole, entry])
+
+    with pytest.raises (ValueError, match='Delta base|delta base'):
+        pack.index_pack (path)
+    assert not list (tmp_path.glob ('*.idx'))
+
+
+def test_repack_streams_big_objects (repo, monkeypatch):
+    big = os.urandom (pack.BIG_FILE_THRESHOLD + 1)
+    big_oid = data.hash_object (big)
+    small_oid = data.hash_object (b'small\n')
+    data.object_cache.clear ()
+    read_object = data._read_object
+
+    def small_only (oid):
+        assert oid != big_oid, 'Big object read whole'
+        return read_object (oid)
+
+    monkeypatch.setattr (data, '_read_object', small_only)
+    p = data.repack ()
+    assert sorted (p) == sorted ([big_oid, small_oid])
+    assert p.read (big_oid) == ('blob', big)
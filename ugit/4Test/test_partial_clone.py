@@ -0,0 +1,70 @@
+# File: test_partial_clone.py
+
+# Clones without blobs, which fetch them from the promisor remote later
+
+from pathlib import Path
+
+from ugit import base
+from ugit import data
+from ugit import remote
+
+from conftest import commit, enter
+
+
+def count_fetches (monkeypatch):
+    """ Record the OIDs of each lazy fetch in a list, which is returned """
+    fetches = []
+
+    def fetch_objects (remote_path, oids):
+        fetches.append (oids)
+        remote.fetch_objects (remote_path, oids)
+
+    monkeypatch.setattr (data, '_lazy_fetch', fetch_objects)
+    return fetches
+
+
+def test_clone_without_blobs (repo, monkeypatch):
+    commit ({'f': 'old\n'})
+    commit ({'f': 'new\n', 'g': 'new\n', 'd/h': 'new\n'})
+    old = data.hash_object (b'old\n')
+
+    enter (monkeypatch, repo.parent / 'clone')
+    fetches = count_fetches (monkeypatch)
+    remote.clone (str (repo), blobs=False)
+    assert data.get_promisor () == str (repo)
+    # The blobs of the checkout are fetched in one transfer
+    assert fetches == [[data.hash_object (b'new\n')]]
+    assert Path ('d/h').read_text () == 'new\n'
+    assert not data.object_exists (old)
+
+    assert data.get_object (old) == b'old\n'
+    assert fetches[-1] == [old]
+    assert data.object_exists (old)
+
+
+def test_checkout_fetches_missing_blobs_at_once (repo, monkeypatch):
+    first = commit ({'f': '1\n'})
+    commit ({'f': '2\n', 'g': '3\n', 'd/h': '4\n'})
+
+    enter (monkeypatch, repo.parent / 'clone')
+    remote.clone (str (repo), blobs=False)
+    fetches = count_fetches (monkeypatch)
+    base.checkout (first)
+    assert fetches == [[data.hash_object (b'1\n')]]
+    assert Path ('f').read_text () == '1\n'
+    assert not Path ('g').exists ()
+
+
+def test_fetch_from_promisor_leaves_out_blobs (repo, monkeypatch):
+    commit ({'f': '1\n'})
+
+    enter (monkeypatch, repo.parent / 'clone')
+    remote.clone (str (repo), blobs=False)
+    enter (monkeypatch, repo)
+    new = commit ({'f': '2\n'})
+    blob = data.hash_object (b'2\n')
+
+    enter (monkeypatch, repo.parent / 'clone')
+    remote.fetch (str (repo))
+    assert data.object_exists (new)
+    assert not data.object_exists (blob)
@@ -0,0 +1,65 @@
+# File: test_refs.py
+
+# Loose and packed references
+
+from ugit import base
+from ugit import data
+
+from conftest import commit
+
+
+def test_packed_refs_are_found (repo):
+    first = commit ({'f': '1\n'})
+    base.create_branch ('topic', first)
+    second = commit ({'f': '2\n'})
+
+    assert data.pack_refs () == 2
+    assert not (data.GIT_DIR / 'refs' / 'heads' / 'master').exists ()
+    assert data.get_ref ('refs/heads/topic').value == first
+    assert data.get_ref ('HEAD').value == second
+    assert dict (data.iter_refs ('refs/heads/'))['refs/heads/master'].value == second
+
+
+def test_loose_ref_takes_precedence (repo):
+    first = commit ({'f': '1\n'})
+    data.pack_refs ()
+    second = commit ({'f': '2\n'})
+    assert data.get_packed_refs ().get ('refs/heads/master') == first
+    assert data.get_ref ('refs/heads/master').value == second
+
+
+def test_delete_packed_ref (repo):
+    oid = commit ({'f': '1\n'})
+    base.create_branch ('topic', oid)
+    data.pack_refs ()
+    data.delete_ref ('refs/heads/topic')
+    assert not data.get_ref ('refs/heads/topic').value
+    assert data.get_ref ('refs/heads/master').value == oid
+
+
+def test_init_after_pack_refs (repo):
+    first = commit ({'f': '1\n'})
+    data.pack_refs ()
+    data.clear_ref_cache ()
+
+    base.init ()
+    head = data.get_ref ('HEAD', deref=False)
+    assert head.symbolic and head.value == 'refs/heads/master'
+    assert data.get_ref ('refs/heads/master').value == first
+
+    second = commit ({'f': '2\n'})
+    assert base.get_commit (second).parents == (first,)
+    assert data.get_ref ('refs/heads/master').value == second
+
+
+def test_resolved_refs_follow_updates (repo):
+    first = commit ({'f': '1\n'})
+    assert data.get_ref ('HEAD').value == first
+    second = commit ({'f': '2\n'})
+    # Resolving HEAD again goes through the updated branch
+    assert data.get_ref ('HEAD').value == second
+
+    base.create_branch ('topic', first)
+    assert data.get_ref ('refs/heads/topic').value == first
+    data.delete_ref ('refs/heads/topic')
+    assert not data.get_ref ('refs/heads/topic').value
@@ -0,0 +1,83 @@
+# File: test_remote.py
+
+# Fetching from and pushing to local remotes
+
+import os
+import stat
+
+from pathlib import Path
+
+from ugit import base
+from ugit import data
+from ugit import remote
+
+from conftest import commit, enter
+
+
+def make_history (count, name='f'):
+    """ Commit count versions of a file which differ a little each """
+    lines = [f'line {i}\n' for i in range (200)]
+    oid = None
+    for i in range (count):
+        lines[i % len (lines)] = f'changed {i}\n'
+        oid = commit ({name: ''.join (lines)}, f'version {i}')
+    return oid
+
+
+def count_deltas ():
+    return sum (1 for p in data.get_packs () for oid in p if p.read_delta (oid))
+
+
+def test_fetch_pack (repo, monkeypatch):
+    head = make_history (40)
+    data.repack ()
+    assert count_deltas ()
+
+    enter (monkeypatch, repo.parent / 'clone')
+    remote.clone (str (repo))
+    assert data.get_ref ('refs/heads/master').value == head
+    assert len (data.get_packs ()) == 1
+    assert count_deltas ()
+    assert Path ('f').read_text ().startswith ('changed 0\nchanged 1\n')
+
+
+def test_received_pack_mode (repo, monkeypatch):
+    make_history (remote.UNPACK_LIMIT)
+    monkeypatch.setattr (data, 'FILE_MODE', 0o640)
+
+    enter (monkeypatch, repo.parent / 'clone')
+    remote.clone (str (repo))
+    p, = data.get_packs ()
+    for fp in (p.path, p.idx.path):
+        assert stat.S_IMODE (os.stat (fp).st_mode) == 0o640
+
+
+def test_push_pack (repo, monkeypatch):
+    make_history (1)
+
+    enter (monkeypatch, repo.parent / 'clone')
+    remote.clone (str (repo))
+    head = make_history (40, 'g')
+    remote.push (str (repo), 'refs/heads/master')
+
+    enter (monkeypatch, repo)
+    assert data.get_ref ('refs/heads/master').value == head
+    assert len (data.get_packs ()) == 1
+    assert base.get_commit (head).message == 'version 39'
+
+
+def test_fetch_updates_remote_refs (repo, monkeypatch):
+    make_history (3)
+
+    enter (monkeypatch, repo.parent / 'clone')
+    remote.clone (str (repo))
+    before = set (dict (data._iter_loose_paths ()))
+
+    enter (monkeypatch, repo)
+    head = make_history (2, 'g')
+    enter (monkeypatch, repo.parent / 'clone')
+    remote.fetch (str (repo))
+    assert data.get_ref ('refs/remote/master').value == head
+    # Only the two new commits and their trees were copied, the blobs
+    # of g are versions of f the clone already has
+    assert len (set (dict (data._iter_loose_paths ())) - before) == 4
@@ -0,0 +1,56 @@
+# File: test_shallow.py
+
+# Fetching part of the history, and deepening it later
+
+from ugit import base
+from ugit import data
+from ugit import remote
+
+from conftest import commit, enter
+
+
+def make_history (count):
+    return [commit ({'f': f'{i}\n'}, f'version {i}') for i in range (count)]
+
+
+def test_shallow_clone (repo, monkeypatch):
+    history = make_history (10)
+
+    enter (monkeypatch, repo.parent / 'clone')
+    remote.clone (str (repo), depth=3)
+    assert data.get_shallow () == {history[-3]}
+    assert (data.GIT_DIR / 'shallow').read_text ().split () == [history[-3]]
+    assert not data.object_exists (history[-4])
+    # The boundary is a root of the history
+    assert list (base.iter_commits_and_parents ([history[-1]])) == history[:-4:-1]
+    assert base.get_merge_base (history[-1], history[-3]) == history[-3]
+
+
+def test_deepen (repo, monkeypatch):
+    history = make_history (10)
+
+    enter (monkeypatch, repo.parent / 'clone')
+    remote.clone (str (repo), depth=2)
+    remote.fetch (str (repo), depth=5)
+    assert data.get_shallow () == {history[-5]}
+    assert len (list (base.iter_commits_and_parents ([history[-1]]))) == 5
+
+    remote.fetch (str (repo), unshallow=True)
+    assert not data.get_shallow ()
+    assert not (data.GIT_DIR / 'shallow').exists ()
+    assert list (base.iter_commits_and_parents ([history[-1]])) == history[::-1]
+
+
+def test_fetch_into_shallow_repository (repo, monkeypatch):
+    history = make_history (5)
+
+    enter (monkeypatch, repo.parent / 'clone')
+    remote.clone (str (repo), depth=1)
+    enter (monkeypatch, repo)
+    new = commit ({'f': 'new\n'})
+
+    enter (monkeypatch, repo.parent / 'clone')
+    remote.fetch (str (repo))
+    assert data.get_ref ('refs/remote/master').value == new
+    assert data.get_shallow () == {history[-1]}
+    assert base.get_commit (new).parents == (history[-1],)
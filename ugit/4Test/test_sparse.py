@@ -0,0 +1,61 @@
+# File: test_sparse.py
+
+# Sparse checkouts, which leave files outside of some directories out
+
+from pathlib import Path
+
+from ugit import base
+from ugit import data
+
+from conftest import commit, write
+
+
+FILES = {'top': 'top\n', 'a/x': 'x\n', 'a/b/y': 'y\n', 'c/z': 'z\n'}
+
+
+def test_set_sparse_checkout (repo):
+    oid = commit (FILES)
+    base.set_sparse_checkout (['a/b/'])
+    assert data.get_sparse_checkout () == ['a/b']
+    # Files directly in a parent of a directory stay
+    assert Path ('top').is_file () and Path ('a/x').is_file ()
+    assert Path ('a/b/y').is_file ()
+    assert not Path ('c/z').exists ()
+    with data.get_index (read_only=True) as index:
+        assert index.skip == {'c/z'}
+        assert index['c/z'] == data.hash_object (b'z\n')
+
+    # Files outside count as unchanged
+    assert base.get_working_tree () == base.get_tree (base.get_commit (oid).tree)
+    assert base.get_untracked_files () == []
+
+    base.set_sparse_checkout (None)
+    assert data.get_sparse_checkout () is None
+    assert Path ('c/z').read_text () == 'z\n'
+    with data.get_index (read_only=True) as index:
+        assert not index.skip
+
+
+def test_commit_keeps_files_outside (repo):
+    commit (FILES)
+    base.set_sparse_checkout (['a'])
+    write ('a/x', 'changed\n')
+    base.add ([Path ('a/x')])
+    oid = base.commit ('changed')
+    tree = base.get_tree (base.get_commit (oid).tree)
+    assert tree['c/z'] == data.hash_object (b'z\n')
+    assert tree['a/x'] == data.hash_object (b'changed\n')
+
+
+def test_checkout_leaves_files_outside (repo):
+    first = commit (FILES)
+    second = commit ({**FILES, 'c/z': 'changed\n', 'a/x': 'changed\n'})
+    base.set_sparse_checkout (['a'])
+    base.checkout (first)
+    assert Path ('a/x').read_text () == 'x\n'
+    assert not Path ('c/z').exists ()
+
+    base.set_sparse_checkout (None)
+    assert Path ('c/z').read_text () == 'z\n'
+    base.checkout (second)
+    assert Path ('c/z').read_text () == 'changed\n'
@@ -0,0 +1,53 @@
+# File: test_tree_diff.py
+
+# Recursive comparison of stored trees
+
+from pathlib import Path
+
+from ugit import base
+from ugit import data
+from ugit import diff
+
+from conftest import commit
+
+
+def commit_tree (files):
+    return base.get_commit (commit (files)).tree
+
+
+def test_identical_subtrees_are_not_read (repo, monkeypatch):
+    t_from = commit_tree ({'same/a': '1\n', 'same/deep/b': '2\n', 'changed/c': '3\n'})
+    t_to = commit_tree ({'changed/c': '4\n'})
+    same = dict ((name, oid) for _, oid, name in base._iter_tree_entries (t_from))['same']
+
+    read = []
+    iter_tree_entries = base._iter_tree_entries
+
+    def record (oid):
+        read.append (oid)
+        return iter_tree_entries (oid)
+
+    monkeypatch.setattr (base, '_iter_tree_entries', record)
+    changes = list (diff.iter_tree_changes (t_from, t_to))
+    assert changes == [('changed/c', data.hash_object (b'3\n'), data.hash_object (b'4\n'))]
+    assert same not in read
+    assert list (diff.iter_tree_changes (t_to, t_to)) == []
+
+
+def test_changes_match_flat_comparison (repo):
+    t_from = commit_tree ({'a': '1\n', 'd/b': '2\n', 'd/e/c': '3\n', 'x': '4\n'})
+    Path ('x').unlink ()
+    with data.get_index () as index:
+        del index['x']
+    t_to = commit_tree ({'a': '5\n', 'd/e/c': '6\n', 'x/y': '7\n', 'new': '8\n'})
+
+    flat = sorted ((path, o_from, o_to) for path, o_from, o_to in diff.compare_trees (
+        base.get_tree (t_from), base.get_tree (t_to)) if o_from != o_to)
+    assert sorted (diff.iter_tree_changes (t_from, t_to)) == flat
+    assert ('x', data.hash_object (b'4\n'), None) in flat
+
+
+def test_pathspec (repo):
+    t_from = commit_tree ({'a/b': '1\n', 'c/d': '2\n'})
+    t_to = commit_tree ({'a/b': '3\n', 'c/d': '4\n'})
+    assert [path for path, _ in diff.iter_changed_files (t_from, t_to, ['c'])] == ['c/d']
@@ -1,31 +1,44 @@
 # File: base.py
 # Date: 2020-11-30
 
+import heapq
 import itertools
 import operator
+import os
 import string
 
 from pathlib import Path
 from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 
 from ugit import data
 from ugit import diff
+from ugit import ignore
+from ugit import pack
 
 
 def init ():
     data.init ()
     ref = 'refs/heads/master'
-    # treat init() as a singleton event, or we mess up the reference tree
-    if (data.GIT_DIR / ref).is_file():
-        return 
-    data.update_ref ('HEAD', data.RefValue (symbolic=True, value=ref))
+    # treat init() as a singleton event, or we mess up the reference tree;
+    # the ref may be packed, so look it up rather than its loose file
+    if (data.get_ref ('HEAD', deref=False).value
+            or data.get_ref (ref, deref=False).value):
+        return
+    data.update_ref ('HEAD', data.RefValue (symbolic=True, value=ref),
+                     deref=False)
 
 
 def write_tree ():
-    """ """
-    # Index is flat, we need it as a tree of dictionaries
-    index_as_tree = {}
+    """ Write the tree objects of the Index, reusing the cached tree OIDs
+    of directories whose entries did not change
+    """
     with data.get_index () as index:
+        if '' in index.trees:
+            return index.trees['']
+
+        # Index is flat, we need it as a tree of dictionaries
+        index_as_tree = {}
         for path, oid in index.items ():
             path = path.split ('/')
             dirpath, filename = path[:-1], path[-1]
@@ -36,36 +49,53 @@ def write_tree ():
                 current = current.setdefault (dirname, {})
             current[filename] = oid
             
-    def write_tree_recursive (tree_dict):
-        entries = []
-        for name, value in tree_dict.items ():
-            if type (value) is dict:
-                type_ = 'tree'
-                oid = write_tree_recursive (value)
-            else:
-                type_ = 'blob'
-                oid = value
-            entries.append ((name, oid, type_))
-            
-        tree = ''.join (f'{type_} {oid} {name}\n'
-                        for name, oid, type_
-                        in sorted (entries))
-        return data.hash_object (tree.encode (), 'tree')
-    
-    return write_tree_recursive (index_as_tree)
+        def write_tree_recursive (tree_dict, dirpath):
+            if dirpath in index.trees:
+                return index.trees[dirpath]
+
+            entries = []
+            for name, value in tree_dict.items ():
+                if type (value) is dict:
+                    type_ = 'tree'
+                    oid = write_tree_recursive (
+                        value, f'{dirpath}/{name}' if dirpath else name)
+                else:
+                    type_ = 'blob'
+                    oid = value
+                entries.append ((name, oid, type_))
+                
+            tree = ''.join (f'{type_} {oid} {name}\n'
+                            for name, oid, type_
+                            in sorted (entries))
+            oid = data.hash_object (tree.encode (), 'tree')
+            index.cache_tree (dirpath, oid)
+            return oid
+        
+        return write_tree_recursive (index_as_tree, '')
 
 
 def _iter_tree_entries (oid):
-    """Using a generator to fetch the tree file by OID
+    """Fetch the tree file by OID
     and for each line in the file we return: type_, oid, filepath
+    The parsed entries are cached by type and OID.
     """
     if not oid:
         return ''
-    return (entry.split (' ', 2) 
-            for entry in data.get_object (oid, 'tree').decode ().splitlines ())
+    entries = data.parsed_cache.get (('tree', oid))
+    if entries is None:
+        tree = data.get_object (oid, 'tree')
+        entries = tuple (tuple (entry.split (' ', 2))
+                         for entry in tree.decode ().splitlines ())
+        data.parsed_cache.put (('tree', oid), entries, len (tree))
+    return entries
 
 
-def get_tree (oid, base_path=''):
+def get_tree (oid, base_path='', dirs=None):
+    """ Return the tree as a flat dictionary of file paths and OIDs.
+    The tree OIDs of all directories are added to dirs, if given.
+    """
+    if dirs is not None and oid:
+        dirs[base_path.rstrip ('/')] = oid
     result = {}
     for type_, oid, name in _iter_tree_entries (oid):
         assert '/' not in name
@@ -74,60 +104,294 @@ def get_tree (oid, base_path=''):
         if type_ == 'blob':
             result[path] = oid
         elif type_ == 'tree':
-            result.update (get_tree (oid, f'{path}/'))
+            result.update (get_tree (oid, f'{path}/', dirs))
         else:
             assert False, f'Unknown tree entry {type_}'
     return result
 
 
-def scan_dir(file_path):
+# Hashing fewer files and bytes than this is done serially,
+# as starting a process pool would cost more than it saves
+PARALLEL_MIN_FILES = 1000
+PARALLEL_MIN_BYTES = 16 * 1024 * 1024
+
+
+def _record_hash (index, path, oid, stat, stage):
+    """ Update the Index with a freshly hashed work tree file """
+    if stage:
+        index[path] = oid
+    if index.get (path) == oid:
+        index.set_stat (path, stat)
+
+
+def hash_file (file_path, index, stage=False):
+    """ Return the OID of a work tree file. Files whose stat data still
+    matches their Index entry are not read and hashed again.
+    With stage=True the Index entry is updated to the file's OID.
+    """
+    path = str (file_path)
+    stat = data.stat_data (file_path)
+    if index.is_clean (path, stat):
+        return index[path]
+
+    oid = data.hash_file (file_path)
+    _record_hash (index, path, oid, stat, stage)
+    return oid
+
+
+def _hash_path (path, git_dir):
+    """ Worker process: hash a file into the object database at git_dir """
+    with data.change_git_dir (Path (git_dir).parent):
+        return data.hash_file (path)
+
+
+def hash_files (files, jobs=None):
+    """ Return the OIDs of a list of (file_path, stat) in the same order.
+    Large inputs are read, hashed and written by a pool of jobs 
+    worker processes (default: one per CPU).
+    """
+    jobs = jobs or os.cpu_count () or 1
+    paths = [str (fp) for fp, _ in files]
+    if (jobs == 1 or (len (files) < PARALLEL_MIN_FILES and
+                      sum (stat.size for _, stat in files) < PARALLEL_MIN_BYTES)):
+        return [data.hash_file (path) for path in paths]
+
+    chunksize = max (1, len (paths) // (jobs * 8))
+    with ProcessPoolExecutor (max_workers=jobs) as pool:
+        return list (pool.map (_hash_path, paths,
+                               itertools.repeat (str (data.GIT_DIR)),
+                               chunksize=chunksize))
+
+
+def _walk_work_tree (file_path):
+    """ Yield (path, os.DirEntry) of the files below file_path which are
+    neither ignored nor outside of a sparse checkout, without entering
+    directories which are
+    """
+    include = get_sparse_filter ()
+    if include is None:
+        yield from ignore.walk (file_path)
+        return
+    # Directories are entered if files directly in them may be within
+    for path, entry in ignore.walk (file_path,
+                                    include_dir=lambda path: include (path + '/')):
+        if include (path):
+            yield path, entry
+
+
+def scan_dir(file_path, index, stage=False, jobs=None, untracked=True):
     """ Scan directory tree for all valid files, and return
-    a dictionary with file_paths and OIDs  """
+    a dictionary with file_paths and OIDs. Ignored directories, and
+    those outside of a sparse checkout, are not entered. Files which
+    are not in the index are left out unless untracked.
+    """
     result = {}
-    for fp in (fp for fp in file_path.rglob('*') 
-               if not is_ignored(fp) and fp.is_file()):
-        result [str(fp)] = data.hash_object(fp.read_bytes())
+    dirty = []
+    for path, entry in sorted (_walk_work_tree (file_path)):
+        if not untracked and path not in index:
+            continue
+        stat = data.stat_data (entry)
+        if index.is_clean (path, stat):
+            result [path] = index[path]
+        else:
+            dirty.append ((path, stat))
+
+    # Results are applied in path order, whichever worker hashed them
+    for (path, stat), oid in zip (dirty, hash_files (dirty, jobs)):
+        result [path] = oid
+        _record_hash (index, path, oid, stat, stage)
     return result    
     
 
-def get_working_tree ():
+def get_working_tree (jobs=None, untracked=True, try_lock=False):
+    """ Return the files of the working directory by path and OID,
+    see scan_dir for untracked.
+    Entries flagged skip-worktree count as unchanged, without a file.
+    The stat data of files which had to be hashed again is recorded,
+    unless with try_lock another process holds the lock of the Index.
+    """
     file_path = Path('.')
-    return scan_dir(file_path)
+    with data.get_index (try_lock=try_lock) as index:
+        result = {path: index[path] for path in index.skip}
+        result.update (scan_dir(file_path, index, jobs=jobs, untracked=untracked))
+        return result
+
+
+def get_untracked_files ():
+    """ Return the sorted paths of the files which are neither
+    in the index nor ignored, without reading them
+    """
+    with data.get_index (read_only=True) as index:
+        return sorted (path for path, _ in _walk_work_tree ('.')
+                       if path not in index)
+
+
+def get_sparse_filter ():
+    """ Return a function testing if a path is within the sparse checkout,
+    or None if all paths are. Within are all paths below its directories,
+    and the files directly in one of their parents, the top level included.
+    """
+    directories = data.get_sparse_checkout ()
+    if directories is None:
+        return None
+    recursive = set (directories)
+    parents = {''}
+    for directory in directories:
+        while directory:
+            directory = directory.rpartition ('/')[0]
+            parents.add (directory)
+
+    def include (path):
+        directory = path.rpartition ('/')[0]
+        if directory in parents:
+            return True
+        while directory:
+            if directory in recursive:
+                return True
+            directory = directory.rpartition ('/')[0]
+        return False
+    return include
+
+
+def set_sparse_checkout (directories):
+    """ Check out only the files within directories (see get_sparse_filter),
+    or all files if None. Files leaving the sparse checkout are deleted,
+    those entering it are written.
+    """
+    directories = None if directories is None else sorted (
+        {directory.strip ('/') for directory in directories} - {'', '.'})
+    with data.get_index () as index:
+        old = data.get_sparse_checkout ()
+        data.set_sparse_checkout (directories)
+        try:
+            _checkout_index (index, dict (index.entries))
+        except BaseException:
+            data.set_sparse_checkout (old)
+            raise
     
 
 def get_index_tree ():
-    with data.get_index () as index:
+    with data.get_index (read_only=True) as index:
         return index
 
 
-def _empty_current_directory ():
-    """ Remove all files/directories of the current tree (unless is_ignored)"""
-    paths = []
-    
-    # First removing all files...
-    for path in (fp for fp in Path('.').rglob ('*')
-               if not is_ignored (fp)):
-        if path.is_file ():
-            path.unlink ()
-        else:
-            paths.append(path)
-            
-    # then removing all directories...
-    paths.sort (reverse=True)
-    for path in paths:
-        path.rmdir()
+def _get_tree_entries (tree_oid, paths):
+    """ Return the blob OIDs of the given paths within a stored tree,
+    reading only the trees along those paths. Paths which are directories,
+    or lie below a file, are absent (None).
+    """
+    trees = {}
 
+    def lookup (path):
+        type_, current = 'tree', tree_oid
+        for name in path.split ('/'):
+            if not current or type_ != 'tree':
+                return None
+            if current not in trees:
+                trees[current] = {entry_name: (entry_type, entry_oid)
+                                  for entry_type, entry_oid, entry_name
+                                  in _iter_tree_entries (current)}
+            type_, current = trees[current].get (name, (None, None))
+        return current if type_ == 'blob' else None
 
-def _checkout_index (index):
-    """For every entry in the index, the respected object is copied to the given
-    file path. Any missing directory structure is created during the process.
+    return {path: lookup (path) for path in paths}
+
+
+def _check_overwrites (index, changes):
+    """ Refuse to change paths with uncommitted modifications, either
+    staged in the index, or in the working directory
     """
-    _empty_current_directory ()
-    for path, oid in index.items ():
+    HEAD = data.get_ref ('HEAD').value
+    t_HEAD = _get_tree_entries (HEAD and get_commit_tree (HEAD),
+                                [path for path, _, _ in changes])
+    removed = {path for path, o_index, o_new in changes if o_index and not o_new}
+    modified = []
+    for path, o_index, o_new in changes:
+        fp = Path (path)
+        if o_index != t_HEAD[path]:
+            modified.append (path)
+        elif fp.is_dir ():
+            # A directory may only be replaced if all its files are tracked
+            # ones, which are removed (and checked themselves)
+            if any (os.path.join (root, name) not in removed
+                    for root, _, names in os.walk (fp) for name in names):
+                modified.append (path)
+        elif fp.is_file ():
+            # Tracked files must match the index, untracked ones the new version
+            if hash_file (fp, index) != (o_index or o_new):
+                modified.append (path)
+
+    assert not modified, ('Your local changes to the following files would be'
+                          ' overwritten:\n    ' + '\n    '.join (modified))
+
+
+def _checkout_index (index, tree, keep=()):
+    """Move the index and the working directory from the current index
+    entries to those of tree (a dictionary of file paths and OIDs). Only
+    files which differ are deleted or written, the others are not touched
+    and keep their modification times. Local modifications are not overwritten.
+    Entries outside of a sparse checkout, unless in keep, are flagged
+    skip-worktree, and their files are neither written nor looked at.
+    """
+    include = get_sparse_filter () or (lambda path: True)
+    # (path, OIDs, whether the file is checked out before and after)
+    changes = []
+    for path, o_index, o_tree in diff.compare_trees (index, tree):
+        before = bool (o_index) and path not in index.skip
+        after = bool (o_tree) and (path in keep or include (path))
+        if o_index != o_tree or before != after:
+            changes.append ((path, o_index, o_tree, before, after))
+    _check_overwrites (index, [(path, o_index, o_tree)
+                               for path, o_index, o_tree, before, after in changes
+                               if before or after])
+
+    # First removing files, and the directories they leave empty...
+    for path, _, o_tree, before, after in changes:
+        if not o_tree:
+            del index[path]
+        elif not after:
+            index[path] = o_tree
+            index.set_skip_worktree (path, True)
+        if not before or after:
+            continue
+        fp = Path (path)
+        if fp.is_file ():
+            fp.unlink ()
+        for parent in fp.parents[:-1]:
+            # The user may have deleted the directory already
+            if not parent.is_dir ():
+                continue
+            if any (parent.iterdir ()):
+                break
+            parent.rmdir ()
+
+    # then writing new and changed files, whose blobs a partial clone
+    # fetches at once
+    writes = [(path, o_tree) for path, _, o_tree, _, after in changes if after]
+    data.prefetch_objects (o_tree for _, o_tree in writes)
+    for path, o_tree in writes:
         fp = Path(path)
         if not fp.parent.is_dir():
             fp.parent.mkdir(parents=True, exist_ok=True)
-        fp.write_bytes(data.get_object (oid, 'blob'))
+        with open (fp, 'wb') as f:
+            for chunk in data.open_object (o_tree, 'blob'):
+                f.write (chunk)
+        index[path] = o_tree
+        index.set_skip_worktree (path, False)
+        index.set_stat (path, data.stat_data (fp))
+
+
+def _read_into_index (index, tree, update_working, keep=()):
+    """ Replace the index entries by those of tree, keeping the stat data
+    of unchanged entries, and update the working directory if asked to,
+    see _checkout_index for keep.
+    """
+    if update_working:
+        _checkout_index (index, tree, keep)
+        return
+    for path in [path for path in index if path not in tree]:
+        del index[path]
+    index.update (tree)
         
 
 def read_tree (tree_oid, update_working=False):
@@ -135,24 +399,28 @@ def read_tree (tree_oid, update_working=False):
     and checkout the files into the working directory.
     """
     with data.get_index () as index:
-        index.clear ()
-        index.update (get_tree (tree_oid))
-        
-        if update_working:
-            _checkout_index (index)
+        dirs = {}
+        _read_into_index (index, get_tree (tree_oid, dirs=dirs), update_working)
+        # All directories now match the stored tree
+        for path, oid in dirs.items ():
+            index.cache_tree (path, oid)
 
 
 def read_tree_merged (t_base, t_HEAD, t_other, update_working=False):
+    """ Read the three-way merge of trees into the index,
+    and return the list of conflicts.
+    """
     with data.get_index () as index:
-        index.clear ()
-        index.update (diff.merge_trees (
+        merged = diff.merge_trees (
             get_tree (t_base),
             get_tree (t_HEAD),
             get_tree (t_other)
-        ))
-        
-        if update_working:
-            _checkout_index (index)
+        )
+        # Conflicts are checked out even outside of a sparse checkout
+        _read_into_index (index, merged.tree, update_working,
+                          {conflict.path for conflict in merged.conflicts})
+
+    return merged.conflicts
 
 
 def commit (message):
@@ -174,6 +442,7 @@ def commit (message):
     commit += f'{message}\n'
 
     oid = data.hash_object (commit.encode (), 'commit')
+    update_commit_graph ({oid})
     
     data.update_ref ('HEAD', data.RefValue (symbolic=False, value=oid))
         
@@ -206,35 +475,100 @@ def merge (other):
     # Merge heads together
     HEAD = data.get_ref ('HEAD').value
     assert HEAD
-    merge_base = get_merge_base (other, HEAD)
     c_other = get_commit (other)
 
     # Handle fast-forward merge
-    if merge_base == HEAD:
+    if is_ancestor_of (other, HEAD):
         read_tree (c_other.tree, update_working=True)
         data.update_ref ('HEAD',
                          data.RefValue (symbolic=False, value=other))
         print ('Fast-forward merge, no need to commit')
         return
     
-    data.update_ref ('MERGE_HEAD', data.RefValue (symbolic=False, value=other))
-    
-    c_base = get_commit (merge_base)
+    # Shallow histories may have no common commit
+    merge_base = get_merge_base (other, HEAD)
+    t_base = merge_base and get_commit (merge_base).tree
     c_HEAD = get_commit (HEAD)
-    read_tree_merged (c_base.tree, c_HEAD.tree, c_other.tree, update_working=True)
-    print ('Merged in working tree\nPlease commit')
+    conflicts = read_tree_merged (t_base, c_HEAD.tree, c_other.tree,
+                                  update_working=True)
+
+    # Only a merge which was checked out is completed by the next commit
+    data.update_ref ('MERGE_HEAD', data.RefValue (symbolic=False, value=other))
+    for conflict in conflicts:
+        print (f'CONFLICT ({conflict.kind}): {conflict.path}')
+    if conflicts:
+        print ('Merged in working tree\nPlease fix the conflicts and commit')
+    else:
+        print ('Merged in working tree\nPlease commit')
+
+
+# Flags painted on commits while searching merge bases
+PARENT1, PARENT2, STALE, RESULT = 1, 2, 4, 8
+
+
+def get_merge_bases (oid1, oid2):
+    """ Return all best common ancestors of two commits, highest
+    generation first. Both sides are painted down their history in order 
+    of decreasing generation: a commit reached from both sides is a merge
+    base, and its own ancestors become stale. The walk stops as soon as
+    only stale commits are left in the queue.
+    """
+    if oid1 == oid2:
+        return [oid1]
+
+    flags = {oid1: PARENT1, oid2: PARENT2}
+    queue = [(-get_generation (oid), oid) for oid in (oid1, oid2)]
+    heapq.heapify (queue)
+    bases = []
+
+    while any (not flags[oid] & STALE for _, oid in queue):
+        _, oid = heapq.heappop (queue)
+        paint = flags[oid] & (PARENT1 | PARENT2 | STALE)
+        if paint == PARENT1 | PARENT2:
+            if not flags[oid] & RESULT:
+                flags[oid] |= RESULT
+                bases.append (oid)
+            paint |= STALE
+        for parent in get_commit_parents (oid):
+            if flags.get (parent, 0) & paint == paint:
+                continue
+            flags[parent] = flags.get (parent, 0) | paint
+            heapq.heappush (queue, (-get_generation (parent), parent))
+
+    # Bases reached again from another base are not the best ones
+    bases = [oid for oid in bases if not flags[oid] & STALE]
+    return [oid for oid in bases
+            if not any (other != oid and is_ancestor_of (other, oid)
+                        for other in bases)]
 
 
 def get_merge_base (oid1, oid2):
-    parents1 = list (iter_commits_and_parents ({oid1}))
-    
-    for oid in iter_commits_and_parents ({oid2}):
-        if oid in parents1:
-            return oid
+    """ Return the best common ancestor of two commits, or None """
+    bases = get_merge_bases (oid1, oid2)
+    return bases[0] if bases else None
         
         
 def is_ancestor_of (commit, maybe_ancestor):
-    return maybe_ancestor in iter_commits_and_parents ({commit})
+    """ Test if maybe_ancestor is reachable from commit. The walk never
+    goes below the generation of maybe_ancestor, as no commit there can
+    lead to it, so unrelated or older history is not visited.
+    """
+    if (maybe_ancestor not in data.get_commit_graph () 
+            and not data.object_exists (maybe_ancestor)):
+        return False
+    generation = get_generation (maybe_ancestor)
+
+    oids = [commit]
+    visited = set ()
+    while oids:
+        oid = oids.pop ()
+        if oid == maybe_ancestor:
+            return True
+        if oid in visited or get_generation (oid) <= generation:
+            continue
+        visited.add (oid)
+        oids.extend (get_commit_parents (oid))
+    return False
 
 
 def create_tag (name, oid):
@@ -269,11 +603,16 @@ Commit = namedtuple ('Commit', ['tree', 'parents', 'message'])
 Commit.__doc__ = """A name tuple representing a commit value
 - with three fields:
   tree     - Object Id
-  parents  - Object Id
+  parents  - tuple of Object Ids
   message  - associated text
 """
 
 def get_commit (oid):
+    # Keyed by type as well, so the OID of a tree is not taken for a commit
+    cached = data.parsed_cache.get (('commit', oid))
+    if cached:
+        return cached
+
     parents = []
     
     commit = data.get_object (oid, 'commit').decode ()
@@ -288,7 +627,106 @@ def get_commit (oid):
             assert False, f'Unknown field {key}'
     
     message = '\n'.join (lines)
-    return Commit (tree=tree, parents=parents, message=message)
+    # A tuple, as the cached Commit is shared by all callers
+    result = Commit (tree=tree, parents=tuple (parents), message=message)
+    data.parsed_cache.put (('commit', oid), result, len (commit))
+    return result
+
+
+def get_commit_parents (oid):
+    """ Return the parents of a commit, from the commit-graph if possible.
+    Shallow commits have none, as their history was not fetched.
+    """
+    if oid in data.get_shallow ():
+        return ()
+    graph = data.get_commit_graph ()
+    if oid in graph:
+        return graph.get_parents (oid)
+    return get_commit (oid).parents
+
+
+def get_commit_tree (oid):
+    """ Return the tree of a commit, from the commit-graph if possible """
+    graph = data.get_commit_graph ()
+    if oid in graph:
+        return graph.get_tree (oid)
+    return get_commit (oid).tree
+
+
+# Generation numbers of commits which are not in the commit-graph,
+# by the shallow commits, which count as roots, they were computed with
+_generations = {}
+
+
+def get_generation (oid):
+    """ Return the generation number of a commit, which is 1 for a root
+    commit, or one more than the highest generation of its parents
+    """
+    graph = data.get_commit_graph ()
+    generations = _generations.setdefault (data.get_shallow (), {})
+
+    def known (oid):
+        return oid in graph or oid in generations
+
+    def generation (oid):
+        if oid in graph:
+            return graph.get_generation (oid)
+        return generations[oid]
+
+    # Compute missing generations parents first, without recursion
+    oids = [oid]
+    while oids:
+        if known (oids[-1]):
+            oids.pop ()
+            continue
+        parents = get_commit_parents (oids[-1])
+        missing = [p for p in parents if not known (p)]
+        if missing:
+            oids.extend (missing)
+        else:
+            generations[oids.pop ()] = 1 + max (map (generation, parents),
+                                                default=0)
+    return generation (oid)
+
+
+def update_commit_graph (oids):
+    """ Add the given commits and all their ancestors, which are not
+    yet in the commit-graph, to the commit-graph
+    """
+    graph = data.get_commit_graph ()
+
+    # Parse the commits missing from the graph
+    new = {}
+    oids = [oid for oid in oids if oid]
+    while oids:
+        oid = oids.pop ()
+        if oid in graph or oid in new or not data.object_exists (oid):
+            continue
+        new[oid] = get_commit (oid)
+        oids.extend (new[oid].parents)
+
+    # Order parents before their children. Commits with a missing
+    # parent or more than two parents can not be stored, nor any of
+    # their descendants.
+    order = []
+    stored = {}
+    for start in new:
+        oids = [(start, False)]
+        while oids:
+            oid, parents_done = oids.pop ()
+            if oid in stored:
+                continue
+            parents = new[oid].parents
+            if parents_done:
+                stored[oid] = len (parents) <= 2 and all (
+                    p in graph or stored.get (p) for p in parents)
+                if stored[oid]:
+                    order.append ((oid, new[oid].tree, parents))
+                continue
+            oids.append ((oid, True))
+            oids.extend ((p, False) for p in parents if p in new)
+
+    return graph.append (order)
 
 
 def iter_commits_and_parents (oids):
@@ -304,11 +742,11 @@ def iter_commits_and_parents (oids):
         visited.add (oid)
         yield oid
         
-        commit = get_commit (oid)
+        parents = get_commit_parents (oid)
         # Return first parent next
-        oids.extendleft (commit.parents[:1])
+        oids.extendleft (parents[:1])
         # Return other parents later
-        oids.extend (commit.parents[1:])
+        oids.extend (parents[1:])
     
 
 def iter_objects_in_commits (oids):
@@ -329,9 +767,281 @@ def iter_objects_in_commits (oids):
                     
     for oid in iter_commits_and_parents (oids):
         yield oid
-        commit = get_commit (oid)
-        if commit.tree not in visited:
-            yield from iter_objects_in_tree (commit.tree)
+        tree = get_commit_tree (oid)
+        if tree not in visited:
+            yield from iter_objects_in_tree (tree)
+
+
+# Number of commits the other side is asked about at once, and the number
+# of commits asked about in vain before the negotiation gives up
+NEGOTIATION_BATCH = 32
+MAX_IN_VAIN = 256
+
+
+def find_common_commits (oids, has_commits):
+    """ Walk the history of oids, newest first, and return the commits
+    the other side has, asking has_commits (list) -> set in batches.
+    Ancestors of common commits are not walked, as they are known to
+    be common as well.
+    """
+    common = set ()
+    heap = [(-get_generation (oid), oid) for oid in set (oids) if oid]
+    heapq.heapify (heap)
+    visited = {oid for _, oid in heap}
+    in_vain = 0
+
+    while heap and in_vain < MAX_IN_VAIN:
+        batch = [heapq.heappop (heap)[1]
+                 for _ in range (min (NEGOTIATION_BATCH, len (heap)))]
+        found = has_commits (batch)
+        common.update (found)
+        in_vain = 0 if found else in_vain + len (batch)
+        for oid in batch:
+            if oid in found:
+                continue
+            for parent in get_commit_parents (oid):
+                if parent not in visited:
+                    visited.add (parent)
+                    heapq.heappush (heap, (-get_generation (parent), parent))
+    return common
+
+
+def iter_new_commits (wants, haves, shallow=(), boundary=()):
+    """ Yield the commits reachable from wants but not from haves,
+    children before their parents. The other side has the commits of
+    shallow but none of their history, the commits of boundary are
+    treated as roots.
+    """
+    # Commit: whether it is reachable from haves
+    uninteresting = {}
+    heap = []
+    # Number of commits in heap which are not uninteresting
+    pending = 0
+
+    def push (oid, is_uninteresting):
+        nonlocal pending
+        if oid in uninteresting:
+            # All children of a commit are popped before it, so it is 
+            # certainly still queued when it becomes uninteresting
+            if is_uninteresting and not uninteresting[oid]:
+                uninteresting[oid] = True
+                pending -= 1
+            return
+        uninteresting[oid] = is_uninteresting
+        pending += not is_uninteresting
+        heapq.heappush (heap, (-get_generation (oid), oid))
+
+    for oid in haves:
+        push (oid, True)
+    for oid in shallow:
+        if data.object_exists (oid):
+            push (oid, True)
+    for oid in wants:
+        if oid:
+            push (oid, False)
+
+    while pending:
+        _, oid = heapq.heappop (heap)
+        is_uninteresting = uninteresting[oid]
+        if not is_uninteresting:
+            pending -= 1
+            yield oid
+        elif oid in shallow:
+            # Its parents are not known to the other side
+            continue
+        if oid in boundary:
+            continue
+        for parent in get_commit_parents (oid):
+            push (parent, is_uninteresting)
+
+
+def get_shallow_fetch (wants, shallow, depth=None):
+    """ Prepare a fetch of the history of wants down to depth commits
+    (all of it if None), for another side with the shallow commits shallow.
+    Return (wants, boundary): wants along with the parents of shallow
+    commits which are within depth, and the commits at depth whose parents
+    are beyond it, which become shallow on the other side.
+    """
+    wants = {oid for oid in wants if oid}
+    within = None
+    boundary = set ()
+    if depth is not None:
+        level = within = set (wants)
+        for _ in range (depth - 1):
+            level = {parent for oid in level
+                     for parent in get_commit_parents (oid)} - within
+            within |= level
+        boundary = {oid for oid in level
+                    if not within.issuperset (get_commit_parents (oid))}
+
+    for oid in shallow:
+        if data.object_exists (oid) and (within is None or oid in within):
+            wants.update (parent for parent in get_commit_parents (oid)
+                          if within is None or parent in within)
+    return wants, boundary
+
+
+def iter_new_objects (wants, haves, shallow=(), boundary=(), blobs=True):
+    """ Yield the objects reachable from the commits wants, but not from
+    the commits haves, see iter_new_commits for shallow and boundary.
+    Without blobs, only commits and trees are yielded.
+    The tree of each new commit is only compared to the trees of its
+    parents: subtrees and blobs found at the same path in a parent are
+    skipped, as they are either known or sent with it. With reachability
+    bitmaps, the objects are found by bitwise operations, unless the
+    history is cut off by shallow commits or blobs are left out.
+    """
+    p = blobs and not shallow and not boundary and _get_bitmap_pack ()
+    if p:
+        want_bits, want_extra = _reachable_bits (wants, p, p.bitmaps)
+        have_bits, have_extra = _reachable_bits (haves, p, p.bitmaps)
+        yield from p.iter_bitmap (want_bits & ~have_bits)
+        yield from want_extra - have_extra
+        return
+
+    visited = set ()
+
+    def iter_tree_objects (oid, parent_oids):
+        if oid in parent_oids or oid in visited:
+            return
+        visited.add (oid)
+        yield oid
+
+        parent_entries = [{name: (type_, oid) 
+                           for type_, oid, name in _iter_tree_entries (parent)}
+                          for parent in parent_oids]
+        for type_, oid, name in _iter_tree_entries (oid):
+            same_path = [entries[name][1] for entries in parent_entries
+                         if entries.get (name, (None,))[0] == type_]
+            if type_ == 'tree':
+                yield from iter_tree_objects (oid, same_path)
+            elif blobs and oid not in same_path and oid not in visited:
+                visited.add (oid)
+                yield oid
+
+    for oid in iter_new_commits (wants, haves, shallow, boundary):
+        yield oid
+        parents = [] if oid in boundary else get_commit_parents (oid)
+        parent_trees = [get_commit_tree (parent) for parent in parents]
+        yield from iter_tree_objects (get_commit_tree (oid), 
+                                      [tree for tree in parent_trees if tree])
+
+
+# Every BITMAP_INTERVAL-th commit gets a bitmap, besides all ref tips
+BITMAP_INTERVAL = 100
+
+
+def _get_bitmap_pack ():
+    """ Return the pack with reachability bitmaps, or None """
+    return next ((p for p in data.get_packs () if p.bitmaps), None)
+
+
+def _reachable_bits (oids, p, bitmaps):
+    """ Return the objects reachable from the commits oids, as a bitset over
+    the objects of pack p plus a set of those not in p. The history is
+    walked until commits with one of bitmaps, {commit: int}, are reached.
+    """
+    seen = bytearray ((len (p) + 7) // 8)
+    extra = set ()
+
+    def add (oid):
+        """ Mark an object as reachable, return False if it already was """
+        pos = p.idx.position (oid)
+        if pos is None:
+            if oid in extra:
+                return False
+            extra.add (oid)
+            return True
+        byte, bit = divmod (pos, 8)
+        if seen[byte] & (1 << bit):
+            return False
+        seen[byte] |= 1 << bit
+        return True
+
+    def add_tree (oid):
+        if not add (oid):
+            return
+        for type_, oid, _ in _iter_tree_entries (oid):
+            if type_ == 'tree':
+                add_tree (oid)
+            else:
+                add (oid)
+
+    commits = [oid for oid in oids if oid]
+    while commits:
+        oid = commits.pop ()
+        if not add (oid):
+            continue
+        bitmap = bitmaps.get (oid)
+        if bitmap is not None:
+            seen[:] = (int.from_bytes (seen, 'little') | bitmap).to_bytes (
+                len (seen), 'little')
+            continue
+        add_tree (get_commit_tree (oid))
+        commits.extend (get_commit_parents (oid))
+
+    return int.from_bytes (seen, 'little'), extra
+
+
+def write_bitmaps (p):
+    """ Write reachability bitmaps for the ref tips and for every 
+    BITMAP_INTERVAL-th commit of pack p. Return the number of bitmaps.
+    """
+    # Bitmaps would miss the history which a shallow repository lacks
+    if data.get_shallow ():
+        return 0
+
+    tips = {ref.value for _, ref in data.iter_refs ()}
+    commits = [oid for oid in iter_commits_and_parents (tips) if oid in p]
+    selected = set (commits[::BITMAP_INTERVAL]) | (tips & set (commits))
+
+    # Oldest first, so each walk stops at the bitmaps of older commits
+    bitmaps = {}
+    for oid in sorted (selected, key=get_generation):
+        bits, extra = _reachable_bits ([oid], p, bitmaps)
+        # Commits which reach objects outside of the pack are not covered
+        if not extra:
+            bitmaps[oid] = bits
+
+    pack.write_bitmaps (p, bitmaps)
+    return len (bitmaps)
+
+
+def iter_reachable_objects (oids):
+    """ Yield all objects reachable from the commits oids """
+    p = _get_bitmap_pack ()
+    if not p:
+        yield from iter_objects_in_commits (oids)
+        return
+    bits, extra = _reachable_bits (oids, p, p.bitmaps)
+    yield from p.iter_bitmap (bits)
+    yield from extra
+
+
+def repack ():
+    """ Pack all objects, and write reachability bitmaps for the new pack.
+    Returns the new pack or None.
+    """
+    p = data.repack ()
+    if p:
+        write_bitmaps (p)
+    return p
+
+
+def gc ():
+    """ Pack all objects reachable from refs or the Index, and delete
+    unreachable ones. Returns the new pack or None.
+    """
+    keep = set (iter_reachable_objects (
+        ref.value for _, ref in data.iter_refs ()))
+    with data.get_index (read_only=True) as index:
+        keep.update (index.values ())
+        keep.update (index.trees.values ())
+
+    p = data.repack (keep)
+    if p:
+        write_bitmaps (p)
+    return p
 
 
 def get_oid (name):
@@ -356,7 +1066,7 @@ def get_oid (name):
     assert False, f'Unknown name {name}'
 
           
-def add (filenames):
+def add (filenames, jobs=None):
     """ 
     Add one or more files/directories to the Index file
     Expects a list of file paths
@@ -367,28 +1077,16 @@ def add (filenames):
                 continue
             elif file_path.is_file():
                 # add file/hash for specified file
-                index[str(file_path)] = data.hash_object(file_path.read_bytes())
+                hash_file (file_path, index, stage=True)
             elif file_path.is_dir():
                 # Add dictionary of files/hashes within specified path
-                index.update(**scan_dir(file_path))    
+                scan_dir (file_path, index, stage=True, jobs=jobs)
 
 
 def is_ignored (path):
-    """ Filter criteria of files/dirs to be ignored """
-    # exlude Python cache files
-    if '__pycache__' in path.parts:        
-        return False
-    
-    # notebook files to exclude
-    if path.suffix == '.ipynb':
-        return True
-    
-    # dirs to exclude
-    for s in ['.ipynb_checkpoints', '.gitignore', '.ugit', 'ugit.egg-info']:
-        if s in path.parts:
-            return True
-    
-    return False                
-
-    # orig: return '.ugit' in path.parts
+    """ Test if a path is ignored by default or by the .ugitignore file,
+    itself or as part of an ignored directory (see ignore.DEFAULT_PATTERNS)
+    """
+    path = Path (path)
+    return ignore.get_rules ().is_ignored (path.as_posix (), path.is_dir ())
 
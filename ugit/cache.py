@@ -0,0 +1,59 @@
+# File: cache.py
+# Date: 2026-10-17
+
+from collections import OrderedDict
+
+
+class LRUCache:
+    """ Least recently used cache, bounded by the total size in bytes
+    of its values. A value's size is given when it is stored.
+    A cache of max_bytes 0 is disabled.
+    """
+    def __init__ (self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict ()
+
+    def __contains__ (self, key):
+        return key in self._items
+
+    def __len__ (self):
+        return len (self._items)
+
+    def get (self, key, default=None):
+        item = self._items.get (key)
+        if item is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._items.move_to_end (key)
+        return item[0]
+
+    def put (self, key, value, size):
+        """ Store value, evicting the least recently used values if needed.
+        Values larger than the whole cache are not stored.
+        """
+        if key in self._items:
+            self.size -= self._items.pop (key)[1]
+        if not self.max_bytes or size > self.max_bytes:
+            return
+        self._items[key] = (value, size)
+        self.size += size
+        self._evict ()
+
+    def _evict (self):
+        while self.size > self.max_bytes:
+            _, (_, evicted) = self._items.popitem (last=False)
+            self.size -= evicted
+
+    def resize (self, max_bytes):
+        """ Change the bound of the cache, 0 disables it """
+        self.max_bytes = max_bytes
+        self._evict ()
+
+    def clear (self):
+        self._items.clear ()
+        self.size = 0
+        self.hits = self.misses = 0
@@ -0,0 +1,143 @@
+# File: commitgraph.py
+# Date: 2026-10-17
+
+import os
+import struct
+
+from pathlib import Path
+
+
+SIGNATURE = b'UCGR'
+VERSION = 1
+
+HEADER = struct.Struct ('>4sI')
+# oid, tree, first parent, second parent, generation
+RECORD = struct.Struct ('>20s20sIII')
+NO_PARENT = 0xffffffff
+
+
+class CommitGraph:
+    """ Parents, tree and generation number of commits, without the need
+    to parse their commit objects. The generation number of a commit is
+    one more than the largest generation of its parents (roots have 1),
+    so a commit can never be an ancestor of one with a lower generation.
+    Layout:
+      signature, version
+      records    - oid, tree, parent positions, generation,
+                   in topological order (parents before their children)
+    The file is only ever appended to, as records never change.
+    A truncated last record, or an unreadable file, is left out: the
+    commits missing from the graph are read from their objects instead.
+    """
+    def __init__ (self, path):
+        self.path = Path (path)
+        self._load ()
+
+    def _stat_key (self):
+        try:
+            st = os.stat (self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _load (self):
+        self.oids = []
+        self.trees = []
+        self.parents = []
+        self.generations = []
+        self.positions = {}
+        # Length of the valid part of the file, and its stat when read
+        self.size = 0
+        self.key = None
+
+        try:
+            with open (self.path, 'rb') as f:
+                st = os.fstat (f.fileno ())
+                buf = f.read ()
+        except FileNotFoundError:
+            return
+        self.key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if (len (buf) < HEADER.size
+                or HEADER.unpack_from (buf, 0) != (SIGNATURE, VERSION)):
+            return
+
+        end = len (buf) - (len (buf) - HEADER.size) % RECORD.size
+        for record in RECORD.iter_unpack (buf[HEADER.size:end]):
+            # Parents always come before their children
+            if any (p != NO_PARENT and p >= len (self.oids) for p in record[2:4]):
+                break
+            self._add (*record)
+        self.size = HEADER.size + len (self.oids) * RECORD.size
+
+    def _add (self, oid, tree, parent1, parent2, generation):
+        self.positions[oid.hex ()] = len (self.oids)
+        self.oids.append (oid.hex ())
+        self.trees.append (tree.hex ())
+        self.parents.append (tuple (p for p in (parent1, parent2)
+                                    if p != NO_PARENT))
+        self.generations.append (generation)
+
+    def __contains__ (self, oid):
+        return oid in self.positions
+
+    def __len__ (self):
+        return len (self.oids)
+
+    def get_parents (self, oid):
+        return tuple (self.oids[p] for p in self.parents[self.positions[oid]])
+
+    def get_tree (self, oid):
+        return self.trees[self.positions[oid]]
+
+    def get_generation (self, oid):
+        return self.generations[self.positions[oid]]
+
+    def append (self, commits):
+        """ Append commits, given as (oid, tree, parents) in topological
+        order. All parents have to be in the graph or earlier in commits,
+        and a commit can have two parents at most. Returns the number of
+        commits appended.
+        Other processes may append as well: under a lock file, the graph
+        is read again if the file changed since, and the commits it has
+        by then are skipped. If another process holds the lock, nothing
+        is appended, the commits are read from their objects meanwhile.
+        """
+        lock = self.path.with_name (self.path.name + '.lock')
+        self.path.parent.mkdir (parents=True, exist_ok=True)
+        try:
+            os.close (os.open (lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return 0
+
+        try:
+            if self._stat_key () != self.key:
+                self._load ()
+            records = []
+            for oid, tree, parents in commits:
+                if oid in self.positions:
+                    continue
+                assert len (parents) <= 2, f'Too many parents for {oid}'
+                positions = [self.positions[p] for p in parents]
+                generation = 1 + max ((self.generations[p] for p in positions),
+                                      default=0)
+                positions += [NO_PARENT] * (2 - len (positions))
+                record = (bytes.fromhex (oid), bytes.fromhex (tree),
+                          *positions, generation)
+                self._add (*record)
+                records.append (RECORD.pack (*record))
+
+            if records:
+                # Drop a truncated record, or an unreadable file, first
+                with open (self.path, 'ab') as f:
+                    f.truncate (self.size)
+                    if not self.size:
+                        f.write (HEADER.pack (SIGNATURE, VERSION))
+                    f.write (b''.join (records))
+                self.size = HEADER.size + len (self.oids) * RECORD.size
+                self.key = self._stat_key ()
+            return len (records)
+        except BaseException:
+            self._load ()
+            raise
+        finally:
+            lock.unlink ()
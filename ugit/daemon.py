@@ -0,0 +1,197 @@
+# File: daemon.py
+# Date: 2026-10-17
+
+import asyncio
+import os
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from ugit import base
+from ugit import data
+from ugit import protocol
+
+
+# Requests run within the event loop, so GIT_DIR may be switched to the
+# requested repository only between two awaits. Packs are built and
+# indexed by a pool of processes, which would block the loop otherwise.
+
+
+def _write_pack_file (objects):
+    """ Write the objects into a temp file, return its path or None """
+    if not objects:
+        return None
+    fd, tmp = tempfile.mkstemp (prefix='ugit-', suffix='.pack')
+    with open (fd, 'wb') as f:
+        data.send_pack (f, objects)
+    return tmp
+
+
+def _write_upload_pack (repo, wants, haves, shallow, deepen, depth, blobs):
+    """ Write the objects a client is missing into a temp file, returns
+    (path or None if there are none, number of objects, commits which
+    may be shallow at the client)
+    """
+    with data.change_git_dir (repo):
+        data.clear_ref_cache ()
+        boundary = set ()
+        if deepen:
+            wants, boundary = base.get_shallow_fetch (wants, shallow, depth)
+        objects = list (base.iter_new_objects (wants, haves, shallow, boundary,
+                                               blobs))
+        boundary |= data.get_shallow ()
+        return _write_pack_file (objects), len (objects), sorted (boundary)
+
+
+def _write_objects_pack (repo, oids):
+    """ Write the requested objects into a temp file,
+    returns (path or None, number of objects)
+    """
+    with data.change_git_dir (repo):
+        for oid in oids:
+            assert data.object_exists (oid), f'Object {oid} not found'
+        return _write_pack_file (oids), len (oids)
+
+
+def _add_pack (repo, tmp):
+    with data.change_git_dir (repo):
+        return data.add_pack (tmp)
+
+
+def _get_refs (repo, prefix):
+    with data.change_git_dir (repo):
+        data.clear_ref_cache ()
+        return {refname: ref.value for refname, ref in data.iter_refs (prefix)}
+
+
+class Server:
+    """ Serves the repositories below root to clients of ugit:// URLs """
+    def __init__ (self, root, jobs=None):
+        self.root = Path (root).resolve ()
+        self.pool = ProcessPoolExecutor (jobs)
+
+    def _repo (self, path):
+        repo = (self.root / path.lstrip ('/')).resolve ()
+        assert repo == self.root or self.root in repo.parents, \
+            f'Repository {path} is outside of the served directory'
+        assert (repo / '.ugit').is_dir (), f'No repository at {path}'
+        return str (repo)
+
+    async def _run (self, fn, *args):
+        return await asyncio.get_running_loop ().run_in_executor (
+            self.pool, fn, *args)
+
+    async def handle (self, reader, writer):
+        try:
+            request = await protocol.read_message (reader)
+            repo = self._repo (request['path'])
+            if request['command'] == 'fetch':
+                await self.upload (reader, writer, repo, request.get ('prefix', ''))
+            elif request['command'] == 'push':
+                await self.receive (reader, writer, repo)
+            elif request['command'] == 'objects':
+                await self.send_objects (writer, repo, request['want'])
+            else:
+                assert False, f'Unknown command {request["command"]}'
+        except asyncio.IncompleteReadError:
+            pass
+        except Exception as e:
+            try:
+                await protocol.send (writer, {'error': str (e)})
+            except ConnectionError:
+                pass
+        finally:
+            writer.close ()
+
+    async def upload (self, reader, writer, repo, prefix):
+        """ Serve a fetch: advertise refs, answer which of the commits
+        the client has we know, then send the pack of the missing objects
+        """
+        await protocol.send (writer, {'refs': _get_refs (repo, prefix)})
+
+        while True:
+            message = await protocol.read_message (reader)
+            if 'want' in message:
+                break
+            with data.change_git_dir (repo):
+                common = [oid for oid in message['have']
+                          if data.object_exists (oid)]
+            await protocol.send (writer, {'common': common})
+
+        tmp, count, shallow = await self._run (
+            _write_upload_pack, repo, message['want'], message['done'],
+            set (message.get ('shallow', ())), message.get ('deepen', False),
+            message.get ('depth'), message.get ('blobs', True))
+        await protocol.send (writer, {'objects': count, 'shallow': shallow})
+        await self._send_pack_file (writer, tmp)
+
+    async def send_objects (self, writer, repo, oids):
+        """ Serve the objects a partial clone asks for by OID """
+        tmp, count = await self._run (_write_objects_pack, repo, oids)
+        await protocol.send (writer, {'objects': count})
+        await self._send_pack_file (writer, tmp)
+
+    async def _send_pack_file (self, writer, tmp):
+        """ Send a pack as data messages, and delete its temp file """
+        if not tmp:
+            return
+        try:
+            with open (tmp, 'rb') as f:
+                while chunk := f.read (protocol.CHUNK_SIZE):
+                    writer.write (protocol.encode_data (chunk))
+                    await writer.drain ()
+            writer.write (protocol.FLUSH)
+            await writer.drain ()
+        finally:
+            os.unlink (tmp)
+
+    async def receive (self, reader, writer, repo):
+        """ Serve a push: advertise refs, receive and index the pack,
+        and update the ref unless it was changed meanwhile or the update
+        is no fast-forward. The ref is checked and written without an await
+        in between, so no other request of the loop can interleave.
+        """
+        await protocol.send (writer, {'refs': _get_refs (repo, '')})
+        message = await protocol.read_message (reader)
+        refname, old, new = message['update']
+        data.check_ref_name (refname)
+        if not refname.startswith ('refs/heads/'):
+            raise ValueError (f'Can not push to {refname}')
+
+        if message['objects']:
+            with data.change_git_dir (repo):
+                fd, tmp = data.temp_pack_file ()
+            try:
+                with open (fd, 'wb') as f:
+                    async for chunk in protocol.iter_data (reader):
+                        f.write (chunk)
+                await self._run (_add_pack, repo, tmp)
+            finally:
+                Path (tmp).unlink (missing_ok=True)
+
+        with data.change_git_dir (repo):
+            data.clear_ref_cache ()
+            assert data.object_exists (new), 'Pushed objects are incomplete'
+            current = data.get_ref (refname).value
+            assert current == old, f'{refname} was updated meanwhile, fetch first'
+            # Checked here as well, the client may not be ugit's
+            if current and not base.is_ancestor_of (new, current):
+                raise ValueError (f'{refname} would not be fast-forwarded')
+            data.update_ref (refname, data.RefValue (symbolic=False, value=new))
+            base.update_commit_graph ({new})
+        await protocol.send (writer, {'ok': True})
+
+    async def serve (self, host, port):
+        server = await asyncio.start_server (self.handle, host, port)
+        async with server:
+            await server.serve_forever ()
+
+
+def serve (root, host='localhost', port=protocol.DEFAULT_PORT, jobs=None):
+    """ Serve the repositories below root until interrupted """
+    server = Server (root, jobs)
+    try:
+        asyncio.run (server.serve (host, port))
+    finally:
+        server.pool.shutdown ()
@@ -1,16 +1,43 @@
 # File: data.py
 # Date: 2020-11-29
 
+import bisect
 import hashlib
 import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zlib
 
 from pathlib import Path
 from collections import namedtuple
+from collections.abc import MutableMapping
 from contextlib import contextmanager
 
+from ugit import commitgraph
+from ugit import pack
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where files are copied instead of reflinked
+    fcntl = None
+from ugit.cache import LRUCache
+
 
 GIT_DIR = Path('.ugit')
 
+# Bound in bytes of the caches of objects by OID, 0 disables them.
+# As objects never change, cached ones never need to be invalidated.
+OBJECT_CACHE_SIZE = int (os.environ.get ('UGIT_OBJECT_CACHE', 64 * 1024 * 1024))
+# Content of objects: (type, bytes)
+object_cache = LRUCache (OBJECT_CACHE_SIZE)
+# Objects parsed by their readers, like commits and tree entries
+parsed_cache = LRUCache (OBJECT_CACHE_SIZE)
+
 RefValue = namedtuple ('RefValue', ['symbolic', 'value'])
 RefValue.__doc__ = """A named tuple representing a Reference Value
 - with two fields:
@@ -28,8 +55,10 @@ def change_git_dir (new_dir):
     global GIT_DIR
     old_dir = GIT_DIR
     GIT_DIR = Path(new_dir) / '.ugit'
-    yield
-    GIT_DIR = old_dir
+    try:
+        yield
+    finally:
+        GIT_DIR = old_dir
 
 
 def init ():
@@ -52,25 +81,68 @@ def update_ref (ref, value, deref=True):
     ref_path = GIT_DIR / ref
     ref_path.parent.mkdir(parents=True, exist_ok=True)
     ref_path.write_text(value)
+    _ref_cache.clear ()
+
+
+def check_ref_name (ref):
+    """ Raise ValueError unless ref is a relative path below GIT_DIR,
+    as a ref name sent by another side may try to escape it
+    """
+    parts = ref.split ('/')
+    if (not ref or ref.startswith ('/') or '\\' in ref or '\x00' in ref
+            or any (part in ('', '.', '..') for part in parts)
+            or any (part.endswith ('.lock') for part in parts)):
+        raise ValueError (f'Invalid ref name {ref!r}')
+
 
-    
 def get_ref (ref, deref=True):
     """ return reference or object Id """
     return _get_ref_internal (ref, deref)[1]
 
 
 def delete_ref (ref, deref=True):
-    """ Delete given reference """
+    """ Delete given reference, loose as well as packed """
     ref = _get_ref_internal (ref, deref)[0]
-    (GIT_DIR / ref).unlink()
+    ref_path = GIT_DIR / ref
+    packed = get_packed_refs ()
+    assert ref_path.is_file () or ref in packed, f'Unknown ref {ref}'
+    if ref_path.is_file ():
+        ref_path.unlink ()
+    if ref in packed:
+        _write_packed_refs ({name: oid for name, oid in packed.items ()
+                             if name != ref})
+    _ref_cache.clear ()
+
+
+# Resolved refs of this process by (GIT_DIR, ref, deref),
+# cleared whenever a ref is updated or deleted
+_ref_cache = {}
+
+
+def clear_ref_cache ():
+    """ Forget resolved refs and shallow commits, as other processes
+    may have changed them
+    """
+    _ref_cache.clear ()
+    _shallow.clear ()
 
 
 def _get_ref_internal (ref, deref):
     """ recursively scan through references """
+    key = (GIT_DIR, ref, deref)
+    if key not in _ref_cache:
+        _ref_cache[key] = _resolve_ref (ref, deref)
+    return _ref_cache[key]
+
+
+def _resolve_ref (ref, deref):
     value = None
     ref_path = GIT_DIR / ref
     if ref_path.is_file():
         value = ref_path.read_text().strip()
+    else:
+        # Loose refs take precedence over packed ones
+        value = get_packed_refs ().get (ref)
 
     symbolic = bool (value) and value.startswith ('ref:')
     if symbolic:
@@ -86,10 +158,15 @@ def iter_refs (prefix='', deref=True):
     refs = ['HEAD', 'MERGE_HEAD']
 
     # extend list by all files within the '.ugit/refs' tree
-    refs.extend( str (fp.relative_to(GIT_DIR))
-                  for fp in (GIT_DIR / 'refs').rglob('*')
-                  if fp.is_file()
-               )
+    # and by the packed refs
+    refs_dir = GIT_DIR / 'refs'
+    if prefix.startswith ('refs/'):
+        refs_dir = GIT_DIR / prefix.rpartition ('/')[0]
+    names = {str (fp.relative_to (GIT_DIR)) 
+             for fp in refs_dir.rglob ('*')
+             if fp.is_file ()}
+    names.update (get_packed_refs ().names_with_prefix (prefix))
+    refs.extend (sorted (names))
 
     for refname in refs:
         if not refname.startswith (prefix):
@@ -99,21 +176,413 @@ def iter_refs (prefix='', deref=True):
             yield refname, ref
 
 
-@contextmanager
-def get_index ():
-    """ In the context of processing the Index from JSON file, 
-    the Index is returned to the caller, 
-    and afterwards written back in JSON format.
+class PackedRefs:
+    """ The refs of the 'packed-refs' file, one line of 
+    '{OID} {refname}' per ref, sorted by name for binary search
+    """
+    def __init__ (self, path):
+        self.names = []
+        self.oids = []
+        if path.is_file ():
+            for line in path.read_text ().splitlines ():
+                oid, name = line.split (' ', 1)
+                self.names.append (name)
+                self.oids.append (oid)
+
+    def get (self, name, default=None):
+        i = bisect.bisect_left (self.names, name)
+        if i < len (self.names) and self.names[i] == name:
+            return self.oids[i]
+        return default
+
+    def __contains__ (self, name):
+        return self.get (name) is not None
+
+    def items (self):
+        return zip (self.names, self.oids)
+
+    def names_with_prefix (self, prefix):
+        start = bisect.bisect_left (self.names, prefix)
+        end = start
+        while end < len (self.names) and self.names[end].startswith (prefix):
+            end += 1
+        return self.names[start:end]
+
+
+# PackedRefs by path, along with the stat data they were read with
+_packed_refs = {}
+
+
+def get_packed_refs ():
+    """ Return the packed refs, read again only when the file changed """
+    fp = GIT_DIR / 'packed-refs'
+    try:
+        st = os.stat (fp)
+        key = (st.st_mtime_ns, st.st_size, st.st_ino)
+    except FileNotFoundError:
+        key = None
+    cached = _packed_refs.get (fp)
+    if not cached or cached[0] != key:
+        cached = _packed_refs[fp] = (key, PackedRefs (fp))
+    return cached[1]
+
+
+def _write_packed_refs (refs):
+    """ Replace the packed-refs file by refs, a dict of name: OID """
+    fp = GIT_DIR / 'packed-refs'
+    tmp = GIT_DIR / 'packed-refs.lock'
+    tmp.write_text (''.join (f'{oid} {name}\n'
+                             for name, oid in sorted (refs.items ())))
+    os.replace (tmp, fp)
+    _packed_refs.pop (fp, None)
+
+
+def pack_refs ():
+    """ Move all non-symbolic refs below 'refs/' into the packed-refs file,
+    and remove their loose files. Return the number of packed refs.
+    """
+    refs = dict (get_packed_refs ().items ())
+    loose = []
+    for refname, ref in iter_refs ('refs/', deref=False):
+        if not ref.symbolic:
+            refs[refname] = ref.value
+            if (GIT_DIR / refname).is_file ():
+                loose.append (GIT_DIR / refname)
+
+    _write_packed_refs (refs)
+    for fp in loose:
+        fp.unlink ()
+        # Remove directories which became empty, except 'refs' itself
+        for parent in fp.parents:
+            if parent == GIT_DIR / 'refs' or any (parent.iterdir ()):
+                break
+            parent.rmdir ()
+    _ref_cache.clear ()
+    return len (refs)
+
+
+# Shallow commits of this process by GIT_DIR, cleared along with refs
+_shallow = {}
+
+
+def get_shallow ():
+    """ Return the shallow commits, whose parents are not in the object
+    database as the history was fetched only down to them
+    """
+    if GIT_DIR not in _shallow:
+        fp = GIT_DIR / 'shallow'
+        _shallow[GIT_DIR] = frozenset (
+            fp.read_text ().split () if fp.is_file () else ())
+    return _shallow[GIT_DIR]
+
+
+def set_shallow (oids):
+    """ Record the shallow commits, removing the file if there are none """
+    fp = GIT_DIR / 'shallow'
+    if oids:
+        tmp = fp.with_name ('shallow.lock')
+        tmp.write_text (''.join (f'{oid}\n' for oid in sorted (oids)))
+        os.replace (tmp, fp)
+    elif fp.is_file ():
+        fp.unlink ()
+    _shallow.pop (GIT_DIR, None)
+
+
+StatData = namedtuple ('StatData', ['mtime_ns', 'size', 'ino', 'mode'])
+StatData.__doc__ = """A named tuple representing the stat data of a work tree file
+- with four fields:
+  mtime_ns  - modification time in nanoseconds
+  size      - file size in bytes
+  ino       - inode number
+  mode      - file type and permission bits
+"""
+
+
+def get_sparse_checkout ():
+    """ Return the directories of a sparse checkout, in which alone files
+    are checked out, or None if the whole tree is
+    """
+    fp = GIT_DIR / 'info' / 'sparse-checkout'
+    if not fp.is_file ():
+        return None
+    return [line.strip ().strip ('/') for line in fp.read_text ().splitlines ()
+            if line.strip () and not line.startswith ('#')]
+
+
+def set_sparse_checkout (directories):
+    """ Record the directories of a sparse checkout, None disables it """
+    fp = GIT_DIR / 'info' / 'sparse-checkout'
+    if directories is None:
+        fp.unlink (missing_ok=True)
+        return
+    fp.parent.mkdir (exist_ok=True)
+    fp.write_text (''.join (f'{directory}\n' for directory in directories))
+
+
+def stat_data (path):
+    """ Return the stat data of a work tree file as kept in the Index.
+    The stat result an os.DirEntry cached while scanning is used again.
     """
-    index = {}
+    st = path.stat () if isinstance (path, os.DirEntry) else os.stat (path)
+    return StatData (st.st_mtime_ns, st.st_size, st.st_ino, st.st_mode)
+
 
+INDEX_SIGNATURE = b'UIDX'
+INDEX_VERSION = 4
+INDEX_HEADER = struct.Struct ('>4sIII')
+# oid, mtime_ns, size, inode, mode, flags, path length
+INDEX_ENTRY = struct.Struct ('>20sqQQIHH')
+# Entry flag: the file is not in the working directory (sparse checkout)
+INDEX_SKIP_WORKTREE = 1
+# oid, path length
+INDEX_TREE = struct.Struct ('>20sH')
+
+
+class Index (MutableMapping):
+    """ The Index maps file paths to blob OIDs.
+    Next to each entry the stat data of its work tree file is kept, 
+    so files which did not change are not read and hashed again.
+    The tree OIDs of directories without changed entries are cached 
+    (the root directory as ''), so they need not be written again.
+    Entries flagged skip-worktree are outside of a sparse checkout, 
+    their files are not in the working directory.
+    Changes mark the Index as dirty, only then it is written back.
+    """
+    def __init__ (self, entries=None, stats=None, timestamp=0, trees=None,
+                  skip=None):
+        self.entries = dict (entries or {})
+        self.stats = dict (stats or {})
+        self.trees = dict (trees or {})
+        self.skip = set (skip or ())
+        # mtime of the Index file when it was read
+        self.timestamp = timestamp
+        # paths whose stat data was verified by hashing in this process
+        self._fresh = set ()
+        self.dirty = False
+
+    def __getitem__ (self, path):
+        return self.entries[path]
+
+    def __setitem__ (self, path, oid):
+        # stat data only stays valid as long as the entry is unchanged
+        if self.entries.get (path) != oid:
+            self.stats.pop (path, None)
+            self._invalidate (path)
+            self.dirty = True
+        self.entries[path] = oid
+
+    def __delitem__ (self, path):
+        del self.entries[path]
+        self.stats.pop (path, None)
+        self.skip.discard (path)
+        self._invalidate (path)
+        self.dirty = True
+
+    def _invalidate (self, path):
+        """ Drop the cached trees of all directories leading to path """
+        while path:
+            path = path.rpartition ('/')[0]
+            self.trees.pop (path, None)
+
+    def __iter__ (self):
+        return iter (self.entries)
+
+    def __len__ (self):
+        return len (self.entries)
+
+    def __repr__ (self):
+        return repr (self.entries)
+
+    def clear (self):
+        if self.entries or self.trees:
+            self.dirty = True
+        self.entries.clear ()
+        self.stats.clear ()
+        self.trees.clear ()
+        self.skip.clear ()
+
+    def set_skip_worktree (self, path, skip):
+        """ Flag an entry whose file is left out of the working directory """
+        if (path in self.skip) != skip:
+            self.dirty = True
+            if skip:
+                self.skip.add (path)
+                self.stats.pop (path, None)
+            else:
+                self.skip.discard (path)
+
+    def set_stat (self, path, stat):
+        """ Record the stat data of a file which matches its entry """
+        # Writing a racy entry again moves the timestamp past it
+        if self.stats.get (path) != stat or stat.mtime_ns >= self.timestamp:
+            self.dirty = True
+        self.stats[path] = stat
+        self._fresh.add (path)
+
+    def cache_tree (self, path, oid):
+        """ Record the tree OID of an unchanged directory """
+        if self.trees.get (path) != oid:
+            self.trees[path] = oid
+            self.dirty = True
+
+    def is_clean (self, path, stat):
+        """ Test if a work tree file can be trusted to match its entry.
+        A file modified within the same timestamp tick as the Index 
+        was written is 'racily clean', and has to be hashed again.
+        """
+        return (path in self.entries
+                and self.stats.get (path) == stat
+                and stat.mtime_ns < self.timestamp)
+
+
+def _read_index (fp):
+    """ Read the binary Index file, or one in the former JSON format """
+    with open (fp, 'rb') as f:
+        buf = mmap.mmap (f.fileno (), 0, access=mmap.ACCESS_READ)
+    timestamp = fp.stat ().st_mtime_ns
+    try:
+        if buf[:4] != INDEX_SIGNATURE:
+            return _read_json_index (bytes (buf), timestamp)
+        assert hashlib.sha1 (memoryview (buf)[:-20]).digest () == buf[-20:], \
+            f'Index file {fp} is corrupt'
+        return _parse_index (buf, timestamp)
+    finally:
+        buf.close ()
+
+
+def _parse_index (buf, timestamp):
+    signature, version, n_entries, n_trees = INDEX_HEADER.unpack_from (buf, 0)
+    assert version == INDEX_VERSION, f'Unsupported Index version {version}'
+    pos = INDEX_HEADER.size
+
+    entries, stats, trees, skip = {}, {}, {}, set ()
+    for _ in range (n_entries):
+        oid, *stat, flags, length = INDEX_ENTRY.unpack_from (buf, pos)
+        pos += INDEX_ENTRY.size
+        path = buf[pos:pos + length].decode ()
+        pos += length
+        entries[path] = oid.hex ()
+        # Entries without stat data are stored with a zero mode
+        if stat[-1]:
+            stats[path] = StatData (*stat)
+        if flags & INDEX_SKIP_WORKTREE:
+            skip.add (path)
+
+    for _ in range (n_trees):
+        oid, length = INDEX_TREE.unpack_from (buf, pos)
+        pos += INDEX_TREE.size
+        trees[buf[pos:pos + length].decode ()] = oid.hex ()
+        pos += length
+
+    return Index (entries, stats, timestamp, trees, skip)
+
+
+def _read_json_index (buf, timestamp):
+    """ Read the former JSON Index, which maps paths to OIDs """
+    return Index (json.loads (buf), timestamp=timestamp)
+
+
+def _write_index (f, index):
+    """ Write the Index in binary format:
+      header     - signature, version, number of entries and of trees
+      entries    - oid, stat data, flags, path length, path; sorted by path
+      trees      - oid, path length, directory path
+      checksum   - SHA-1 of all the above
+    """
+    out = bytearray (INDEX_HEADER.pack (INDEX_SIGNATURE, INDEX_VERSION,
+                                        len (index.entries), len (index.trees)))
+    for path in sorted (index.entries):
+        stat = index.stats.get (path)
+        # Racy entries which were not verified again would look clean
+        # against the new Index timestamp, so their stat data is dropped
+        if not stat or (stat.mtime_ns >= index.timestamp
+                        and path not in index._fresh):
+            stat = StatData (0, 0, 0, 0)
+        flags = INDEX_SKIP_WORKTREE if path in index.skip else 0
+        name = path.encode ()
+        out += INDEX_ENTRY.pack (bytes.fromhex (index.entries[path]),
+                                 *stat, flags, len (name))
+        out += name
+
+    for path, oid in sorted (index.trees.items ()):
+        name = path.encode ()
+        out += INDEX_TREE.pack (bytes.fromhex (oid), len (name))
+        out += name
+
+    out += hashlib.sha1 (out).digest ()
+    f.write (out)
+
+
+@contextmanager
+def get_index (read_only=False, try_lock=False):
+    """ In the context of processing the Index file, 
+    the Index is returned to the caller, and afterwards 
+    written back if it changed.
+    Unless read_only, the Index is locked meanwhile by an 'index.lock' 
+    file, which replaces the Index file when it is written.
+    With try_lock, an Index locked by another process is only read,
+    so its changes are dropped.
+    """
     fp = GIT_DIR / 'index'
-    if fp.is_file ():
-        index = json.loads (fp.read_text ())
+    if read_only:
+        yield _read_index (fp) if fp.is_file () else Index ()
+        return
+
+    lock = GIT_DIR / 'index.lock'
+    try:
+        f = open (lock, 'xb')
+    except FileExistsError:
+        if try_lock:
+            yield _read_index (fp) if fp.is_file () else Index ()
+            return
+        raise FileExistsError (f'Unable to create {lock}: '
+                               'another ugit process seems to be running') from None
+
+    replaced = False
+    try:
+        with f:
+            index = _read_index (fp) if fp.is_file () else Index ()
+            yield index
+            if index.dirty:
+                _write_index (f, index)
+        if index.dirty:
+            os.replace (lock, fp)
+            replaced = True
+    finally:
+        # The lock is left behind neither on errors, nor if unchanged
+        if not replaced:
+            lock.unlink ()
+
+
+def _loose_path (oid, objects_dir=None):
+    """ Loose objects are stored in fan-out directories: objects/ab/cdef... """
+    return (objects_dir or GIT_DIR / 'objects') / oid[:2] / oid[2:]
 
-    yield index
 
-    fp.write_text (json.dumps (index))
+def _legacy_path (oid, objects_dir=None):
+    """ Uncompressed loose objects of the former flat layout: objects/abcdef... """
+    return (objects_dir or GIT_DIR / 'objects') / oid
+
+
+def _write_loose (oid, compressed):
+    """ Store a compressed loose object, through a temp file and rename """
+    fp = _loose_path (oid)
+    fp.parent.mkdir (exist_ok=True)
+    tmp = fp.with_name (f'tmp-{os.getpid ()}-{fp.name}')
+    tmp.write_bytes (compressed)
+    os.replace (tmp, fp)
+
+
+def _get_file_mode ():
+    """ Return the mode new files get from open (), as the umask permits """
+    umask = os.umask (0)
+    os.umask (umask)
+    return 0o666 & ~umask
+
+
+# Temp files are only accessible by their owner, loose objects written
+# through one are given the mode of those written by _write_loose
+FILE_MODE = _get_file_mode ()
 
 
 def hash_object (data, type_='blob'):
@@ -121,19 +590,293 @@ def hash_object (data, type_='blob'):
     obj = type_.encode () + b'\x00' + data
     oid = hashlib.sha1 (obj).hexdigest ()
     
-    fp = GIT_DIR / 'objects' / oid
-    if not fp.is_file ():
-        fp.write_bytes(obj)
+    if not object_exists (oid):
+        _write_loose (oid, zlib.compress (obj, zlib.Z_BEST_SPEED))
     
     return oid
 
 
+def hash_object_stream (f, type_='blob'):
+    """ write the content of a binary file object to the object database,
+    reading, hashing and compressing it in chunks of constant size
+    """
+    header = type_.encode () + b'\x00'
+    sha = hashlib.sha1 (header)
+    z = zlib.compressobj (zlib.Z_BEST_SPEED)
+
+    fd, tmp = tempfile.mkstemp (dir=GIT_DIR / 'objects', prefix='tmp-')
+    try:
+        with open (fd, 'wb') as out:
+            out.write (z.compress (header))
+            for chunk in iter (lambda: f.read (pack.CHUNK_SIZE), b''):
+                sha.update (chunk)
+                out.write (z.compress (chunk))
+            out.write (z.flush ())
+            os.fchmod (out.fileno (), FILE_MODE)
+
+        oid = sha.hexdigest ()
+        if not object_exists (oid):
+            fp = _loose_path (oid)
+            fp.parent.mkdir (exist_ok=True)
+            os.replace (tmp, fp)
+    finally:
+        if os.path.exists (tmp):
+            os.unlink (tmp)
+
+    return oid
+
+
+def hash_file (path, type_='blob'):
+    """ write the content of a file to the object database by streaming """
+    with open (path, 'rb') as f:
+        return hash_object_stream (f, type_)
+
+
+def _inflate_loose (fp):
+    """ Stream decompress a loose object file. 
+    Yields the object type first, followed by chunks of its content.
+    """
+    d = zlib.decompressobj ()
+    header = b''
+    with open (fp, 'rb') as f:
+        for chunk in iter (lambda: f.read (pack.CHUNK_SIZE), b''):
+            out = d.decompress (chunk)
+            if header is not None:
+                header += out
+                if b'\x00' not in header:
+                    continue
+                type_, _, out = header.partition (b'\x00')
+                yield type_.decode ()
+                header = None
+            if out:
+                yield out
+    assert d.eof, f'Truncated object {fp}'
+
+
+# Packs of the current object directory, cached by the directory's path
+# together with the mtime of its pack directory (rescanned when it changes)
+_packs = {}
+
+
+def _get_packs (rescan=False, objects_dir=None):
+    """ Return the list of packs in the object database """
+    pack_dir = (objects_dir or GIT_DIR / 'objects') / 'pack'
+    key = str (pack_dir.absolute ())
+    cached = _packs.get (key)
+    if cached and not rescan:
+        return cached[1]
+
+    mtime = pack_dir.stat ().st_mtime_ns if pack_dir.is_dir () else None
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    packs = [pack.Pack (fp.with_suffix ('.pack'))
+             for fp in sorted (pack_dir.glob ('*.idx'))] if mtime else []
+    _packs[key] = (mtime, packs)
+    return packs
+
+
+def _forget_packs ():
+    """ Drop the cached list of packs, after packs were added or removed
+    too quickly to change the modification time of the pack directory
+    """
+    _packs.pop (str ((GIT_DIR / 'objects' / 'pack').absolute ()), None)
+
+
+def get_packs ():
+    """ Return the list of packs, checking the pack directory for changes """
+    return _get_packs (rescan=True)
+
+
+# Alternates by the path of their file, along with its stat data
+_alternates = {}
+
+
+def _alternates_stat (fp):
+    """ Return (mtime, size) of the alternates file fp, or None """
+    try:
+        st = os.stat (fp)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def get_alternates (objects_dir=None):
+    """ Return the object directories listed in objects/info/alternates,
+    whose objects are read as if they were part of this object database
+    """
+    objects_dir = objects_dir or GIT_DIR / 'objects'
+    fp = objects_dir / 'info' / 'alternates'
+    stat = _alternates_stat (fp)
+    key = str (fp.absolute ())
+    cached = _alternates.get (key)
+    if not cached or cached[0] != stat:
+        dirs = [objects_dir / line.strip ()
+                for line in fp.read_text ().splitlines ()
+                if line.strip () and not line.startswith ('#')] if stat else []
+        cached = _alternates[key] = (stat, dirs)
+    return cached[1]
+
+
+def add_alternate (objects_dir):
+    """ Add an object directory to read objects from """
+    fp = GIT_DIR / 'objects' / 'info' / 'alternates'
+    fp.parent.mkdir (parents=True, exist_ok=True)
+    with open (fp, 'a') as f:
+        f.write (f'{Path (objects_dir).absolute ()}\n')
+
+
+# Object directories with their alternates by the current directory and
+# GIT_DIR, along with their alternates files and the stat data those had
+_object_dirs = {}
+
+
+def _iter_object_dirs ():
+    """ Return the object directory, then those of its alternates,
+    and theirs in turn. Resolved again only when an alternates file
+    changed, so a lookup costs a stat per object directory.
+    """
+    key = (os.getcwd (), str (GIT_DIR))
+    cached = _object_dirs.get (key)
+    if cached and cached[1] == list (map (_alternates_stat, cached[0])):
+        return cached[2]
+
+    files, stats, dirs = [], [], []
+    todo = [GIT_DIR / 'objects']
+    seen = set ()
+    while todo:
+        objects_dir = todo.pop (0)
+        resolved = objects_dir.resolve ()
+        if resolved in seen:
+            continue
+        seen.add (resolved)
+        dirs.append (objects_dir)
+        # Stat before reading, so a change meanwhile is noticed next time
+        files.append (str (objects_dir / 'info' / 'alternates'))
+        stats.append (_alternates_stat (files[-1]))
+        todo.extend (get_alternates (objects_dir))
+    _object_dirs[key] = (files, stats, dirs)
+    return dirs
+
+
+def _find_object (oid):
+    """ Return where an object is stored, as ('loose' or 'legacy', path)
+    or ('pack', Pack), or None. The local object directory is searched 
+    before the alternates. If not found, pack directories are checked
+    for new packs once.
+    """
+    for objects_dir in _iter_object_dirs ():
+        fp = _loose_path (oid, objects_dir)
+        if fp.is_file ():
+            return 'loose', fp
+        fp = _legacy_path (oid, objects_dir)
+        if fp.is_file ():
+            return 'legacy', fp
+        for p in _get_packs (False, objects_dir):
+            if oid in p:
+                return 'pack', p
+
+    for objects_dir in _iter_object_dirs ():
+        for p in _get_packs (True, objects_dir):
+            if oid in p:
+                return 'pack', p
+    return None
+
+
+# A partial clone lacks the blobs which a filtered fetch left out, and
+# fetches them from the remote recorded in .ugit/promisor when they are
+# first needed, through a function (remote, list of OIDs) set by the
+# remote module
+_lazy_fetch = None
+
+
+def set_lazy_fetch (fetch_objects):
+    global _lazy_fetch
+    _lazy_fetch = fetch_objects
+
+
+def get_promisor ():
+    """ Return the remote which promises the missing objects, or None """
+    fp = GIT_DIR / 'promisor'
+    return fp.read_text ().strip () if fp.is_file () else None
+
+
+def set_promisor (remote):
+    (GIT_DIR / 'promisor').write_text (f'{remote}\n')
+
+
+def prefetch_objects (oids):
+    """ Fetch those of oids which are missing from the promisor remote,
+    all in one transfer. Returns the number of objects requested.
+    """
+    remote = get_promisor ()
+    if not remote or not _lazy_fetch:
+        return 0
+    missing = [oid for oid in dict.fromkeys (oids)
+               if oid and not object_exists (oid)]
+    if missing:
+        _lazy_fetch (remote, missing)
+    return len (missing)
+
+
+def _open_object (oid):
+    """ Return (type, iterator over chunks of the content) of an object """
+    cached = object_cache.get (oid)
+    if cached:
+        return cached[0], iter ((cached[1],))
+
+    found = _find_object (oid)
+    if not found and prefetch_objects ([oid]):
+        found = _find_object (oid)
+    assert found, f'Object {oid} not found'
+    kind, location = found
+    if kind == 'loose':
+        chunks = _inflate_loose (location)
+        return next (chunks), chunks
+    if kind == 'legacy':
+        type_, _, content = location.read_bytes ().partition (b'\x00')
+        return type_.decode (), iter ((content,))
+    return location.stream (oid)
+
+
+def _read_object (oid):
+    """ Return (type, content) of an object, either loose or packed """
+    type_, chunks = _open_object (oid)
+    content = b''.join (chunks)
+    object_cache.put (oid, (type_, content), len (content))
+    return type_, content
+
+
+def _read_header (oid):
+    """ Return (type, size) of an object, without holding its content.
+    Loose objects do not record their size, so they are decompressed
+    chunk by chunk to count it.
+    """
+    cached = object_cache.get (oid)
+    if cached:
+        return cached[0], len (cached[1])
+    found = _find_object (oid)
+    if found and found[0] == 'pack':
+        return found[1].read_header (oid)
+    type_, chunks = _open_object (oid)
+    return type_, sum (map (len, chunks))
+
+
+def open_object (oid, expected='blob'):
+    """ Like get_object, but the content is returned as an iterator
+    over chunks, so large objects are never held in memory entirely
+    """
+    type_, chunks = _open_object (oid)
+
+    if expected is not None:
+        assert type_ == expected, f'Expected {expected}, got {type_}'
+
+    return chunks
+
+
 def get_object (oid, expected='blob'):
     """ Fetch file content from object database by OId """
-    obj = (GIT_DIR / 'objects' / oid).read_bytes()
-
-    type_, _, content = obj.partition (b'\x00')
-    type_ = type_.decode ()
+    type_, content = _read_object (oid)
 
     if expected is not None:
         assert type_ == expected, f'Expected {expected}, got {type_}'
@@ -142,22 +885,250 @@ def get_object (oid, expected='blob'):
 
 
 def object_exists (oid):
-    """ Test if object exists """
-    return (GIT_DIR / 'objects' / oid).is_file() 
+    """ Test if object exists, here or in an alternate """
+    return _find_object (oid) is not None
+
+
+def _iter_loose_paths ():
+    """ Yield (oid, path) of all loose objects, in either layout """
+    for fp in (GIT_DIR / 'objects').iterdir ():
+        if len (fp.name) == 40 and fp.is_file ():
+            yield fp.name, fp
+        elif len (fp.name) == 2 and fp.is_dir ():
+            for obj in fp.iterdir ():
+                if len (obj.name) == 38:
+                    yield fp.name + obj.name, obj
+
+
+def iter_loose_objects ():
+    """ Return a generator yielding the OIDs of all loose objects """
+    return (oid for oid, _ in _iter_loose_paths ())
+
+
+# Loose objects younger than this (in seconds) are never deleted by
+# a repack, as they may belong to a commit which is still being created
+PRUNE_EXPIRE = 14 * 24 * 3600
+
+
+def repack (keep=None):
+    """ Move all loose objects, and the objects of all existing packs,
+    into one new pack. Returns the new pack, or None if there are no objects.
+    If keep is given, only the objects in keep are packed, and all others
+    are deleted, except for recent loose objects.
+    """
+    old_packs = _get_packs (rescan=True)
+    loose = dict (_iter_loose_paths ())
+    oids = set (loose)
+    for p in old_packs:
+        oids.update (p)
+    if keep is not None:
+        oids &= set (keep)
+    if not oids:
+        return None
+
+    new_pack = pack.write_pack (GIT_DIR / 'objects' / 'pack', oids, _read_object,
+                                read_header=_read_header, open_object=_open_object)
+
+    for p in old_packs:
+        if p.path != new_pack:
+            p.path.unlink ()
+            p.idx.path.unlink ()
+            p.path.with_suffix ('.bitmap').unlink (missing_ok=True)
+    expire = time.time () - PRUNE_EXPIRE
+    for oid, fp in loose.items ():
+        if oid in oids or fp.stat ().st_mtime < expire:
+            fp.unlink ()
+    for fp in (GIT_DIR / 'objects').iterdir ():
+        if len (fp.name) == 2 and fp.is_dir () and not any (fp.iterdir ()):
+            fp.rmdir ()
+
+    _forget_packs ()
+    return next (p for p in _get_packs () if p.path == new_pack)
+
 
+# Commit-graphs, cached by the path of their file. As the file is only
+# appended to, a cached graph may miss commits other processes added,
+# but its records stay valid. Appending reads the file again if it changed.
+_commit_graphs = {}
 
-def fetch_object_if_missing (oid, remote_git_dir):
-    """ Fetch object from remote GIT_DIR """
+
+def get_commit_graph ():
+    """ Return the commit-graph of the object database """
+    fp = GIT_DIR / 'objects' / 'info' / 'commit-graph'
+    key = str (fp.absolute ())
+    if key not in _commit_graphs:
+        _commit_graphs[key] = commitgraph.CommitGraph (fp)
+    return _commit_graphs[key]
+
+
+def _read_loose_raw (oid):
+    """ Return the compressed bytes of a loose object, or None """
+    fp = _loose_path (oid)
+    return fp.read_bytes () if fp.is_file () else None
+
+
+def _copy_object (oid, raw, obj):
+    """ Store an object read from another object database, either as
+    its compressed loose file, or as (type, content)
+    """
+    if raw:
+        _write_loose (oid, raw)
+    else:
+        type_, content = obj
+        assert hash_object (content, type_) == oid, f'Corrupt object {oid}'
+
+
+def fetch_object_if_missing (oid, remote_git_dir, link=False):
+    """ Fetch object from remote GIT_DIR.
+    With link, a loose object is hardlinked (or reflinked) instead of copied.
+    """
     if object_exists (oid):
         return
 
-    fp = GIT_DIR / 'objects' / oid
-    fp.write_bytes( (remote_git_dir / fp ).read_bytes() )
+    if link:
+        with change_git_dir (remote_git_dir):
+            src = _loose_path (oid)
+        if src.is_file ():
+            _loose_path (oid).parent.mkdir (exist_ok=True)
+            _link_file (src, _loose_path (oid))
+            return
+
+    with change_git_dir (remote_git_dir):
+        raw = _read_loose_raw (oid)
+        obj = None if raw else _read_object (oid)
+    _copy_object (oid, raw, obj)
+
+
+# ioctl request to share the data blocks of a file (Linux, btrfs/XFS)
+FICLONE = 0x40049409
+
+
+def _link_file (src, dst):
+    """ Share an immutable file of another object database: hardlink it,
+    or reflink it across devices where supported, or copy it otherwise
+    """
+    try:
+        os.link (src, dst)
+        return
+    except FileExistsError:
+        return
+    except OSError:
+        pass
+
+    tmp = dst.with_name (f'tmp-{os.getpid ()}-{dst.name}')
+    with open (src, 'rb') as f_src, open (tmp, 'wb') as f_dst:
+        try:
+            fcntl.ioctl (f_dst.fileno (), FICLONE, f_src.fileno ())
+        except (AttributeError, OSError):
+            shutil.copyfileobj (f_src, f_dst)
+    os.replace (tmp, dst)
+
+
+def link_packs (remote_git_dir):
+    """ Hardlink (or reflink) all packs of remote GIT_DIR which are
+    missing here, returns the number of linked packs
+    """
+    with change_git_dir (remote_git_dir):
+        remote_dir = GIT_DIR / 'objects' / 'pack'
+    pack_dir = GIT_DIR / 'objects' / 'pack'
+    pack_dir.mkdir (parents=True, exist_ok=True)
+
+    count = 0
+    for idx in sorted (remote_dir.glob ('pack-*.idx')):
+        if (pack_dir / idx.name).is_file ():
+            continue
+        # The index comes last, as it makes the pack visible to readers
+        for suffix in ('.pack', '.bitmap', '.idx'):
+            src = idx.with_suffix (suffix)
+            if src.is_file ():
+                _link_file (src, pack_dir / src.name)
+        count += 1
+    _forget_packs ()
+    return count
 
 
 def push_object (oid, remote_git_dir):
     """ Push object to remote GIT_DIR """
-    fp = GIT_DIR / 'objects' / oid
-    (remote_git_dir / fp).write_bytes( fp.read_bytes() )
+    raw = _read_loose_raw (oid)
+    obj = None if raw else _read_object (oid)
+    with change_git_dir (remote_git_dir):
+        _copy_object (oid, raw, obj)
+
 
+def temp_pack_file ():
+    """ Create a temp file for an incoming pack, returns (fd, path) """
+    pack_dir = GIT_DIR / 'objects' / 'pack'
+    pack_dir.mkdir (parents=True, exist_ok=True)
+    return tempfile.mkstemp (dir=pack_dir, prefix='tmp-', suffix='.pack')
+
+
+def add_pack (tmp):
+    """ Verify and index a pack written to the temp file tmp, then add it
+    to the object database. Returns the number of received objects.
+    """
+    pack_path = pack.index_pack (tmp)
+    # Temp files are only readable by their owner
+    os.chmod (pack_path, FILE_MODE)
+    os.chmod (pack_path.with_suffix ('.idx'), FILE_MODE)
+    _forget_packs ()
+    return len (next (p for p in _get_packs () if p.path.name == pack_path.name))
 
+
+def _read_delta (oid):
+    """ Return (base OID, delta) of an object stored as a delta, or None """
+    found = _find_object (oid)
+    if found and found[0] == 'pack':
+        return found[1].read_delta (oid)
+    return None
+
+
+def send_pack (f, oids, progress=None):
+    """ Write a pack of the objects oids to the binary file f. Deltas
+    already stored in packs are sent as they are, only the other objects
+    are searched for deltas.
+    """
+    pack.write_pack_stream (f, oids, _read_object, progress=progress,
+                            read_delta=_read_delta, read_header=_read_header,
+                            open_object=_open_object)
+
+
+def receive_pack (chunks):
+    """ Add a pack received as an iterable of byte chunks to the object
+    database, returns the number of received objects
+    """
+    fd, tmp = temp_pack_file ()
+    try:
+        with open (fd, 'wb') as f:
+            for chunk in chunks:
+                f.write (chunk)
+        return add_pack (tmp)
+    finally:
+        Path (tmp).unlink (missing_ok=True)
+
+
+def fetch_pack (oids, remote_git_dir, progress=None):
+    """ Fetch objects from remote GIT_DIR as a single pack,
+    returns the number of received objects
+    """
+    fd, tmp = temp_pack_file ()
+    try:
+        with open (fd, 'wb') as f, change_git_dir (remote_git_dir):
+            send_pack (f, oids, progress)
+        return add_pack (tmp)
+    finally:
+        Path (tmp).unlink (missing_ok=True)
+
+
+def push_pack (oids, remote_git_dir, progress=None):
+    """ Push objects to remote GIT_DIR as a single pack,
+    returns the number of received objects
+    """
+    with change_git_dir (remote_git_dir):
+        fd, tmp = temp_pack_file ()
+    try:
+        with open (fd, 'wb') as f:
+            send_pack (f, oids, progress)
+        with change_git_dir (remote_git_dir):
+            return add_pack (tmp)
+    finally:
+        Path (tmp).unlink (missing_ok=True)
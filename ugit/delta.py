@@ -0,0 +1,150 @@
+# File: delta.py
+# Date: 2026-10-17
+
+# Length of the blocks of the base which are indexed for matching
+BLOCK_SIZE = 16
+# Largest copy and insert instruction
+MAX_COPY = 0xffffff
+MAX_INSERT = 0x7f
+
+
+def encode_varint (value):
+    """ Encode an unsigned integer as little endian base-128 """
+    out = bytearray ()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append (byte | 0x80)
+        else:
+            out.append (byte)
+            return bytes (out)
+
+
+def decode_varint (buf, pos):
+    """ Decode an unsigned integer at pos, returns (value, new_pos) """
+    value = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def create_delta (base, target, max_size=None):
+    """ Return a delta which rebuilds target from base, made of
+    copy (offset, size) and insert (literal bytes) instructions.
+    Returns None as soon as the delta would exceed max_size.
+    """
+    index = {}
+    for offset in range (len (base) - BLOCK_SIZE, -1, -BLOCK_SIZE):
+        index[base[offset:offset + BLOCK_SIZE]] = offset
+
+    out = bytearray (encode_varint (len (base)) + encode_varint (len (target)))
+    insert = bytearray ()
+    i = 0
+    end = len (target)
+    while i < end:
+        offset = index.get (target[i:i + BLOCK_SIZE]) if i + BLOCK_SIZE <= end else None
+        if offset is None:
+            insert.append (target[i])
+            i += 1
+            if max_size is not None and len (out) + len (insert) > max_size:
+                return None
+            continue
+
+        # Extend the match forwards, then backwards into pending literals
+        size = BLOCK_SIZE + _match_length (base, offset + BLOCK_SIZE,
+                                           target, i + BLOCK_SIZE)
+        while insert and offset and base[offset - 1] == insert[-1]:
+            insert.pop ()
+            offset -= 1
+            i -= 1
+            size += 1
+
+        _emit_insert (out, insert)
+        insert.clear ()
+        _emit_copy (out, offset, size)
+        i += size
+
+    _emit_insert (out, insert)
+    if max_size is not None and len (out) > max_size:
+        return None
+    return bytes (out)
+
+
+def _match_length (a, a_pos, b, b_pos):
+    """ Return the number of equal bytes of a and b from the given positions """
+    length = 0
+    step = 4096
+    while step:
+        chunk_a = a[a_pos + length:a_pos + length + step]
+        if chunk_a and chunk_a == b[b_pos + length:b_pos + length + step]:
+            length += len (chunk_a)
+            if len (chunk_a) < step:
+                break
+        else:
+            # Narrow down the first difference by halving the step
+            step //= 2
+    return length
+
+
+def _emit_insert (out, literal):
+    for start in range (0, len (literal), MAX_INSERT):
+        chunk = literal[start:start + MAX_INSERT]
+        out.append (len (chunk))
+        out += chunk
+
+
+def _emit_copy (out, offset, size):
+    while size:
+        chunk = min (size, MAX_COPY)
+        op = 0x80
+        args = bytearray ()
+        for i in range (4):
+            byte = (offset >> (8 * i)) & 0xff
+            if byte:
+                op |= 1 << i
+                args.append (byte)
+        for i in range (3):
+            byte = (chunk >> (8 * i)) & 0xff
+            if byte:
+                op |= 0x10 << i
+                args.append (byte)
+        out.append (op)
+        out += args
+        offset += chunk
+        size -= chunk
+
+
+def apply_delta (base, delta):
+    """ Rebuild the target of a delta from its base """
+    base_size, pos = decode_varint (delta, 0)
+    target_size, pos = decode_varint (delta, pos)
+    assert base_size == len (base), 'Delta does not match its base'
+
+    out = bytearray ()
+    end = len (delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            offset = size = 0
+            for i in range (4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range (3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            out += base[offset:offset + size]
+        else:
+            assert op, 'Invalid delta instruction'
+            out += delta[pos:pos + op]
+            pos += op
+
+    assert len (out) == target_size, 'Delta produced a wrong size'
+    return bytes (out)
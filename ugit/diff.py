@@ -1,11 +1,12 @@
 # File: diff.py
 # Date: 2020-11-29
 
-import subprocess
+import re
 
-from collections import defaultdict
-from tempfile import NamedTemporaryFile as Temp
+from collections import defaultdict, namedtuple
+from collections.abc import Mapping
 
+from ugit import base
 from ugit import data
 
 def compare_trees (*trees):
@@ -18,66 +19,426 @@ def compare_trees (*trees):
         yield (path, *oids)
 
 
-def iter_changed_files (t_from, t_to):
-    for path, o_from, o_to in compare_trees (t_from, t_to):
-        if o_from != o_to:
-            action = ('new file' if not o_from else
-                      'deleted' if not o_to else
-                      'modified')
-            yield path, action
+def in_pathspec (path, pathspec, is_dir=False):
+    """ Test if a path is selected by a list of path prefixes.
+    Directories are also selected if they lead to a selected path.
+    """
+    if not pathspec:
+        return True
+    for spec in pathspec:
+        spec = spec.rstrip ('/')
+        if path == spec or path.startswith (spec + '/'):
+            return True
+        if is_dir and spec.startswith (path + '/'):
+            return True
+    return False
+
+
+def iter_tree_changes (oid_from, oid_to, pathspec=None, base_path=''):
+    """ Compare two stored trees by walking them side by side, and yield
+    (path, o_from, o_to) for each changed blob. Subtrees with the same
+    OID on both sides are skipped without being read.
+    """
+    if oid_from == oid_to:
+        return
+
+    entries_from, entries_to = ({name: (type_, oid) 
+                                 for type_, oid, name in base._iter_tree_entries (tree)}
+                                for tree in (oid_from, oid_to))
+
+    for name in sorted (entries_from.keys () | entries_to.keys ()):
+        type_from, o_from = entries_from.get (name, (None, None))
+        type_to, o_to = entries_to.get (name, (None, None))
+        if o_from == o_to:
+            continue
+        path = base_path + name
+        is_dir = 'tree' in (type_from, type_to)
+        if not in_pathspec (path, pathspec, is_dir):
+            continue
+
+        # A path may change between file and directory
+        if is_dir:
+            yield from iter_tree_changes (
+                o_from if type_from == 'tree' else None,
+                o_to if type_to == 'tree' else None,
+                pathspec, f'{path}/')
+        blob_from = o_from if type_from == 'blob' else None
+        blob_to = o_to if type_to == 'blob' else None
+        if blob_from != blob_to:
+            yield path, blob_from, blob_to
+
 
+def _iter_changes (t_from, t_to, pathspec=None):
+    """ Yield (path, o_from, o_to) of the changed files of two trees.
+    A tree is either a dictionary of file paths and OIDs, or the OID of
+    a stored tree. Two stored trees are compared by iter_tree_changes.
+    """
+    if not (isinstance (t_from, Mapping) or isinstance (t_to, Mapping)):
+        yield from iter_tree_changes (t_from, t_to, pathspec)
+        return
 
-def diff_trees (t_from, t_to):
-    output = b''
+    if not isinstance (t_from, Mapping):
+        t_from = base.get_tree (t_from)
+    if not isinstance (t_to, Mapping):
+        t_to = base.get_tree (t_to)
     for path, o_from, o_to in compare_trees (t_from, t_to):
-        if o_from != o_to:
-            output += diff_blobs (o_from, o_to)
-    return output
+        if o_from != o_to and in_pathspec (path, pathspec):
+            yield path, o_from, o_to
+
+
+def iter_changed_files (t_from, t_to, pathspec=None):
+    for path, o_from, o_to in _iter_changes (t_from, t_to, pathspec):
+        action = ('new file' if not o_from else
+                  'deleted' if not o_to else
+                  'modified')
+        yield path, action
+
+
+def diff_trees (t_from, t_to, pathspec=None):
+    """ Return a generator yielding the unified diff of two trees in chunks """
+    for path, o_from, o_to in _iter_changes (t_from, t_to, pathspec):
+        yield from diff_blobs (o_from, o_to, path)
+
+
+# Lines of context around each hunk
+CONTEXT = 3
+# Bytes searched for a NUL byte to detect binary files
+BINARY_CHECK_SIZE = 8000
+# Lines shown after a hunk header, like 'diff --show-c-function'
+FUNCTION_LINE = re.compile (rb'[A-Za-z_$]')
+FUNCTION_LINE_WIDTH = 40
 
 
 def diff_blobs (o_from, o_to, path='blob'):
-    with Temp () as f_from, Temp () as f_to:
-        for oid, f in ((o_from, f_from), (o_to, f_to)):
-            if oid:
-                f.write (data.get_object (oid))
-                f.flush ()
-                
-        with subprocess.Popen (
-            ['diff', '--unified', '--show-c-function',
-             '--label', f'a/{path}', f_from.name,
-             '--label', f'b/{path}', f_to.name],
-            stdout=subprocess.PIPE) as proc:
-                output, _ = proc.communicate ()
-                
-        return output
+    """ Return a generator yielding the unified diff of two blobs in chunks """
+    if o_from == o_to:
+        return
+    c_from = data.get_object (o_from) if o_from else b''
+    c_to = data.get_object (o_to) if o_to else b''
+    if c_from == c_to:
+        return
+
+    if (b'\x00' in c_from[:BINARY_CHECK_SIZE] or 
+            b'\x00' in c_to[:BINARY_CHECK_SIZE]):
+        yield f'Binary files a/{path} and b/{path} differ\n'.encode ()
+        return
+
+    yield f'--- a/{path}\n+++ b/{path}\n'.encode ()
+    yield from unified_diff (_split_lines (c_from), _split_lines (c_to))
+
+
+def _split_lines (content):
+    """ Split content after each newline, keeping the line endings """
+    lines = content.split (b'\n')
+    last = lines.pop ()
+    lines = [line + b'\n' for line in lines]
+    if last:
+        lines.append (last)
+    return lines
+
+
+def unified_diff (a, b, context=CONTEXT):
+    """ Yield the hunks of a unified diff between two lists of lines """
+    func_pos, func_line = 0, b''
+
+    for group in _group_opcodes (_opcodes (a, b), context):
+        first, last = group[0], group[-1]
+
+        # The last line before the hunk looking like a function definition
+        for line in a[func_pos:first[1]]:
+            if FUNCTION_LINE.match (line):
+                func_line = line.rstrip (b'\n')[:FUNCTION_LINE_WIDTH]
+        func_pos = first[1]
+
+        header = (f'@@ -{_format_range (first[1], last[2])}'
+                  f' +{_format_range (first[3], last[4])} @@').encode ()
+        hunk = [header + (b' ' + func_line if func_line else b'') + b'\n']
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                hunk.extend (_prefix_lines (b' ', a[i1:i2]))
+                continue
+            hunk.extend (_prefix_lines (b'-', a[i1:i2]))
+            hunk.extend (_prefix_lines (b'+', b[j1:j2]))
+        yield b''.join (hunk)
+
+
+def _prefix_lines (prefix, lines):
+    for line in lines:
+        yield prefix + line
+        if not line.endswith (b'\n'):
+            yield b'\n\\ No newline at end of file\n'
+
+
+def _format_range (start, stop):
+    """ Convert a range to the 'start,length' format of unified diffs """
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return f'{beginning}'
+    if not length:
+        beginning -= 1
+    return f'{beginning},{length}'
+
+
+def _opcodes (a, b):
+    """ Return a list of (tag, i1, i2, j1, j2) turning a into b,
+    tag being 'equal' or 'replace' 
+    """
+    codes = []
+    i = j = 0
+    for ai, bj, size in diff_lines (a, b) + [(len (a), len (b), 0)]:
+        if i < ai or j < bj:
+            codes.append (('replace', i, ai, j, bj))
+        if size:
+            codes.append (('equal', ai, ai + size, bj, bj + size))
+        i, j = ai + size, bj + size
+    return codes
+
+
+def _group_opcodes (codes, n):
+    """ Split opcodes into hunks with up to n lines of context """
+    if not codes:
+        return
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max (i1, i2 - n), i2, max (j1, j2 - n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min (i2, i1 + n), j1, min (j2, j1 + n)
+
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        # Split the group at long runs of unchanged lines
+        if tag == 'equal' and i2 - i1 > 2 * n:
+            group.append ((tag, i1, min (i2, i1 + n), j1, min (j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max (i1, i2 - n), max (j1, j2 - n)
+        group.append ((tag, i1, i2, j1, j2))
+    if group and not (len (group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+
+def diff_lines (a, b):
+    """ Return the matching blocks (i, j, size) of a shortest edit script
+    between the lists a and b, computed by Myers' O(ND) algorithm in its
+    linear space variant: each range is split at the middle snake of its
+    shortest path, after stripping common prefixes and suffixes.
+    """
+    # Compare small integers instead of lines
+    ids = {}
+    a = [ids.setdefault (line, len (ids)) for line in a]
+    b = [ids.setdefault (line, len (ids)) for line in b]
+
+    blocks = []
+    ranges = [(0, len (a), 0, len (b))]
+    while ranges:
+        alo, ahi, blo, bhi = ranges.pop ()
+
+        n = 0
+        while alo + n < ahi and blo + n < bhi and a[alo + n] == b[blo + n]:
+            n += 1
+        if n:
+            blocks.append ((alo, blo, n))
+            alo, blo = alo + n, blo + n
+
+        n = 0
+        while alo < ahi - n and blo < bhi - n and a[ahi - n - 1] == b[bhi - n - 1]:
+            n += 1
+        if n:
+            blocks.append ((ahi - n, bhi - n, n))
+            ahi, bhi = ahi - n, bhi - n
+
+        if alo == ahi or blo == bhi:
+            continue
+        if ahi - alo == 1 or bhi - blo == 1:
+            # A single line matches at most once
+            if ahi - alo == 1 and a[alo] in b[blo:bhi]:
+                blocks.append ((alo, b.index (a[alo], blo, bhi), 1))
+            elif bhi - blo == 1 and b[blo] in a[alo:ahi]:
+                blocks.append ((a.index (b[blo], alo, ahi), blo, 1))
+            continue
+
+        a_range, b_range = a[alo:ahi], b[blo:bhi]
+        if set (a_range).isdisjoint (b_range):
+            continue
+        split = _middle_snake (a_range, b_range)
+        if split:
+            x, y = split
+            ranges.append ((alo + x, ahi, blo + y, bhi))
+            ranges.append ((alo, alo + x, blo, blo + y))
+
+    # Sort and join adjacent blocks
+    result = []
+    for i, j, n in sorted (blocks):
+        if result and result[-1][0] + result[-1][2] == i and result[-1][1] + result[-1][2] == j:
+            result[-1] = (result[-1][0], result[-1][1], result[-1][2] + n)
+        else:
+            result.append ((i, j, n))
+    return result
+
+
+def _middle_snake (a, b):
+    """ Walk the shortest edit path of a and b from both ends at once.
+    Returns the point (x, y) where both walks meet, or None if a and b
+    have nothing in common.
+    """
+    n, m = len (a), len (b)
+    max_d = (n + m + 1) // 2
+    offset = max_d
+    v1 = [-1] * (2 * max_d + 2)
+    v1[offset + 1] = 0
+    v2 = v1[:]
+    delta = n - m
+    # If delta is odd, the forward walk is the one to meet the reverse walk
+    front = delta % 2 != 0
+    k1start = k1end = k2start = k2end = 0
+
+    for d in range (max_d):
+        # Forward walk, one step
+        for k1 in range (-d + k1start, d + 1 - k1end, 2):
+            k1_offset = offset + k1
+            if k1 == -d or (k1 != d and v1[k1_offset - 1] < v1[k1_offset + 1]):
+                x1 = v1[k1_offset + 1]
+            else:
+                x1 = v1[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and a[x1] == b[y1]:
+                x1 += 1
+                y1 += 1
+            v1[k1_offset] = x1
+            if x1 > n:
+                k1end += 2
+            elif y1 > m:
+                k1start += 2
+            elif front:
+                k2_offset = offset + delta - k1
+                if 0 <= k2_offset < len (v2) and v2[k2_offset] != -1:
+                    if x1 >= n - v2[k2_offset]:
+                        return x1, y1
+
+        # Reverse walk, one step
+        for k2 in range (-d + k2start, d + 1 - k2end, 2):
+            k2_offset = offset + k2
+            if k2 == -d or (k2 != d and v2[k2_offset - 1] < v2[k2_offset + 1]):
+                x2 = v2[k2_offset + 1]
+            else:
+                x2 = v2[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while x2 < n and y2 < m and a[-x2 - 1] == b[-y2 - 1]:
+                x2 += 1
+                y2 += 1
+            v2[k2_offset] = x2
+            if x2 > n:
+                k2end += 2
+            elif y2 > m:
+                k2start += 2
+            elif not front:
+                k1_offset = offset + delta - k2
+                if 0 <= k1_offset < len (v1) and v1[k1_offset] != -1:
+                    x1 = v1[k1_offset]
+                    y1 = offset + x1 - k1_offset
+                    if x1 >= n - x2:
+                        return x1, y1
+    return None
+
+
+Conflict = namedtuple ('Conflict', ['path', 'kind'])
+Conflict.__doc__ = """A named tuple representing a merge conflict
+- with two fields:
+  path  - file path
+  kind  - 'content', 'add/add' or 'modify/delete'
+"""
+
+MergeResult = namedtuple ('MergeResult', ['tree', 'conflicts'])
+MergeResult.__doc__ = """A named tuple representing the result of merge_trees
+- with two fields:
+  tree       - dictionary of file paths and OIDs
+  conflicts  - list of Conflicts
+"""
 
 
 def merge_trees (t_base, t_HEAD, t_other):
+    """ Three-way merge of flat trees. Paths changed on one side only,
+    or changed the same way on both sides, are resolved by OID alone.
+    Only paths modified differently on both sides are merged by lines.
+    """
     tree = {}
+    conflicts = []
     for path, o_base, o_HEAD, o_other in compare_trees (t_base, t_HEAD, t_other):
-        tree[path] = data.hash_object (merge_blobs (o_base, o_HEAD, o_other))
-    return tree
+        if o_HEAD == o_other or o_base == o_other:
+            oid = o_HEAD
+        elif o_base == o_HEAD:
+            oid = o_other
+        elif not o_HEAD or not o_other:
+            # Keep the modified version of a file deleted on the other side
+            oid = o_HEAD or o_other
+            conflicts.append (Conflict (path, 'modify/delete'))
+        else:
+            merged, clean = merge_blobs (o_base, o_HEAD, o_other)
+            oid = data.hash_object (merged)
+            if not clean:
+                conflicts.append (Conflict (path, 'content' if o_base else 'add/add'))
+        if oid:
+            tree[path] = oid
+    return MergeResult (tree, conflicts)
 
 
 def merge_blobs (o_base, o_HEAD, o_other):
-    with Temp () as f_base, Temp () as f_HEAD, Temp () as f_other:
-        
-        # write blobs to file
-        for oid, f in ((o_base, f_base), (o_HEAD, f_HEAD), (o_other, f_other)):
-            if oid:
-                f.write (data.get_object (oid))
-                f.flush ()
-                
-        with subprocess.Popen (
-            ['diff3', '-m',
-             '-L', 'HEAD', f_HEAD.name,
-             '-L', 'BASE', f_base.name,
-             '-L', 'MERGE_HEAD', f_other.name
-            ], stdout=subprocess.PIPE) as proc:
-            output, _ = proc.communicate ()
-            assert proc.returncode in (0,1)
-            
-        return output
-    
-    
+    """ Merge the lines of two blobs changed from a common base blob.
+    Returns the merged content, and whether it is free of conflicts.
+    Conflicts are marked like 'diff3 -m' does.
+    """
+    base, HEAD, other = (_split_lines (data.get_object (oid)) if oid else []
+                         for oid in (o_base, o_HEAD, o_other))
+
+    output = []
+    clean = True
+    for b_chunk, h_chunk, o_chunk in _merge_chunks (base, HEAD, other):
+        if h_chunk == o_chunk or b_chunk == o_chunk:
+            output.extend (h_chunk)
+        elif b_chunk == h_chunk:
+            output.extend (o_chunk)
+        else:
+            clean = False
+            for marker, lines in ((b'<<<<<<< HEAD\n', h_chunk),
+                                  (b'||||||| BASE\n', b_chunk),
+                                  (b'=======\n', o_chunk)):
+                output.append (marker)
+                output.extend (lines)
+                if lines and not lines[-1].endswith (b'\n'):
+                    output.append (b'\n')
+            output.append (b'>>>>>>> MERGE_HEAD\n')
+
+    return b''.join (output), clean
+
+
+def _merge_chunks (base, HEAD, other):
+    """ Split three lists of lines into aligned chunks (base, HEAD, other).
+    Chunks alternate between regions where all three are equal, and
+    regions in between, where one or both sides changed the base.
+    """
+    # Base lines kept on both sides, as (base, HEAD, other, size)
+    syncs = []
+    m_HEAD, m_other = diff_lines (base, HEAD), diff_lines (base, other)
+    i = j = 0
+    while i < len (m_HEAD) and j < len (m_other):
+        b1, h, n1 = m_HEAD[i]
+        b2, o, n2 = m_other[j]
+        start, end = max (b1, b2), min (b1 + n1, b2 + n2)
+        if start < end:
+            syncs.append ((start, h + start - b1, o + start - b2, end - start))
+        if b1 + n1 < b2 + n2:
+            i += 1
+        else:
+            j += 1
+    syncs.append ((len (base), len (HEAD), len (other), 0))
 
+    b = h = o = 0
+    for b_sync, h_sync, o_sync, size in syncs:
+        if b < b_sync or h < h_sync or o < o_sync:
+            yield base[b:b_sync], HEAD[h:h_sync], other[o:o_sync]
+        if size:
+            yield (base[b_sync:b_sync + size], HEAD[h_sync:h_sync + size],
+                   other[o_sync:o_sync + size])
+        b, h, o = b_sync + size, h_sync + size, o_sync + size
@@ -0,0 +1,173 @@
+# File: ignore.py
+# Date: 2026-10-17
+
+import os
+import re
+
+from collections import namedtuple
+
+
+IGNORE_FILE = '.ugitignore'
+
+# Ignored unless IGNORE_FILE re-includes them
+DEFAULT_PATTERNS = ['*.ipynb', '.ipynb_checkpoints', '.gitignore', 'ugit.egg-info']
+# Ignored whatever IGNORE_FILE says
+FORCED_PATTERNS = ['.ugit']
+
+
+Rule = namedtuple ('Rule', ['regex', 'negate', 'dir_only'])
+Rule.__doc__ = """A named tuple representing a compiled ignore pattern
+- with three fields:
+  regex     - compiled regular expression over the whole relative path
+  negate    - Boolean, the pattern started with '!' and re-includes paths
+  dir_only  - Boolean, the pattern ended with '/' and only matches directories
+"""
+
+
+def _translate (pattern):
+    """ Translate a gitignore pattern into a regular expression over paths
+    relative to the top directory. Patterns without a slash match a name
+    at any level, the others are anchored to the top directory.
+    '*' and '?' do not match a slash, '**' matches any number of directories.
+    """
+    anchored = '/' in pattern
+    pattern = pattern.removeprefix ('/')
+    regex = '' if anchored else '(?:.*/)?'
+    i, n = 0, len (pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith ('**', i) and (i == 0 or pattern[i - 1] == '/'):
+            if pattern.startswith ('**/', i):
+                regex += '(?:.*/)?'
+                i += 3
+                continue
+            if i + 2 == n:
+                regex += '.*'
+                i += 2
+                continue
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[':
+            # A ']' right after the opening bracket belongs to the class
+            j = i + 1
+            if j < n and pattern[j] in '!^':
+                j += 1
+            j = pattern.find (']', j + 1)
+            if j < 0:
+                regex += re.escape (c)
+            else:
+                chars = pattern[i + 1:j].replace ('\\', '\\\\')
+                if chars[0] == '!':
+                    chars = '^' + chars[1:]
+                elif chars[0] in '^[':
+                    chars = '\\' + chars
+                regex += f'(?!/)[{chars}]'
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            regex += re.escape (pattern[i])
+        else:
+            regex += re.escape (c)
+        i += 1
+    return regex
+
+
+def _parse (line):
+    """ Return the Rule of a line of an ignore file, or None """
+    if not line.endswith ('\\ '):
+        line = line.rstrip ()
+    if not line or line.startswith ('#'):
+        return None
+    negate = line.startswith ('!')
+    if negate:
+        line = line[1:]
+    dir_only = line.endswith ('/')
+    line = line.rstrip ('/')
+    if not line:
+        return None
+    return Rule (re.compile (_translate (line)), negate, dir_only)
+
+
+def _combine (rules):
+    """ Compile the regular expressions of rules into one """
+    return re.compile ('|'.join (f'(?:{rule.regex.pattern})' for rule in rules)
+                       or '(?!)')
+
+
+class IgnoreRules:
+    """ Gitignore-style patterns, each compiled once. The last pattern
+    which matches a path decides, those starting with '!' re-include it.
+    Without such patterns, all of them are combined into one expression
+    for files and one for directories, so a path is tested at once.
+    """
+    def __init__ (self, lines):
+        self.rules = [rule for rule in map (_parse, lines) if rule]
+        self._combined = None
+        if not any (rule.negate for rule in self.rules):
+            self._combined = (_combine ([rule for rule in self.rules
+                                         if not rule.dir_only]),
+                              _combine (self.rules))
+
+    def match (self, path, is_dir=False):
+        """ Test if a relative path is ignored by itself, regardless
+        of its directories
+        """
+        if self._combined:
+            return self._combined[is_dir].fullmatch (path) is not None
+        for rule in reversed (self.rules):
+            if (is_dir or not rule.dir_only) and rule.regex.fullmatch (path):
+                return not rule.negate
+        return False
+
+    def is_ignored (self, path, is_dir=False):
+        """ Test if a relative path is ignored, or lies in an ignored directory """
+        parts = path.split ('/')
+        for i in range (1, len (parts)):
+            if self.match ('/'.join (parts[:i]), True):
+                return True
+        return self.match (path, is_dir)
+
+
+# Rules by the directory and the mtime of its IGNORE_FILE
+_rules = {}
+
+
+def get_rules ():
+    """ Return the rules of IGNORE_FILE in the current directory along with
+    the default ones, compiled again only when the file changed
+    """
+    try:
+        mtime = os.stat (IGNORE_FILE).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    key = (os.getcwd (), mtime)
+    if key not in _rules:
+        lines = []
+        if mtime is not None:
+            with open (IGNORE_FILE) as f:
+                lines = f.read ().splitlines ()
+        _rules[key] = IgnoreRules (DEFAULT_PATTERNS + lines + FORCED_PATTERNS)
+    return _rules[key]
+
+
+def walk (directory='.', rules=None, include_dir=None):
+    """ Yield (path, os.DirEntry) of the files below directory which are
+    not ignored, with paths relative to the current directory. Ignored
+    directories, and those include_dir (path) rejects, are not entered.
+    Symbolic links to directories are not followed.
+    """
+    rules = rules or get_rules ()
+    todo = [os.path.normpath (directory)]
+    while todo:
+        current = todo.pop ()
+        with os.scandir (current) as entries:
+            for entry in entries:
+                path = entry.name if current == '.' else f'{current}/{entry.name}'
+                if entry.is_dir (follow_symlinks=False):
+                    if (not rules.match (path, True)
+                            and (include_dir is None or include_dir (path))):
+                        todo.append (path)
+                elif entry.is_file () and not rules.match (path):
+                    yield path, entry
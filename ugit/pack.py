@@ -0,0 +1,636 @@
+# File: pack.py
+# Date: 2026-10-17
+
+import hashlib
+import mmap
+import os
+import struct
+import zlib
+
+from collections import deque
+from pathlib import Path
+
+from ugit import delta
+from ugit.cache import LRUCache
+from ugit.delta import encode_varint, decode_varint
+
+
+PACK_SIGNATURE = b'UPAK'
+IDX_SIGNATURE = b'\xffUIX'
+BITMAP_SIGNATURE = b'UBMP'
+VERSION = 1
+
+# Object type codes within a pack entry
+TYPE_CODES = {'commit': 1, 'tree': 2, 'blob': 3}
+TYPE_NAMES = {code: type_ for type_, code in TYPE_CODES.items ()}
+# Entry holding a delta against an earlier entry of the same pack
+OFS_DELTA = 6
+
+CHUNK_SIZE = 64 * 1024
+
+# Number of preceding objects tried as delta base, and the longest delta chain
+WINDOW = 10
+DEPTH = 50
+# Objects smaller than this are always stored whole
+MIN_DELTA_SIZE = 64
+# Objects larger than this are always stored whole, and are no delta
+# base either, as searching deltas for them costs more than it saves
+BIG_FILE_THRESHOLD = 1024 * 1024
+
+# Objects rebuilt from deltas, keyed by (pack path, offset), so walking
+# several chains through the same base only decodes it once
+base_cache = LRUCache (32 * 1024 * 1024)
+
+
+def _iter_inflate (buf, pos):
+    """ Decompress a zlib stream starting at pos,
+    feeding the decompressor chunk by chunk, and yielding its output.
+    """
+    d = zlib.decompressobj ()
+    while not d.eof:
+        chunk = buf[pos:pos + CHUNK_SIZE]
+        assert chunk, 'Truncated pack entry'
+        out = d.decompress (chunk)
+        if out:
+            yield out
+        pos += CHUNK_SIZE
+
+
+def _inflate (buf, pos):
+    return b''.join (_iter_inflate (buf, pos))
+
+
+def _inflate_end (buf, pos):
+    """ Decompress a zlib stream starting at pos, 
+    returns (content, position after the stream)
+    """
+    d = zlib.decompressobj ()
+    out = []
+    while not d.eof:
+        chunk = buf[pos:pos + CHUNK_SIZE]
+        assert chunk, 'Truncated pack entry'
+        out.append (d.decompress (chunk))
+        pos += len (chunk)
+    return b''.join (out), pos - len (d.unused_data)
+
+
+def _hash_inflate_end (buf, pos, header):
+    """ Decompress a zlib stream starting at pos chunk by chunk, without
+    holding its content. Returns (SHA-1 of header and the content,
+    size of the content, position after the stream)
+    """
+    d = zlib.decompressobj ()
+    sha = hashlib.sha1 (header)
+    size = 0
+    while not d.eof:
+        chunk = buf[pos:pos + CHUNK_SIZE]
+        assert chunk, 'Truncated pack entry'
+        pos += len (chunk)
+        # Bounded output, as a small chunk may inflate to a huge one
+        while chunk and not d.eof:
+            out = d.decompress (chunk, CHUNK_SIZE)
+            sha.update (out)
+            size += len (out)
+            chunk = d.unconsumed_tail
+    return sha.hexdigest (), size, pos - len (d.unused_data)
+
+
+def _map_file (path):
+    with open (path, 'rb') as f:
+        return mmap.mmap (f.fileno (), 0, access=mmap.ACCESS_READ)
+
+
+class PackIndex:
+    """ Sorted OID table of a pack, with a fan-out table over the
+    first OID byte, so a lookup is a binary search within one slot.
+    Layout:
+      signature, version
+      fan-out    - 256 x uint32, number of OIDs with first byte <= i
+      OIDs       - N x 20 bytes, sorted
+      offsets    - N x uint64, position of each entry in the pack
+      trailer    - pack checksum, idx checksum
+    """
+    HEADER = struct.Struct ('>4sI')
+    FANOUT = struct.Struct ('>256I')
+
+    def __init__ (self, path):
+        self.path = Path (path)
+        self._map = _map_file (path)
+        signature, version = self.HEADER.unpack_from (self._map, 0)
+        assert signature == IDX_SIGNATURE, f'Bad pack index {path}'
+        assert version == VERSION, f'Unsupported pack index version {version}'
+
+        self.fanout = self.FANOUT.unpack_from (self._map, self.HEADER.size)
+        self.count = self.fanout[-1]
+        self._oids_at = self.HEADER.size + self.FANOUT.size
+        self._offsets_at = self._oids_at + 20 * self.count
+        self.pack_checksum = self._map[-40:-20]
+
+    def __len__ (self):
+        return self.count
+
+    def _oid_at (self, i):
+        start = self._oids_at + 20 * i
+        return self._map[start:start + 20]
+
+    def oid_at (self, i):
+        """ Return the OID at position i of the sorted OID table """
+        return self._oid_at (i).hex ()
+
+    def position (self, oid):
+        """ Return the position of oid in the sorted OID table, or None """
+        key = bytes.fromhex (oid)
+        lo = self.fanout[key[0] - 1] if key[0] else 0
+        hi = self.fanout[key[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = self._oid_at (mid)
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def offset (self, oid):
+        """ Return the offset of oid within the pack, or None """
+        i = self.position (oid)
+        if i is None:
+            return None
+        return struct.unpack_from ('>Q', self._map, self._offsets_at + 8 * i)[0]
+
+    def offsets (self):
+        """ Return the offsets of all OIDs, in the order of the OID table """
+        return struct.unpack_from (f'>{self.count}Q', self._map, self._offsets_at)
+
+    def __contains__ (self, oid):
+        return self.position (oid) is not None
+
+    def __iter__ (self):
+        """ Iterate over all OIDs in sorted order """
+        for i in range (self.count):
+            yield self._oid_at (i).hex ()
+
+
+class Pack:
+    """ Many objects concatenated into one file.
+    Layout:
+      signature, version, object count
+      entries    - type code (1 byte), size (varint), zlib data
+                   or OFS_DELTA, size, distance back to the base entry
+                   (varint), zlib compressed delta
+      trailer    - SHA-1 of all preceding bytes
+    """
+    HEADER = struct.Struct ('>4sII')
+
+    def __init__ (self, path):
+        self.path = Path (path)
+        self.idx = PackIndex (self.path.with_suffix ('.idx'))
+        self._map = _map_file (self.path)
+        signature, version, count = self.HEADER.unpack_from (self._map, 0)
+        assert signature == PACK_SIGNATURE, f'Bad pack {path}'
+        assert version == VERSION, f'Unsupported pack version {version}'
+        assert count == len (self.idx), f'Pack and index of {path} differ'
+
+    def __contains__ (self, oid):
+        return oid in self.idx
+
+    def __iter__ (self):
+        return iter (self.idx)
+
+    def __len__ (self):
+        return len (self.idx)
+
+    @property
+    def bitmaps (self):
+        """ The reachability bitmaps of the pack, empty if it has none """
+        if not hasattr (self, '_bitmaps'):
+            self._bitmaps = PackBitmaps (self.path.with_suffix ('.bitmap'),
+                                         self.idx.pack_checksum)
+        return self._bitmaps
+
+    def iter_bitmap (self, bits):
+        """ Yield the OIDs of the objects whose bits are set in bits """
+        buf = bits.to_bytes ((len (self) + 7) // 8, 'little')
+        for i, byte in enumerate (buf):
+            while byte:
+                low = byte & -byte
+                yield self.idx.oid_at (8 * i + low.bit_length () - 1)
+                byte ^= low
+
+    def read (self, oid):
+        """ Return (type, content) of a packed object, or None """
+        offset = self.idx.offset (oid)
+        if offset is None:
+            return None
+        return self.read_at (offset)
+
+    def stream (self, oid):
+        """ Return (type, iterator over chunks of the content) of a packed
+        object, or None. Only whole entries are decompressed in a streaming
+        fashion, deltas need their complete base to be rebuilt.
+        """
+        offset = self.idx.offset (oid)
+        if offset is None:
+            return None
+        code = self._map[offset]
+        if code == OFS_DELTA:
+            type_, content = self.read_at (offset)
+            return type_, iter ((content,))
+        _, pos = decode_varint (self._map, offset + 1)
+        return TYPE_NAMES[code], _iter_inflate (self._map, pos)
+
+    def read_header (self, oid):
+        """ Return (type, size) of a packed object, or None, without
+        decompressing it. The type of a delta is that of its chain's base.
+        """
+        offset = self.idx.offset (oid)
+        if offset is None:
+            return None
+        size, _ = decode_varint (self._map, offset + 1)
+        while self._map[offset] == OFS_DELTA:
+            _, pos = decode_varint (self._map, offset + 1)
+            distance, _ = decode_varint (self._map, pos)
+            offset = _base_offset (offset, distance)
+        return TYPE_NAMES[self._map[offset]], size
+
+    def read_at (self, offset):
+        """ Return (type, content) of the entry at offset,
+        following its delta chain down to a whole object.
+        """
+        return _read_at (self._map, self.path, offset)
+
+    def read_delta (self, oid):
+        """ Return (base OID, delta) of an object stored as a delta, or None """
+        offset = self.idx.offset (oid)
+        if offset is None or self._map[offset] != OFS_DELTA:
+            return None
+        _, pos = decode_varint (self._map, offset + 1)
+        distance, pos = decode_varint (self._map, pos)
+        if not hasattr (self, '_oids_by_offset'):
+            self._oids_by_offset = dict (zip (self.idx.offsets (), self.idx))
+        return (self._oids_by_offset[_base_offset (offset, distance)],
+                _inflate (self._map, pos))
+
+
+def _read_at (buf, key, offset):
+    """ Return (type, content) of the pack entry at offset within buf,
+    rebuilt objects are cached in base_cache by (key, offset)
+    """
+    chain = []
+    while True:
+        cached = base_cache.get ((key, offset))
+        if cached:
+            type_, content = cached
+            break
+        code = buf[offset]
+        size, pos = decode_varint (buf, offset + 1)
+        if code == OFS_DELTA:
+            distance, pos = decode_varint (buf, pos)
+            chain.append ((offset, pos, size))
+            offset = _base_offset (offset, distance)
+            continue
+        type_, content = TYPE_NAMES[code], _inflate (buf, pos)
+        assert len (content) == size, f'Corrupt pack entry at {offset}'
+        break
+
+    for delta_offset, pos, size in reversed (chain):
+        # Every object in a chain serves as a base for the next one
+        base_cache.put ((key, offset), (type_, content), len (content))
+        content = delta.apply_delta (content, _inflate (buf, pos))
+        assert len (content) == size, f'Corrupt pack entry at {delta_offset}'
+        offset = delta_offset
+    return type_, content
+
+
+def _base_offset (offset, distance):
+    """ Return the offset of the base of the delta entry at offset,
+    raises ValueError if distance does not lead back into the entries
+    """
+    if not 0 < distance <= offset - Pack.HEADER.size:
+        raise ValueError (f'Bad delta base distance {distance} '
+                          f'of the pack entry at {offset}')
+    return offset - distance
+
+
+class PackBitmaps:
+    """ Reachability bitmaps of selected commits of a pack. Bit i of the
+    bitmap of a commit is set if the object at position i of the pack 
+    index is reachable from the commit, the commit itself included.
+    Layout:
+      signature, version, pack checksum, number of bitmaps
+      entries    - commit OID, size of its compressed bitmap
+      bitmaps    - zlib compressed little endian bitsets, in entry order
+    Bitmaps of a different pack than the one they are stored next to
+    are ignored.
+    """
+    HEADER = struct.Struct ('>4sI20sI')
+    ENTRY = struct.Struct ('>20sI')
+
+    def __init__ (self, path, pack_checksum):
+        self.path = Path (path)
+        # Commit: (position in the file, compressed size)
+        self._entries = {}
+        if not self.path.is_file ():
+            return
+
+        buf = self.path.read_bytes ()
+        signature, version, checksum, count = self.HEADER.unpack_from (buf, 0)
+        assert signature == BITMAP_SIGNATURE, f'Bad bitmap file {path}'
+        if version != VERSION or checksum != pack_checksum:
+            return
+        self._buf = buf
+        pos = self.HEADER.size + count * self.ENTRY.size
+        for oid, size in self.ENTRY.iter_unpack (
+                buf[self.HEADER.size:self.HEADER.size + count * self.ENTRY.size]):
+            self._entries[oid.hex ()] = (pos, size)
+            pos += size
+
+    def __contains__ (self, oid):
+        return oid in self._entries
+
+    def __len__ (self):
+        return len (self._entries)
+
+    def get (self, oid):
+        """ Return the bitmap of a commit as int, or None """
+        entry = self._entries.get (oid)
+        if entry is None:
+            return None
+        pos, size = entry
+        return int.from_bytes (zlib.decompress (self._buf[pos:pos + size]),
+                               'little')
+
+
+def write_bitmaps (p, bitmaps):
+    """ Store bitmaps, given as {commit OID: int}, next to the pack p """
+    entries, blobs = [], []
+    for oid, bits in sorted (bitmaps.items ()):
+        blob = zlib.compress (bits.to_bytes ((len (p) + 7) // 8, 'little'))
+        entries.append (PackBitmaps.ENTRY.pack (bytes.fromhex (oid), len (blob)))
+        blobs.append (blob)
+
+    path = p.path.with_suffix ('.bitmap')
+    tmp_path = path.with_suffix ('.bitmap.tmp')
+    tmp_path.write_bytes (b''.join ((
+        PackBitmaps.HEADER.pack (BITMAP_SIGNATURE, VERSION,
+                                 p.idx.pack_checksum, len (entries)),
+        *entries,
+        *blobs,
+    )))
+    os.replace (tmp_path, path)
+    if hasattr (p, '_bitmaps'):
+        del p._bitmaps
+
+
+def write_pack (pack_dir, oids, read_object, window=WINDOW, depth=DEPTH,
+                read_header=None, open_object=None):
+    """ Write the given objects into a new pack with its index,
+    using read_object (oid) -> (type, content), see write_pack_stream
+    for read_header and open_object. Returns the pack's path.
+    """
+    pack_dir = Path (pack_dir)
+    pack_dir.mkdir (parents=True, exist_ok=True)
+    tmp_pack = pack_dir / f'tmp-{os.getpid ()}.pack'
+
+    with open (tmp_pack, 'wb') as f:
+        offsets, pack_checksum = write_pack_stream (
+            f, oids, read_object, window, depth,
+            read_header=read_header, open_object=open_object)
+
+    name = f'pack-{pack_checksum.hex ()}'
+    pack_path = pack_dir / f'{name}.pack'
+    os.replace (tmp_pack, pack_path)
+    _write_index (pack_dir / f'{name}.idx', offsets, pack_checksum)
+    return pack_path
+
+
+def write_pack_stream (f, oids, read_object, window=WINDOW, depth=DEPTH,
+                       progress=None, read_delta=None, read_header=None,
+                       open_object=None):
+    """ Write a pack of the given objects to the binary file f, using
+    read_object (oid) -> (type, content). Returns ({oid: offset}, checksum).
+    progress (done, total) is called for every written object.
+
+    Objects are sorted by type and decreasing size, as read_header (oid)
+    -> (type, size) returns them, and each one is stored as a delta against
+    one of the preceding objects within the window if that saves space,
+    as long as the chain stays below depth. Only the objects of the window
+    are held in memory. Objects above BIG_FILE_THRESHOLD are compressed
+    chunk by chunk as open_object (oid) -> (type, iterator over chunks)
+    returns them. Both default to read_object.
+    If given, read_delta (oid) -> (base OID, delta) or None returns the
+    delta an object is already stored as. It is reused without a search
+    if its base is in the pack as well, which is then written first.
+    """
+    if read_header is None:
+        def read_header (oid):
+            type_, content = read_object (oid)
+            return type_, len (content)
+    if open_object is None:
+        def open_object (oid):
+            type_, content = read_object (oid)
+            return type_, iter ((content,))
+
+    headers = {oid: read_header (oid) for oid in oids}
+    order = sorted (headers, key=lambda oid: (TYPE_CODES[headers[oid][0]],
+                                              -headers[oid][1], oid))
+    reused = {}
+    if read_delta:
+        for oid in order:
+            stored = read_delta (oid)
+            if stored and stored[0] in headers:
+                reused[oid] = stored
+
+    checksum = hashlib.sha1 ()
+    offsets = {}
+
+    def write (buf):
+        checksum.update (buf)
+        f.write (buf)
+        return len (buf)
+
+    write (Pack.HEADER.pack (PACK_SIGNATURE, VERSION, len (order)))
+    pos = Pack.HEADER.size
+    # Recent objects as (oid, type, content, chain depth)
+    candidates = deque (maxlen=window)
+    chains = {}
+    for oid in _order_bases_first (order, reused):
+        type_, size = headers[oid]
+        content = None
+        if oid in reused and chains[reused[oid][0]] < depth:
+            (base, best), chain = reused[oid], chains[reused[oid][0]] + 1
+        elif size > BIG_FILE_THRESHOLD:
+            base, best, chain = None, None, 0
+        else:
+            type_, content = read_object (oid)
+            base, best, chain = _find_delta_base (type_, content,
+                                                  candidates, depth)
+        offsets[oid] = pos
+        chains[oid] = chain
+        if best is not None:
+            pos += write (bytes ([OFS_DELTA])
+                          + encode_varint (size)
+                          + encode_varint (pos - offsets[base])
+                          + zlib.compress (best))
+        elif content is not None:
+            pos += write (bytes ([TYPE_CODES[type_]])
+                          + encode_varint (size)
+                          + zlib.compress (content))
+        else:
+            pos += _write_whole_stream (write, oid, type_, size,
+                                        open_object (oid)[1])
+        if window and size <= BIG_FILE_THRESHOLD:
+            if content is None:
+                content = read_object (oid)[1]
+            candidates.append ((oid, type_, content, chain))
+        if progress:
+            progress (len (offsets), len (order))
+
+    pack_checksum = checksum.digest ()
+    f.write (pack_checksum)
+    return offsets, pack_checksum
+
+
+def _write_whole_stream (write, oid, type_, size, chunks):
+    """ Write a whole entry, compressing the content chunk by chunk.
+    Returns the size of the entry.
+    """
+    z = zlib.compressobj ()
+    length = write (bytes ([TYPE_CODES[type_]]) + encode_varint (size))
+    written = 0
+    for chunk in chunks:
+        written += len (chunk)
+        length += write (z.compress (chunk))
+    length += write (z.flush ())
+    assert written == size, f'Object {oid} is not {size} bytes long'
+    return length
+
+
+def index_pack (path, progress=None):
+    """ Verify a pack file written by another object database, and add
+    its index. The OID of each entry is computed from its content. 
+    The pack is renamed after its checksum, returns the new path.
+    progress (done, total) is called for every indexed object.
+    """
+    path = Path (path)
+    buf = _map_file (path)
+    try:
+        signature, version, count = Pack.HEADER.unpack_from (buf, 0)
+        assert signature == PACK_SIGNATURE, f'Bad pack {path}'
+        assert version == VERSION, f'Unsupported pack version {version}'
+        pack_checksum = buf[-20:]
+        assert hashlib.sha1 (memoryview (buf)[:-20]).digest () == pack_checksum, \
+            f'Pack checksum mismatch in {path}'
+
+        offsets = {}
+        # Offsets of the entries indexed so far
+        entries = set ()
+        pos = Pack.HEADER.size
+        for i in range (count):
+            offset = pos
+            code = buf[pos]
+            size, pos = decode_varint (buf, pos + 1)
+            if code == OFS_DELTA:
+                distance, pos = decode_varint (buf, pos)
+                patch, pos = _inflate_end (buf, pos)
+                # Bases precede their deltas, so they are already indexed
+                base_offset = _base_offset (offset, distance)
+                if base_offset not in entries:
+                    raise ValueError (f'Delta base of the pack entry at {offset} '
+                                      f'is no entry')
+                type_, base = _read_at (buf, pack_checksum, base_offset)
+                content = delta.apply_delta (base, patch)
+            elif size > BIG_FILE_THRESHOLD:
+                # Hashed chunk by chunk, read again if a delta needs it
+                type_, content = TYPE_NAMES[code], None
+                oid, length, pos = _hash_inflate_end (
+                    buf, pos, type_.encode () + b'\x00')
+            else:
+                type_ = TYPE_NAMES[code]
+                content, pos = _inflate_end (buf, pos)
+            if content is not None:
+                length = len (content)
+                base_cache.put ((pack_checksum, offset), (type_, content), length)
+                sha = hashlib.sha1 (type_.encode () + b'\x00')
+                sha.update (content)
+                oid = sha.hexdigest ()
+            assert length == size, f'Corrupt pack entry at {offset}'
+            entries.add (offset)
+            offsets[oid] = offset
+            if progress:
+                progress (i + 1, count)
+        assert pos == len (buf) - 20, f'Trailing data in pack {path}'
+    finally:
+        buf.close ()
+
+    name = f'pack-{pack_checksum.hex ()}'
+    pack_path = path.with_name (f'{name}.pack')
+    os.replace (path, pack_path)
+    _write_index (path.with_name (f'{name}.idx'), offsets, pack_checksum)
+    return pack_path
+
+
+def _order_bases_first (order, reused):
+    """ Yield the OIDs of order, each reused delta after its base. A reused
+    delta whose base depends on it in turn is dropped from reused.
+    """
+    done = set ()
+    for oid in order:
+        todo = [oid]
+        while todo:
+            current = todo[-1]
+            if current in done:
+                todo.pop ()
+                continue
+            base = reused[current][0] if current in reused else None
+            if base is not None and base not in done:
+                if base in todo:
+                    del reused[current]
+                else:
+                    todo.append (base)
+                continue
+            todo.pop ()
+            done.add (current)
+            yield current
+
+
+def _find_delta_base (type_, content, candidates, depth):
+    """ Return (base oid, delta, chain depth) for the smallest delta 
+    against one of the candidates, or (None, None, 0) if no delta 
+    is at most half the size of the object.
+    """
+    base, best, chain = None, None, 0
+    if not MIN_DELTA_SIZE <= len (content) <= BIG_FILE_THRESHOLD:
+        return base, best, chain
+
+    for c_oid, c_type, c_content, c_chain in reversed (candidates):
+        if c_type != type_ or c_chain >= depth:
+            continue
+        max_size = len (best) - 1 if best else len (content) // 2
+        d = delta.create_delta (c_content, content, max_size)
+        if d is not None:
+            base, best, chain = c_oid, d, c_chain + 1
+    return base, best, chain
+
+
+def _write_index (path, offsets, pack_checksum):
+    oids = sorted (bytes.fromhex (oid) for oid in offsets)
+
+    fanout = [0] * 256
+    for oid in oids:
+        fanout[oid[0]] += 1
+    for i in range (1, 256):
+        fanout[i] += fanout[i - 1]
+
+    body = b''.join ((
+        PackIndex.HEADER.pack (IDX_SIGNATURE, VERSION),
+        PackIndex.FANOUT.pack (*fanout),
+        *oids,
+        *(struct.pack ('>Q', offsets[oid.hex ()]) for oid in oids),
+        pack_checksum,
+    ))
+    tmp_path = path.with_suffix ('.idx.tmp')
+    tmp_path.write_bytes (body + hashlib.sha1 (body).digest ())
+    os.replace (tmp_path, path)
@@ -0,0 +1,133 @@
+# File: protocol.py
+# Date: 2026-10-17
+
+import json
+import socket
+import struct
+
+from urllib.parse import urlsplit
+
+
+SCHEME = 'ugit'
+DEFAULT_PORT = 9418
+
+# Every message is prefixed by its length. Control messages are JSON,
+# pack data is sent as binary messages, followed by an empty one.
+HEADER = struct.Struct ('>I')
+FLUSH = HEADER.pack (0)
+CHUNK_SIZE = 64 * 1024
+MAX_MESSAGE = 64 * 1024 * 1024
+
+
+def is_url (remote):
+    """ Test if a remote is given as ugit://host:port/path """
+    return str (remote).startswith (f'{SCHEME}://')
+
+
+def encode (message):
+    payload = json.dumps (message).encode ()
+    return HEADER.pack (len (payload)) + payload
+
+
+def encode_data (chunk):
+    return HEADER.pack (len (chunk)) + chunk
+
+
+def _check_length (length):
+    assert length <= MAX_MESSAGE, f'Message too long ({length} bytes)'
+    return length
+
+
+def _decode (payload):
+    message = json.loads (payload)
+    assert 'error' not in message, f'Remote error: {message["error"]}'
+    return message
+
+
+class Connection:
+    """ Client side of a connection to a ugit server """
+    def __init__ (self, url):
+        parts = urlsplit (url)
+        assert parts.scheme == SCHEME, f'Unsupported URL {url}'
+        self.path = parts.path
+        self.sock = socket.create_connection ((parts.hostname or 'localhost',
+                                               parts.port or DEFAULT_PORT))
+        self.rfile = self.sock.makefile ('rb')
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc):
+        self.close ()
+
+    def close (self):
+        self.rfile.close ()
+        self.sock.close ()
+
+    def _read (self, size):
+        buf = self.rfile.read (size)
+        assert len (buf) == size, 'Connection closed by the server'
+        return buf
+
+    def _read_payload (self):
+        length, = HEADER.unpack (self._read (HEADER.size))
+        return self._read (_check_length (length))
+
+    def send (self, message):
+        self.sock.sendall (encode (message))
+
+    def receive (self):
+        return _decode (self._read_payload ())
+
+    def send_data (self, chunks):
+        """ Send binary chunks, followed by the end marker """
+        for chunk in chunks:
+            if chunk:
+                self.sock.sendall (encode_data (chunk))
+        self.sock.sendall (FLUSH)
+
+    def iter_data (self):
+        """ Yield binary chunks up to the end marker """
+        while True:
+            chunk = self._read_payload ()
+            if not chunk:
+                return
+            yield chunk
+
+
+class SocketWriter:
+    """ Binary file object sending everything written as data messages """
+    def __init__ (self, connection):
+        self.connection = connection
+        self.buf = bytearray ()
+
+    def write (self, data):
+        self.buf += data
+        while len (self.buf) >= CHUNK_SIZE:
+            self.connection.sock.sendall (encode_data (bytes (self.buf[:CHUNK_SIZE])))
+            del self.buf[:CHUNK_SIZE]
+
+    def close (self):
+        """ Send the rest, and the end marker """
+        self.connection.send_data ((bytes (self.buf),))
+        self.buf.clear ()
+
+
+async def read_message (reader):
+    """ Read a control message from an asyncio StreamReader """
+    length, = HEADER.unpack (await reader.readexactly (HEADER.size))
+    return _decode (await reader.readexactly (_check_length (length)))
+
+
+async def iter_data (reader):
+    """ Yield binary chunks from an asyncio StreamReader up to the end marker """
+    while True:
+        length, = HEADER.unpack (await reader.readexactly (HEADER.size))
+        if not length:
+            return
+        yield await reader.readexactly (_check_length (length))
+
+
+async def send (writer, message):
+    writer.write (encode (message))
+    await writer.drain ()
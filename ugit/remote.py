@@ -3,58 +3,276 @@
 
 
 import os
+import sys
 
 from ugit import base
 from ugit import data
+from ugit import protocol
 
 REMOTE_REFS_BASE = 'refs/heads'
 LOCAL_REFS_BASE = 'refs/remote'
 
+# Fewer objects than this are copied one by one, more as a single pack
+UNPACK_LIMIT = 100
 
-def fetch (remote_path):
-    # Get refs from server
-    refs = _get_remote_refs (remote_path, REMOTE_REFS_BASE)
-    
-    # Fetch missing objects by iterating and fetching on demand
-    for oid in base.iter_objects_in_commits (refs.values ()):
-        data.fetch_object_if_missing (oid, remote_path)
+
+def fetch (remote_path, link=False, depth=None, unshallow=False, blobs=True):
+    """ Fetch the branches of a remote, given as path or ugit:// URL.
+    With link, the objects of a local remote are hardlinked (or reflinked)
+    instead of copied. With depth, only that many commits of the history
+    of each branch are fetched, which also deepens a shallow repository,
+    while unshallow fetches all the history it is missing. Without blobs,
+    only commits and trees are fetched, and the remote is recorded as
+    promisor to fetch blobs from once they are needed.
+    """
+    assert depth is None or depth > 0, 'Depth must be positive'
+    assert depth is None or not unshallow, 'Depth and unshallow exclude each other'
+    deepen = depth is not None or unshallow
+    promisor = (remote_path if protocol.is_url (remote_path)
+                else os.path.abspath (remote_path))
+    # Later fetches from the promisor leave out blobs as well
+    blobs = blobs and data.get_promisor () != promisor
+
+    if protocol.is_url (remote_path):
+        refs, shallow = _fetch_url (remote_path, deepen, depth, blobs)
+    else:
+        refs, shallow = _fetch_local (remote_path, link, deepen, depth, blobs)
+    assert all (map (data.object_exists, refs.values ())), \
+        'Fetched objects are incomplete'
+    _update_shallow (shallow)
+    if not blobs:
+        data.set_promisor (promisor)
 
     # Update local refs to match server
     for remote_name, value in refs.items ():
         refname = os.path.relpath (remote_name, REMOTE_REFS_BASE)
         data.update_ref (f'{LOCAL_REFS_BASE}/{refname}',
                          data.RefValue (symbolic=False, value=value))
+    base.update_commit_graph (refs.values ())
+
+
+def _update_shallow (shallow):
+    """ Record the commits whose parents are missing as shallow, out of
+    those the remote reported and those which were shallow before
+    """
+    shallow = {oid for oid in data.get_shallow () | set (shallow)
+               if data.object_exists (oid) and not all (
+                   map (data.object_exists, base.get_commit (oid).parents))}
+    if shallow != data.get_shallow ():
+        data.set_shallow (shallow)
+
+
+def _find_haves (refs, has_commits):
+    """ Negotiate the commits both sides have, walking the local history
+    only until the server knows a commit
+    """
+    local_refs = {ref.value for _, ref in data.iter_refs ()}
+    haves = base.find_common_commits (local_refs, has_commits)
+    haves.update (oid for oid in refs.values () if data.object_exists (oid))
+    return haves
+
+
+def _fetch_local (remote_path, link=False, deepen=False, depth=None, blobs=True):
+    """ Return the fetched refs, and the commits to check for being
+    shallow
+    """
+    # Get refs from server
+    refs = _get_remote_refs (remote_path, REMOTE_REFS_BASE)
+    if link:
+        data.link_packs (remote_path)
+    haves = _find_haves (
+        refs, lambda batch: {oid for oid in batch if _remote_has (remote_path, oid)})
+    shallow = data.get_shallow ()
+
+    # Let the server enumerate the objects we are missing
+    with data.change_git_dir (remote_path):
+        wants, boundary = refs.values (), set ()
+        if deepen:
+            wants, boundary = base.get_shallow_fetch (wants, shallow, depth)
+        objects = list (base.iter_new_objects (wants, haves, shallow, boundary,
+                                               blobs))
+        boundary |= data.get_shallow ()
+
+    if link or len (objects) < UNPACK_LIMIT:
+        for oid in objects:
+            data.fetch_object_if_missing (oid, remote_path, link)
+    else:
+        data.fetch_pack (objects, remote_path, _progress ('Receiving objects'))
+    return refs, boundary
+
+
+def _fetch_url (url, deepen=False, depth=None, blobs=True):
+    """ Fetch over one connection: ref advertisement, negotiation
+    in batches of commits, then the pack of the missing objects.
+    Return the fetched refs, and the commits to check for being shallow.
+    """
+    with protocol.Connection (url) as conn:
+        conn.send ({'command': 'fetch', 'path': conn.path,
+                    'prefix': REMOTE_REFS_BASE})
+        refs = conn.receive ()['refs']
+
+        def has_commits (batch):
+            conn.send ({'have': batch})
+            return set (conn.receive ()['common'])
+
+        # Deepening needs the history of refs we already have
+        wants = [oid for oid in refs.values ()
+                 if deepen or not data.object_exists (oid)]
+        haves = _find_haves (refs, has_commits) if wants else set ()
+        conn.send ({'want': wants, 'done': sorted (haves),
+                    'shallow': sorted (data.get_shallow ()),
+                    'deepen': deepen, 'depth': depth, 'blobs': blobs})
+
+        message = conn.receive ()
+        if message['objects']:
+            data.receive_pack (_iter_progress (conn.iter_data (), 'Receiving objects',
+                                               message['objects']))
+    return refs, message.get ('shallow', [])
+
+
+def fetch_objects (remote_path, oids):
+    """ Fetch the given objects in one transfer, for a partial clone
+    which needs blobs its promisor remote left out
+    """
+    if protocol.is_url (remote_path):
+        with protocol.Connection (remote_path) as conn:
+            conn.send ({'command': 'objects', 'path': conn.path, 'want': oids})
+            count = conn.receive ()['objects']
+            if count:
+                data.receive_pack (_iter_progress (conn.iter_data (),
+                                                   'Fetching objects', count))
+    elif len (oids) < UNPACK_LIMIT:
+        for oid in oids:
+            data.fetch_object_if_missing (oid, remote_path)
+    else:
+        data.fetch_pack (oids, remote_path, _progress ('Fetching objects'))
+
+
+data.set_lazy_fetch (fetch_objects)
+
+
+def clone (remote_path, link=False, shared=False, depth=None, blobs=True):
+    """ Initialize a repository in the current directory, fetch the branches
+    of remote into it, and check out its master branch. The objects of a
+    local remote are hardlinked with link, or not copied at all with shared,
+    where its object directory is read as an alternate. With depth, only
+    that many commits of the history are fetched, without blobs only those
+    needed for the checkout.
+    """
+    base.init ()
+    if shared:
+        assert not protocol.is_url (remote_path), 'Only local remotes can be shared'
+        with data.change_git_dir (remote_path):
+            objects_dir = data.GIT_DIR / 'objects'
+        data.add_alternate (objects_dir)
+    fetch (remote_path, link, depth, blobs=blobs)
+
+    master = data.get_ref (f'{LOCAL_REFS_BASE}/master').value
+    if master:
+        # Check out while HEAD is unborn, then let master point to it
+        base.read_tree (base.get_commit_tree (master), update_working=True)
+        data.update_ref ('refs/heads/master',
+                         data.RefValue (symbolic=False, value=master))
+
+
+def _progress (title):
+    """ Return a callback (done, total) which reports the progress
+    of a transfer on stderr, if it is a terminal
+    """
+    shown = None
+
+    def report (done, total):
+        nonlocal shown
+        percent = 100 * done // total
+        if percent == shown or not sys.stderr.isatty ():
+            return
+        shown = percent
+        end = '\n' if done == total else ''
+        print (f'\r{title}: {percent}% ({done}/{total})',
+               end=end, file=sys.stderr, flush=True)
+    return report
+
+
+def _iter_progress (chunks, title, count):
+    """ Pass chunks through, reporting the received bytes """
+    received = 0
+    for chunk in chunks:
+        received += len (chunk)
+        if sys.stderr.isatty ():
+            print (f'\r{title} ({count} objects): {received // 1024} KiB',
+                   end='', file=sys.stderr, flush=True)
+        yield chunk
+    if sys.stderr.isatty ():
+        print (file=sys.stderr)
+
+
+def _remote_has (remote_path, oid):
+    with data.change_git_dir (remote_path):
+        return data.object_exists (oid)
 
 
 def _get_remote_refs (remote_path, prefix=''):
     with data.change_git_dir (remote_path):
         return {refname: ref.value for refname, ref in data.iter_refs (prefix)}
-            
+
 
 def push (remote_path, refname):
-    # Get refs data
-    remote_refs = _get_remote_refs (remote_path)
+    """ Push a branch to a remote, given as path or ugit:// URL """
+    if protocol.is_url (remote_path):
+        _push_url (remote_path, refname)
+    else:
+        _push_local (remote_path, refname)
+
+
+def _objects_to_push (remote_refs, refname):
+    """ Return (local value of refname, objects the server doesn't have) """
     remote_ref = remote_refs.get (refname)
     local_ref = data.get_ref (refname).value
     assert local_ref
-    
+
     # Don't allow force push
     assert not remote_ref or base.is_ancestor_of (local_ref, remote_ref)
-    
-    # Compute which objects the server doesn't have
-    known_remote_refs = filter (data.object_exists, remote_refs.values ())
-    remote_objects = set (base.iter_objects_in_commits (known_remote_refs))
-    local_objects = set (base.iter_objects_in_commits ({local_ref}))
-    objects_to_push = local_objects - remote_objects
+
+    # Compute which objects the server doesn't have: the server has the
+    # history of all its refs, so those we know are common commits
+    haves = set (filter (data.object_exists, remote_refs.values ()))
+    return local_ref, list (base.iter_new_objects ({local_ref}, haves))
+
+
+def _push_local (remote_path, refname):
+    local_ref, objects_to_push = _objects_to_push (
+        _get_remote_refs (remote_path), refname)
 
     # Push missing objects
-    for oid in objects_to_push:
-        data.push_object (oid, remote_path)
-        
+    if len (objects_to_push) < UNPACK_LIMIT:
+        for oid in objects_to_push:
+            if not _remote_has (remote_path, oid):
+                data.push_object (oid, remote_path)
+    else:
+        data.push_pack (objects_to_push, remote_path, _progress ('Sending objects'))
+    assert _remote_has (remote_path, local_ref), 'Pushed objects are incomplete'
+
     # Update server ref to our value
     with data.change_git_dir (remote_path):
         data.update_ref (refname,
                          data.RefValue (symbolic=False, value=local_ref))
-    
+        base.update_commit_graph ({local_ref})
+
 
+def _push_url (url, refname):
+    """ Push over one connection: ref advertisement, then the ref update
+    along with the pack of the objects the server doesn't have. The server
+    refuses the update if its ref changed in the meantime.
+    """
+    with protocol.Connection (url) as conn:
+        conn.send ({'command': 'push', 'path': conn.path})
+        remote_refs = conn.receive ()['refs']
+        local_ref, objects_to_push = _objects_to_push (remote_refs, refname)
 
+        conn.send ({'update': [refname, remote_refs.get (refname), local_ref],
+                    'objects': len (objects_to_push)})
+        if objects_to_push:
+            writer = protocol.SocketWriter (conn)
+            data.send_pack (writer, objects_to_push, _progress ('Sending objects'))
+            writer.close ()
+        conn.receive ()